@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, message_chunk_to_message, messages_from_dict
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects.postgresql import insert as upsert
+from typing import List, Optional, Sequence, Tuple
+from . import database, orm_models
+from .config import settings
+from .metrics import metrics
+import threading
+
+MESSAGE_OVERHEAD_BYTES = 200 # rough size of a message object besides its content, for the memory cap of the cache
+SUMMARY_PREFIX = "Summary of the earlier conversation with the user:\n"
+
+@dataclass
+class StoredMessage:
+    id: int # id of the chat_messages row (a counter with the memory backend)
+    created_at: datetime
+    message: BaseMessage
+
+    @property
+    def size(self) -> int:
+        return len(str(self.message.content)) + MESSAGE_OVERHEAD_BYTES
+
+@dataclass
+class CachedHistory:
+    messages: List[StoredMessage] = field(default_factory=list)
+    last_id: int = 0 # the messages up to this id are loaded
+    summary: str = "" # running summary of the messages up to summarized_up_to (summary mode)
+    summarized_up_to: int = 0
+
+    @property
+    def size(self) -> int:
+        return sum(stored.size for stored in self.messages) + len(self.summary)
+
+
+class PostgresChatHistoryBackend:
+    """Chat messages in the chat_messages table, kept over restarts and shared by all the processes."""
+
+    def load(self, user_id: str, after_id: int, since: datetime, limit: int) -> List[StoredMessage]:
+        """The last (at most limit) messages of the user after after_id and since."""
+        with database.Session_local() as db:
+            rows = db.execute(
+                select(orm_models.ChatMessages)
+                .where(orm_models.ChatMessages.owner_email == user_id,
+                       orm_models.ChatMessages.id > after_id,
+                       orm_models.ChatMessages.created_at >= since)
+                .order_by(orm_models.ChatMessages.id.desc())
+                .limit(limit)
+            ).scalars().all()
+            return [StoredMessage(id= row.id,
+                                  created_at= row.created_at,
+                                  message= messages_from_dict([{"type": row.role, "data": {"content": row.content}}])[0])
+                    for row in reversed(rows)]
+
+    def add(self, user_id: str, messages: Sequence[BaseMessage], since: datetime, limit: int):
+        """Stores the messages, and drops the messages of the user older than since or before the last limit ones."""
+        with database.Session_local() as db:
+            db.execute(insert(orm_models.ChatMessages),
+                       [{"owner_email": user_id, "role": message.type, "content": str(message.content)}
+                        for message in map(message_chunk_to_message, messages)]) # a streamed answer is an AIMessageChunk
+            kept_ids = (
+                select(orm_models.ChatMessages.id)
+                .where(orm_models.ChatMessages.owner_email == user_id)
+                .order_by(orm_models.ChatMessages.id.desc())
+                .limit(limit)
+            )
+            db.execute(
+                delete(orm_models.ChatMessages)
+                .where(orm_models.ChatMessages.owner_email == user_id)
+                .where((orm_models.ChatMessages.created_at < since) | orm_models.ChatMessages.id.not_in(kept_ids))
+            )
+            db.commit()
+
+    def load_summary(self, user_id: str) -> Tuple[str, int]:
+        with database.Session_local() as db:
+            row = db.get(orm_models.ChatSummaries, user_id)
+            return (row.summary, row.summarized_up_to) if row else ("", 0)
+
+    def save_summary(self, user_id: str, summary: str, summarized_up_to: int):
+        """Stores the summary (unless a newer one was stored meanwhile) and drops the summarized messages."""
+        with database.Session_local() as db:
+            statement = upsert(orm_models.ChatSummaries).values(owner_email=user_id, summary=summary, summarized_up_to=summarized_up_to)
+            db.execute(statement.on_conflict_do_update(
+                index_elements=["owner_email"],
+                set_={"summary": statement.excluded.summary, "summarized_up_to": statement.excluded.summarized_up_to},
+                where=orm_models.ChatSummaries.summarized_up_to < statement.excluded.summarized_up_to
+            ))
+            db.execute(delete(orm_models.ChatMessages).where(orm_models.ChatMessages.owner_email == user_id,
+                                                             orm_models.ChatMessages.id <= summarized_up_to))
+            db.commit()
+
+    def clear(self, user_id: str):
+        with database.Session_local() as db:
+            db.execute(delete(orm_models.ChatMessages).where(orm_models.ChatMessages.owner_email == user_id))
+            db.execute(delete(orm_models.ChatSummaries).where(orm_models.ChatSummaries.owner_email == user_id))
+            db.commit()
+
+
+class ChatHistoryStore:
+    """Chat histories of the users, at most max_messages messages per user and none older than max_age_seconds.
+
+    The histories are held in an in-process LRU hot cache, bounded by cache_max_bytes. With a backend, the backend
+    is the source of truth: every read loads the messages added since the cached ones (e.g. by another process),
+    an evicted history is loaded again. Without a backend, the cache is the only store (lost on eviction and restart).
+
+    With keep_turns > 0 (summary mode), the turns before the last keep_turns ones are folded into a running summary
+    once more than 2 * keep_turns turns are kept verbatim (see utils.summarize_chat_history, run after the responses),
+    the history is then the summary (as a system message) followed by the verbatim turns."""
+
+    def __init__(self, max_messages: int, max_age_seconds: float, cache_max_bytes: int,
+                 backend: PostgresChatHistoryBackend = None, keep_turns: int = 0):
+        self.max_messages = max_messages
+        self.keep_turns = keep_turns
+        self.max_age_seconds = max_age_seconds
+        self.cache_max_bytes = cache_max_bytes
+        self.backend = backend
+        self._entries: "OrderedDict[str, CachedHistory]" = OrderedDict()
+        self._cache_size = 0
+        self._next_id = 0 # ids of the messages of the memory backend
+        self._lock = threading.Lock()
+
+    def history(self, user_id: str) -> "UserChatHistory":
+        return UserChatHistory(self, user_id)
+
+    def _since(self) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(seconds=self.max_age_seconds)
+
+    def get_messages(self, user_id: str) -> List[BaseMessage]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            last_id = entry.last_id if entry is not None else 0
+        metrics.increment("chat_history_cache_hits" if entry is not None else "chat_history_cache_misses")
+
+        new_messages, summary = [], None
+        if self.backend is not None:
+            new_messages = self.backend.load(user_id, last_id, self._since(), self.max_messages)
+            if self.keep_turns > 0: # the summary may have been updated by another process
+                summary = self.backend.load_summary(user_id)
+
+        with self._lock:
+            entry = self._entries.get(user_id) or CachedHistory()
+            if summary is not None and summary[1] > entry.summarized_up_to:
+                entry.summary, entry.summarized_up_to = summary
+            new_messages = [stored for stored in new_messages if stored.id > entry.last_id] # loaded concurrently
+            self._update(user_id, entry, entry.messages + new_messages)
+            summary_messages = [SystemMessage(content=SUMMARY_PREFIX + entry.summary)] if entry.summary else []
+            return summary_messages + [stored.message for stored in entry.messages]
+
+    def pending_summary(self, user_id: str) -> Optional[Tuple[str, List[BaseMessage], int]]:
+        """The current summary, the messages to fold into it and the id of the last of them,
+        or None if the history is short enough (or the summary mode is off)."""
+        if self.keep_turns <= 0:
+            return None
+        self.get_messages(user_id) # loads the messages of the last turn
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            turn_starts = [index for index, stored in enumerate(entry.messages) if stored.message.type == "human"]
+            if len(turn_starts) <= 2 * self.keep_turns:
+                return None
+            folded_messages = entry.messages[:turn_starts[-self.keep_turns]]
+            return entry.summary, [stored.message for stored in folded_messages], folded_messages[-1].id
+
+    def set_summary(self, user_id: str, summary: str, summarized_up_to: int):
+        """Replaces the summary, the messages up to summarized_up_to are dropped."""
+        if self.backend is not None:
+            self.backend.save_summary(user_id, summary, summarized_up_to)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and summarized_up_to > entry.summarized_up_to:
+                entry.summary, entry.summarized_up_to = summary, summarized_up_to
+                self._update(user_id, entry, entry.messages)
+
+    def add_messages(self, user_id: str, messages: Sequence[BaseMessage]):
+        if self.backend is not None:
+            # the new messages are loaded (with their ids) by the next read
+            self.backend.add(user_id, messages, self._since(), self.max_messages)
+            return
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            entry = self._entries.get(user_id) or CachedHistory()
+            stored_messages = []
+            for message in messages:
+                self._next_id += 1
+                stored_messages.append(StoredMessage(id= self._next_id, created_at= now, message= message))
+            self._update(user_id, entry, entry.messages + stored_messages)
+
+    def clear(self, user_id: str):
+        if self.backend is not None:
+            self.backend.clear(user_id)
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._cache_size -= entry.size
+
+    def _update(self, user_id: str, entry: CachedHistory, messages: List[StoredMessage]):
+        """Sets the messages of a cached history (with the age and count limits), then evicts the least recently
+        used histories over the memory cap. Called with the lock held."""
+        since = self._since()
+        messages = [stored for stored in messages
+                    if stored.created_at >= since and stored.id > entry.summarized_up_to][-self.max_messages:]
+        if user_id in self._entries:
+            self._cache_size -= entry.size
+        entry.messages = messages
+        entry.last_id = max([entry.last_id] + [stored.id for stored in messages])
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        self._cache_size += entry.size
+        while self._cache_size > self.cache_max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False) # least recently used
+            self._cache_size -= evicted.size
+            metrics.increment("chat_history_cache_evictions")
+
+
+class UserChatHistory(BaseChatMessageHistory):
+    """The chat history of one user in a ChatHistoryStore, as used by RunnableWithMessageHistory."""
+
+    def __init__(self, store: ChatHistoryStore, user_id: str):
+        self.store = store
+        self.user_id = user_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.get_messages(self.user_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.add_messages(self.user_id, messages)
+
+    def clear(self) -> None:
+        self.store.clear(self.user_id)
+
+
+chat_history_store = ChatHistoryStore(
+    max_messages= settings.CHAT_HISTORY_MAX_MESSAGES,
+    max_age_seconds= settings.CHAT_HISTORY_MAX_AGE_HOURS * 3600,
+    cache_max_bytes= settings.CHAT_HISTORY_CACHE_MAX_BYTES,
+    backend= PostgresChatHistoryBackend() if settings.CHAT_HISTORY_BACKEND == "postgres" else None,
+    keep_turns= settings.CHAT_HISTORY_KEEP_TURNS
+)
@@ -0,0 +1,175 @@
+"""Per-user context of the coach (the goal and today's tasks of the user, rendered once into the
+user context system message of the chat prompt), cached so that a chat turn does not query the plans and preferences.
+
+The writers of plans and preferences (routers, scheduler) call invalidate / ainvalidate before committing:
+the entry is dropped in this process, and a NOTIFY on the coach_context channel (sent with the commit)
+makes the listener thread of every other process drop it too."""
+from collections import OrderedDict
+from dataclasses import dataclass
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from typing import Dict, Optional, Tuple
+from . import database, orm_models, utils
+from .config import settings
+from .metrics import metrics
+import json
+import logging
+import select as select_module
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "coach_context"
+
+def render_task(user_plans: orm_models.Plans, task_number: int) -> str:
+    """A task of the plan as text: title, time window, steps and tip."""
+    title = getattr(user_plans, f"task{task_number}_title")
+    start = getattr(user_plans, f"task{task_number}_timings_start")[:5]
+    end = getattr(user_plans, f"task{task_number}_timings_end")[:5]
+    content = getattr(user_plans, f"task{task_number}_content")
+    try:
+        steps = " ".join(f"{index}. {step}" for index, step in enumerate(json.loads(content).values(), start=1))
+    except (ValueError, AttributeError):
+        steps = content
+    return f"{title} ({start}-{end}): {steps} Tip: {getattr(user_plans, f'task{task_number}_tip')}"
+
+@dataclass(frozen=True)
+class CoachContext:
+    goal: str
+    user_context: str # the rendered user_context_chatbot
+
+def render_coach_context(user_plans: orm_models.Plans, user_preferences: orm_models.Preferences) -> CoachContext:
+    return CoachContext(goal= user_preferences.goal,
+                        user_context= utils.user_context_chatbot.format(goal= user_preferences.goal,
+                                                                         user_task1= render_task(user_plans, 1),
+                                                                         user_task2= render_task(user_plans, 2),
+                                                                         user_task3= render_task(user_plans, 3)))
+
+
+class CoachContextCache:
+    """LRU of the coach contexts of the users, with a TTL as a safety net for missed invalidations.
+
+    Every invalidation bumps the version of the user, a context loaded while the user's plan or preferences
+    were being written is not cached (it may be the old one)."""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, CoachContext]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, email: str) -> Tuple[Optional[CoachContext], int]:
+        """The cached context of the user (None if missing) and the version to pass to set."""
+        with self._lock:
+            version = self._versions.get(email, 0)
+            entry = self._entries.get(email)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[email]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(email)
+        metrics.increment("coach_context_hits" if entry is not None else "coach_context_misses")
+        return (entry[1] if entry is not None else None), version
+
+    def set(self, email: str, context: CoachContext, version: int):
+        with self._lock:
+            if self._versions.get(email, 0) != version: # invalidated while loading
+                return
+            self._entries[email] = (time.monotonic(), context)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_local(self, email: str):
+        with self._lock:
+            self._entries.pop(email, None)
+            self._versions[email] = self._versions.get(email, 0) + 1
+            if len(self._versions) > 2 * self.max_size: # the versions only matter while a load is in flight
+                self._versions = {email: self._versions[email]}
+        metrics.increment("coach_context_invalidations")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions = {email: version + 1 for email, version in self._versions.items()}
+
+
+coach_context_cache = CoachContextCache(max_size= settings.COACH_CONTEXT_CACHE_SIZE,
+                                        ttl_seconds= settings.COACH_CONTEXT_CACHE_TTL_SECONDS)
+
+async def get_coach_context(email: str) -> Optional[CoachContext]:
+    """The coach context of the user, None if the user has no plan or no preferences."""
+    context, version = coach_context_cache.get(email)
+    if context is not None:
+        return context
+    async with database.AsyncSession_local() as db:
+        user_plans = (await db.execute(
+            select(orm_models.Plans).where(orm_models.Plans.owner_email == email)
+        )).scalars().first()
+        user_preferences = (await db.execute(
+            select(orm_models.Preferences).where(orm_models.Preferences.owner_email == email)
+        )).scalars().first()
+    if user_plans is None or user_preferences is None:
+        return None
+    context = render_coach_context(user_plans, user_preferences)
+    coach_context_cache.set(email, context, version)
+    return context
+
+## invalidation ----------------------------------------------------------------------------------
+def notify_statement(email: str):
+    return select(func.pg_notify(NOTIFY_CHANNEL, email))
+
+def invalidate(email: str, db: Session):
+    """Drops the cached context of the user, in all the processes once db is committed."""
+    coach_context_cache.invalidate_local(email)
+    if settings.COACH_CONTEXT_NOTIFY:
+        db.execute(notify_statement(email))
+
+async def ainvalidate(email: str, db: AsyncSession):
+    coach_context_cache.invalidate_local(email)
+    if settings.COACH_CONTEXT_NOTIFY:
+        await db.execute(notify_statement(email))
+
+
+def listen_for_invalidations(stop_event: threading.Event):
+    """LISTENs on the coach_context channel (on a dedicated connection) and drops the notified contexts,
+    until stop_event is set. The whole cache is dropped on every (re)connection, notifications may have been missed."""
+    while not stop_event.is_set():
+        connection = None
+        try:
+            connection = database.engine.raw_connection()
+            connection.detach() # never returned to the pool, it is closed below
+            connection.dbapi_connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+            coach_context_cache.clear()
+            while not stop_event.is_set():
+                if select_module.select([connection.dbapi_connection], [], [], 1)[0]:
+                    connection.dbapi_connection.poll()
+                    while connection.dbapi_connection.notifies:
+                        coach_context_cache.invalidate_local(connection.dbapi_connection.notifies.pop(0).payload)
+        except Exception:
+            logger.exception("Coach context listener failed, reconnecting")
+            coach_context_cache.clear()
+            stop_event.wait(5)
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+listener_stop_event = threading.Event()
+
+def start_listener_thread() -> Optional[threading.Thread]:
+    if not settings.COACH_CONTEXT_NOTIFY:
+        return None
+    listener_stop_event.clear()
+    thread = threading.Thread(target=listen_for_invalidations, args=(listener_stop_event,), name="coach-context-listener", daemon=True)
+    thread.start()
+    return thread
+
+def stop_listener_thread():
+    listener_stop_event.set()
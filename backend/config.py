@@ -12,10 +12,109 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES : int
     COOKIE_SECRET : str
     COOKIE_PREFIX : str
-    OPENAI_API_KEY : str
+    OPENAI_API_KEY : str = "" # not needed with the fake and replay LLM providers
     GOOGLE_REDIRECT_URI: str
     FRONTEND_URL: str
     GOOGLE_CREDENTIALS_ENCRYPTION_KEY: str
+    
+    # daily plan generation (scheduler)
+    PLAN_GENERATION_CONCURRENCY: int = 8 # max number of plans generated in parallel
+    PLAN_GENERATION_TIMEOUT_SECONDS: float = 90 # per user timeout of a plan generation
+    PLAN_GENERATION_CHUNK_SIZE: int = 500 # users fetched from the database per chunk
+    PLAN_COHORT_DEDUP: bool = True # generate once for all users with identical preferences (without note) and feedback
+    PLAN_FEEDBACK_WINDOW_DAYS: int = 5 # days of feedback given as context of the plan generation
+    PLAN_FEEDBACK_TOKEN_BUDGET: int = 150 # max prompt tokens of the failed tasks, and of the successful tasks
+    PLAN_OUTPUT_MAX_REGENERATIONS: int = 1 # new LLM calls when a generated plan is invalid even after its local repair
+    # weekly mode: >1 generates the plans of that many days in one LLM call, the next days are stored and activated
+    # each morning without an LLM call (raise PLAN_LLM_DEADLINE_SECONDS and PLAN_GENERATION_TIMEOUT_SECONDS accordingly)
+    PLAN_DAYS_PER_GENERATION: int = 1
+    PLAN_DIVERGENCE_MAX_FAILURES: int = 3 # failed tasks since a batch of days was generated, after which it is generated again
+    
+    # cache of generated plans, keyed by the generation inputs
+    PLAN_CACHE_SIZE: int = 1024 # entries of the in-process LRU
+    PLAN_CACHE_TTL_SECONDS: float = 6 * 3600
+    PLAN_CACHE_BACKEND: str = "memory" # "memory", or "postgres" to share the cache between processes
+    
+    # plan generation job queue and workers
+    PLAN_JOB_MAX_ATTEMPTS: int = 3 # after that, a job is moved to the dead state
+    PLAN_JOB_BACKOFF_SECONDS: float = 60 # retry delay after the first failure, doubled for every further failure
+    PLAN_JOB_MAX_BACKOFF_SECONDS: float = 1800
+    PLAN_JOB_LEASE_SECONDS: float = 600 # a claimed job is given to another worker if not finished by then
+    PLAN_WORKER_POLL_SECONDS: float = 5 # how often an idle worker checks for new jobs
+    PLAN_WORKER_IN_APP: bool = True # also drain the queue on the event loop of every API process
+    PLAN_MAX_GENERATIONS_PER_MINUTE: int = 0 # cap over all workers, 0 means no cap
+    PLAN_JOB_CLAIM_LOCK_ID: int = 72650002 # postgres advisory lock key serializing the claims when capped
+    
+    # when the plans are generated
+    # "fixed": all plans at 6 AM Europe/Berlin
+    # "local": every user before their local morning, spread over the day in buckets
+    PLAN_SCHEDULE_MODE: str = "fixed"
+    PLAN_SCHEDULE_BUCKET_MINUTES: int = 15 # the scheduler enqueues the jobs of the next bucket (must divide 60)
+    PLAN_LOCAL_MORNING_HOUR: int = 6 # the plan must be ready at this local hour
+    PLAN_LEAD_MINUTES: int = 60 # generate at least this long before the local morning
+    PLAN_STAGGER_WINDOW_MINUTES: int = 120 # users are spread (by a hash of their email) over this window before the lead time
+    
+    # LLM provider: "openai", "fake" (local canned responses, for offline benchmarks),
+    # "record" (openai, saving the responses to LLM_CASSETTE_DIR) or "replay" (the recorded responses, offline)
+    LLM_PROVIDER: str = "openai"
+    LLM_CASSETTE_DIR: str = "cassettes"
+    FAKE_LLM_LATENCY_SECONDS: float = 0.5 # time to the first token of the fake and replay providers
+    FAKE_LLM_TOKENS_PER_SECOND: float = 50 # 0 answers at once
+    FAKE_LLM_PLAN_FILE: str = "" # JSON file of the plan answered by the fake provider, a built in plan by default
+    
+    # LLM routing: per use case, a primary and an optional (cheaper, faster) fallback model
+    # every call is bounded by the deadline, a tier which does not answer within its timeout falls back to the next one,
+    # and a duplicate (hedged) request is sent once a call takes longer than the p95 latency of its tier
+    PLAN_LLM_MODEL: str = "gpt-4o"
+    PLAN_LLM_FALLBACK_MODEL: str = "gpt-4o-mini" # empty to disable the fallback
+    PLAN_LLM_DEADLINE_SECONDS: float = 60 # total over all tiers
+    PLAN_LLM_TIER_TIMEOUT_SECONDS: float = 40
+    PLAN_LLM_HEDGE_AFTER_SECONDS: float = 20 # hedge threshold until enough latencies are recorded, 0 disables hedging
+    CHAT_LLM_MODEL: str = "gpt-4o"
+    CHAT_LLM_FALLBACK_MODEL: str = "gpt-4o-mini"
+    CHAT_LLM_DEADLINE_SECONDS: float = 60
+    CHAT_LLM_TIER_TIMEOUT_SECONDS: float = 10 # the chat is streamed, this bounds the time to the first token
+    CHAT_LLM_HEDGE_AFTER_SECONDS: float = 0 # streamed responses are not hedged
+    LLM_HEDGE_PERCENTILE: float = 0.95
+    LLM_HEDGE_MIN_SAMPLES: int = 20 # latencies recorded per tier before the percentile is used
+    LLM_LATENCY_WINDOW: int = 500 # latencies kept per tier for the percentile
+    PLAN_LLM_COMPLETION_TOKENS_ESTIMATE: int = 700 # added to the prompt tokens for the rate limiter
+    CHAT_LLM_COMPLETION_TOKENS_ESTIMATE: int = 400
+    
+    # rate limits of the LLM calls (per model, over all the processes with the postgres backend), 0 means no limit
+    # set them a bit below the limits of the OpenAI account, so that the calls wait instead of getting 429s
+    LLM_REQUESTS_PER_MINUTE: int = 0
+    LLM_TOKENS_PER_MINUTE: int = 0
+    LLM_RATE_LIMIT_BACKEND: str = "memory" # "memory" (per process), or "postgres" to share the limits between processes
+    LLM_RATE_LIMIT_INTERACTIVE_RESERVE: float = 0.2 # share of the limits only the requests of the users (not the scheduler) can use
+    
+    # chat history of the coach
+    CHAT_HISTORY_BACKEND: str = "postgres" # "postgres" (kept over restarts, shared by the processes) or "memory" (per process)
+    CHAT_HISTORY_MAX_MESSAGES: int = 20 # per user, the oldest messages are dropped
+    CHAT_HISTORY_MAX_AGE_HOURS: float = 7 * 24
+    CHAT_HISTORY_CACHE_MAX_BYTES: int = 32 * 1024 * 1024 # in-process LRU of the recent histories
+    # summary mode: >0 sends only the last turns verbatim, the older ones are folded into a running summary after the
+    # responses (once 2 * CHAT_HISTORY_KEEP_TURNS turns are kept), keep it below CHAT_HISTORY_MAX_MESSAGES / 4
+    CHAT_HISTORY_KEEP_TURNS: int = 0
+    
+    # rendered goal and tasks of the users for the coach prompt, dropped when the plan or the preferences are written
+    COACH_CONTEXT_CACHE_SIZE: int = 10000
+    COACH_CONTEXT_CACHE_TTL_SECONDS: float = 3600 # safety net for missed invalidations
+    COACH_CONTEXT_NOTIFY: bool = True # invalidate the other processes (LISTEN / NOTIFY), off for a single process
+    
+    # semantic cache of the coach answers, shared by the users with the same goal (in-process)
+    SEMANTIC_CACHE_ENABLED: bool = False
+    SEMANTIC_CACHE_THRESHOLD: float = 0.9 # min cosine similarity of the questions
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 5000
+    SEMANTIC_CACHE_TTL_SECONDS: float = 24 * 3600
+    SEMANTIC_CACHE_MIN_WORDS: int = 4 # shorter questions are mostly follow-ups of the conversation
+    
+    # coach generations at once per user (POST /coach and /coach/ws), the next ones are rejected
+    COACH_MAX_CONCURRENT_GENERATIONS_PER_USER: int = 1
+    
+    # only one process (the leader) runs the scheduled jobs
+    SCHEDULER_LEADER_LOCK_ID: int = 72650001 # postgres advisory lock key
+    SCHEDULER_LEADER_ELECTION_INTERVAL_SECONDS: int = 30 # how often followers try to take over
 
     class Config:
         env_file = ".env"
@@ -1,5 +1,6 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from .config import settings
 
@@ -8,6 +9,11 @@ DATABASE_URL = f"postgresql://{settings.DATABASE_USERNAME}:{settings.DATABASE_PA
 engine = create_engine(DATABASE_URL)
 Session_local = sessionmaker(bind= engine, autoflush= False)
 
+# async engine for the endpoints waiting on long LLM calls, so that they do not hold a threadpool thread
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{settings.DATABASE_USERNAME}:{settings.DATABASE_PASSWORD}@{settings.DATABASE_IP}:{settings.DATABASE_PORT}/{settings.DATABASE_NAME}"
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+AsyncSession_local = async_sessionmaker(bind= async_engine, autoflush= False, expire_on_commit= False)
+
 Base = declarative_base()
 
 def get_db():
@@ -16,3 +22,7 @@ def get_db():
         yield db #yields the database session and pauses also closes the session on next call
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSession_local() as db: # closes the session after the request
+        yield db
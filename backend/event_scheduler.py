@@ -1,65 +1,309 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import pytz
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.orm import Session
-from . import orm_models, database
-import requests
+from . import orm_models, database, schemas
+from .config import settings
+from .leader_election import LeaderElection
+from .metrics import metrics
+from .single_flight import plan_generations
 from datetime import datetime, date, timedelta
-import json
-from . import utils
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+import asyncio
+import copy
+import functools
+import logging
+import time
+from . import utils, job_queue, plan_cache, coach_context
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PlanGenerationJob:
+    """Everything needed to generate the plan of one user."""
+    email: str
+    plan_id: int
+    preferences: schemas.Preferences
+    list_of_task_failures: List[str] = field(default_factory=list)
+    list_of_task_successes: List[str] = field(default_factory=list)
+
+@dataclass
+class PlanGenerationReport:
+    """Summary of one plan generation run."""
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    cohort_hits: int = 0 # plans reused from another user with the same preferences and feedback
+    wall_time: float = 0.0
+
+    @property
+    def cohort_hit_rate(self) -> float:
+        return self.cohort_hits / self.total if self.total else 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Generated plans per second."""
+        return self.succeeded / self.wall_time if self.wall_time else 0.0
+
+
+def cohort_fingerprint(job: PlanGenerationJob) -> Optional[str]:
+    """Fingerprint of the normalized generation inputs of a user. Users with the same fingerprint
+    get the same plan (up to the timings), so it is generated only once per cohort.
+    Users with a note are never grouped, since the note is free text."""
+
+    if job.preferences.note and job.preferences.note.strip():
+        return None
+    return plan_cache.plan_inputs_key(job.preferences, job.list_of_task_failures, job.list_of_task_successes)
+
+async def generate_plans(jobs: Iterable[PlanGenerationJob],
+                         on_plan_generated: Callable[[PlanGenerationJob, dict], None],
+                         on_plan_failed: Callable[[PlanGenerationJob, Exception], None] = None,
+                         concurrency: int = settings.PLAN_GENERATION_CONCURRENCY,
+                         timeout: float = settings.PLAN_GENERATION_TIMEOUT_SECONDS,
+                         cohorts: Dict[str, asyncio.Future] = None,
+                         days: int = 1) -> PlanGenerationReport:
+    """Generates the plans of all the jobs concurrently, with at most `concurrency` LLM calls in flight.
+    Every call is bounded by `timeout` seconds, and a failing or slow user never aborts the rest of the run.
+    on_plan_generated is called (in the event loop) with every successfully generated plan,
+    on_plan_failed with the error of every failed or timed out job.
+    jobs is consumed lazily, so it can be a generator streaming the users from the database.
+    If a cohorts dict is passed, users with the same cohort_fingerprint share one LLM call: the dict maps
+    the fingerprints to the generations, and can be kept over several runs (of the same day).
+    With days > 1, the plans of that many days are generated in one call per user (weekly mode),
+    and on_plan_generated is called with the list of the plans (today's first)."""
+
+    report = PlanGenerationReport()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    start = time.perf_counter()
+
+    async def generate(job: PlanGenerationJob, not_before: datetime) -> dict:
+        if days > 1:
+            return await asyncio.wait_for(
+                plan_generations.do(f"{job.email}:days:{days}", lambda: utils.aget_plans_for_days(job.preferences, days,
+                                                                                                  list_of_task_failures= job.list_of_task_failures,
+                                                                                                  list_of_task_successes= job.list_of_task_successes,
+                                                                                                  not_before= not_before)),
+                timeout= timeout)
+        # a generation of the user's plan already in flight in this process (e.g. a request of the user) is shared
+        return await asyncio.wait_for(
+            plan_generations.do(job.email, lambda: utils.aget_todays_plan(job.preferences,
+                                                                         list_of_task_failures= job.list_of_task_failures,
+                                                                         list_of_task_successes= job.list_of_task_successes,
+                                                                         not_before= not_before,
+                                                                         bypass_cache= True)), # every day gets a fresh plan
+            timeout= timeout)
+
+    async def generate_for_cohort(job: PlanGenerationJob, not_before: datetime) -> dict:
+        fingerprint = cohort_fingerprint(job)
+        if fingerprint is None:
+            return await generate(job, not_before)
+        metrics.increment("plan_cohort_jobs") # the hit rate is plan_cohort_hits / plan_cohort_jobs
+
+        cohort_plan = cohorts.get(fingerprint)
+        is_cohort_hit = cohort_plan is not None
+        if not is_cohort_hit:
+            cohort_plan = cohorts[fingerprint] = asyncio.ensure_future(generate(job, not_before))
+        try:
+            generated_plan = await asyncio.shield(cohort_plan)
+        except Exception:
+            if cohorts.get(fingerprint) is cohort_plan:
+                del cohorts[fingerprint] # the next member of the cohort tries again
+            raise
+        # every member gets its own copy, with the timings (of today's plan) moved after its own time constraint
+        generated_plan = copy.deepcopy(generated_plan)
+        try:
+            if days > 1:
+                generated_plan[0] = utils.shift_plan_after(generated_plan[0], not_before)
+            else:
+                generated_plan = utils.shift_plan_after(generated_plan, not_before)
+        except utils.PlanDoesNotFit:
+            if not is_cohort_hit: # generated for this member's not_before, nothing better to get
+                return copy.deepcopy(cohort_plan.result())
+            logger.info("Cohort plan does not fit after %s for %s, generating its own", not_before.strftime("%H:%M"), job.email)
+            return await generate(job, not_before)
+        if is_cohort_hit:
+            report.cohort_hits += 1
+            metrics.increment("plan_cohort_hits")
+            metrics.increment("plan_cohort_llm_calls_saved") # the call of the member, shared with the first one
+        return generated_plan
+
+    async def run_job(job: PlanGenerationJob):
+        try:
+            not_before = datetime.now(pytz.timezone(job.preferences.timezone))
+            if cohorts is None:
+                generated_plan = await generate(job, not_before)
+            else:
+                generated_plan = await generate_for_cohort(job, not_before)
+            on_plan_generated(job, generated_plan)
+            report.succeeded += 1
+        except asyncio.TimeoutError as e:
+            report.timed_out += 1
+            logger.warning("Plan generation for %s timed out after %ss", job.email, timeout)
+            if on_plan_failed:
+                on_plan_failed(job, e)
+        except Exception as e:
+            report.failed += 1
+            logger.exception("Plan generation for %s failed", job.email)
+            if on_plan_failed:
+                on_plan_failed(job, e)
+        finally:
+            semaphore.release()
+
+    running = set()
+    for job in jobs:
+        await semaphore.acquire() # wait for a free slot before taking the next user
+        report.total += 1
+        task = asyncio.create_task(run_job(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    await asyncio.gather(*running)
+
+    report.wall_time = time.perf_counter() - start
+    # one batch of a worker, the totals of a scheduled run are job_queue.run_summary
+    logger.info("Plan generation batch finished: %d/%d plans generated (%d failed, %d timed out) in %.1fs, %.2f plans/s, "
+                "cohort hit rate %.0f%% (%d LLM calls saved)",
+                report.succeeded, report.total, report.failed, report.timed_out, report.wall_time, report.throughput,
+                100 * report.cohort_hit_rate, report.cohort_hits)
+    return report
+
+
+def iter_plan_generation_jobs(db: Session, 
+                              emails: List[str] = None, 
+                              chunk_size: int = settings.PLAN_GENERATION_CHUNK_SIZE) -> Iterator[PlanGenerationJob]:
+    """Streams the users (all, or only the given emails) that have both preferences and a plan, 
+    together with their plan id and the task titles they failed and succeeded in the feedback window.
+    Everything is loaded by a single query (feedback lists are aggregated with array_agg) and fetched
+    from a server side cursor in chunks of chunk_size rows."""
+
+    # the feedback history is also a context, which tells which kind of activities the user succeeded in doing and which they failed
+    end_date = date.today()
+    start_date = end_date - timedelta(days=settings.PLAN_FEEDBACK_WINDOW_DAYS - 1) # the feedback window is also given as input for plan update
+
+    def aggregated_titles(column):
+        # one row per task title, aggregated back to one list per user (in order of the feedback date)
+        titles = (
+            select(orm_models.Feedback.owner_email.label("owner_email"),
+                   orm_models.Feedback.date.label("date"),
+                   func.unnest(column).label("title"))
+            .where(orm_models.Feedback.date >= start_date, orm_models.Feedback.date <= end_date)
+        )
+        if emails is not None: # postgres does not push the filter of the outer query through the group by
+            titles = titles.where(orm_models.Feedback.owner_email.in_(emails))
+        titles = titles.subquery()
+        return (
+            select(titles.c.owner_email,
+                   func.array_agg(aggregate_order_by(titles.c.title, titles.c.date)).label("titles"))
+            .group_by(titles.c.owner_email)
+            .subquery()
+        )
+
+    failures = aggregated_titles(orm_models.Feedback.list_of_task_failures)
+    successes = aggregated_titles(orm_models.Feedback.list_of_task_successes)
+
+    # inner joins filter out the users without preferences or plans
+    query = (
+        select(orm_models.Users.email,
+               orm_models.Plans.id.label("plan_id"),
+               orm_models.Preferences.goal,
+               orm_models.Preferences.lifestyle,
+               orm_models.Preferences.preferred_timings,
+               orm_models.Preferences.note,
+               orm_models.Preferences.timezone,
+               failures.c.titles.label("list_of_task_failures"),
+               successes.c.titles.label("list_of_task_successes"))
+        .join(orm_models.Preferences, orm_models.Preferences.owner_email == orm_models.Users.email)
+        .join(orm_models.Plans, orm_models.Plans.owner_email == orm_models.Users.email)
+        .outerjoin(failures, failures.c.owner_email == orm_models.Users.email)
+        .outerjoin(successes, successes.c.owner_email == orm_models.Users.email)
+        .distinct(orm_models.Users.email) # one row per user, like the .first() lookups in the routers
+        .order_by(orm_models.Users.email, orm_models.Preferences.id, orm_models.Plans.id)
+    )
+    if emails is not None:
+        query = query.where(orm_models.Users.email.in_(emails))
+
+    result = db.execute(query, execution_options={"yield_per": chunk_size})
+    for chunk in result.partitions():
+        for row in chunk:
+            yield PlanGenerationJob(
+                email= row.email,
+                plan_id= row.plan_id,
+                preferences= schemas.Preferences(goal= row.goal,
+                                                 lifestyle= row.lifestyle,
+                                                 preferred_timings= row.preferred_timings,
+                                                 note= row.note,
+                                                 timezone= row.timezone),
+                list_of_task_failures= row.list_of_task_failures or [],
+                list_of_task_successes= row.list_of_task_successes or []
+            )
+
+
+def save_generated_plan(db: Session, job: PlanGenerationJob, generated_plan: dict):
+    """Validates a generated plan and writes it to the plan of the user."""
+    try:
+        validated_plan = schemas.Plans(**utils.serialize_plan_content(generated_plan))
+        db.query(orm_models.Plans).filter_by(id=job.plan_id).update(validated_plan.dict(), synchronize_session=False)
+        coach_context.invalidate(job.email, db)
+        db.commit()
+    except Exception:
+        db.rollback() # keep the session usable for the remaining users
+        raise
 
 def call_update_plans():
-    # Call your FastAPI update endpoint (assuming it’s authenticated with a token)
+    """Enqueues today's plan generation job of every user which has preferences and an existing plan.
+    The jobs are executed by the plan workers (see plan_worker.py)."""
+
     db: Session = next(database.get_db())
-    users = db.query(orm_models.Users).all()
-
-    for user in users:
-        preferences = db.query(orm_models.Preferences).filter_by(owner_email=user.email).first()
-        if not preferences:
-            continue # If no preferences, skip to the next user
-
-        plan_query = db.query(orm_models.Plans).filter_by(owner_email=user.email)
-        if not plan_query.first():
-            continue # If no plan exists, skip to the next user
-
-        # Modify preferred_timings as you do in your existing endpoint
-        preferred_timings_list = preferences.preferred_timings
-        preferred_timings_list.insert(0, f"Hard constraint (even if the next elements in this list conflicts with this constraint, you must obey hard this constraint) : The suggested plan must take place after {datetime.now().strftime("%H hrs %M mins")}")
-        preferences.preferred_timings = preferred_timings_list
-
-
-        # the feedback history is also a context, which tells which kind of activities the user succeeded in doing and which they failed
-        end_date = date.today()
-        start_date = end_date - timedelta(days=4) # last 5 days feedback window is also given as input for plan update
-        list_of_task_failures = []
-        list_of_task_successes = []
-        
-        feedback_history = db.query(orm_models.Feedback).filter(
-            orm_models.Feedback.owner_email == user.email,
-            orm_models.Feedback.date >= start_date,
-            orm_models.Feedback.date <= end_date,
-            ).all()
-        
-        for feedback in feedback_history:
-            list_of_task_failures.extend(feedback.list_of_task_failures)
-            list_of_task_successes.extend(feedback.list_of_task_successes)
-
-
-        generated_plan = utils.get_todays_plan(preferences,
-                                           list_of_task_failures= list_of_task_failures,
-                                           list_of_task_successes= list_of_task_successes)
-        
-        generated_plan["task1_content"] = json.dumps(generated_plan["task1_content"])
-        generated_plan["task2_content"] = json.dumps(generated_plan["task2_content"])
-        generated_plan["task3_content"] = json.dumps(generated_plan["task3_content"])
-
-        plan_query.update(generated_plan, synchronize_session=False)
-        db.commit()
+    try:
+        enqueued = job_queue.enqueue_plan_jobs(db)
+        logger.info("Enqueued %d plan generation jobs", enqueued)
+    finally:
+        db.close()
+
+def enqueue_local_morning_plans():
+    """Enqueues the plan generation jobs of the users whose local generation time falls into the next bucket.
+    Used in the "local" schedule mode, where the scheduler runs every PLAN_SCHEDULE_BUCKET_MINUTES."""
+
+    db: Session = next(database.get_db())
+    try:
+        enqueued = job_queue.enqueue_local_morning_plan_jobs(db, bucket_minutes= settings.PLAN_SCHEDULE_BUCKET_MINUTES)
+        logger.info("Enqueued %d plan generation jobs for the next %d minutes", enqueued, settings.PLAN_SCHEDULE_BUCKET_MINUTES)
+    finally:
+        db.close()
+
+## every process starts the scheduler, but only the leader runs the scheduled jobs
+leader = LeaderElection(database.engine, settings.SCHEDULER_LEADER_LOCK_ID)
+scheduler = BackgroundScheduler()
+
+def run_if_leader(job: Callable[[], None]) -> Callable[[], None]:
+    """Wraps a scheduled job, so that it is executed only by the leader process."""
+    @functools.wraps(job)
+    def wrapper():
+        if not leader.try_acquire():
+            logger.info("Skipping %s, another process is the scheduler leader", job.__name__)
+            return
+        job()
+    return wrapper
 
 def start_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(call_update_plans, 
-                      CronTrigger(hour=6, minute=0, timezone=pytz.timezone("Europe/Berlin")),
-                      id="daily_plan_generation")  # Every day at 6 AM update plans
+    leader.try_acquire()
+    scheduler.add_job(leader.try_acquire,
+                      IntervalTrigger(seconds=settings.SCHEDULER_LEADER_ELECTION_INTERVAL_SECONDS),
+                      id="leader_election")  # followers take over if the leader dies
+    if settings.PLAN_SCHEDULE_MODE == "local":
+        scheduler.add_job(run_if_leader(enqueue_local_morning_plans),
+                          CronTrigger(minute=f"*/{settings.PLAN_SCHEDULE_BUCKET_MINUTES}"),
+                          id="daily_plan_generation")  # every bucket, enqueue the users whose local morning is coming up
+    else:
+        scheduler.add_job(run_if_leader(call_update_plans),
+                          CronTrigger(hour=6, minute=0, timezone=pytz.timezone("Europe/Berlin")),
+                          id="daily_plan_generation")  # Every day at 6 AM update plans
     scheduler.start()
 
+def stop_scheduler():
+    scheduler.shutdown(wait=False)
+    leader.release()
@@ -1,14 +1,17 @@
 from fastapi import FastAPI, status, HTTPException, Depends
 from .routers import auth, preferences, plans, coach, calendar
-from . import orm_models, database, schemas, oauth2, event_scheduler
+from . import orm_models, database, schemas, oauth2, event_scheduler, plan_worker, coach_context, job_queue
+from .metrics import metrics
+from .config import settings
 from typing import Annotated, List
+from datetime import date
 from sqlalchemy.orm import Session
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
-orm_models.Base.metadata.create_all(database.engine)
+orm_models.create_tables(database.engine)
 app = FastAPI()
 
 app.add_middleware(
@@ -38,6 +41,16 @@ def get_all_users(db: Session = Depends(database.get_db)):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No users found!")
     return users
 
+@app.get("/metrics", status_code=status.HTTP_200_OK)
+def get_metrics():
+    """Gets the in-process metrics (cache hits, ...) of the backend, this is used by admin"""
+    return metrics.snapshot()
+
+@app.get("/metrics/plan_runs/{run_date}", status_code=status.HTTP_200_OK)
+def get_plan_run(run_date: date, db: Session = Depends(database.get_db)):
+    """Gets the totals (jobs, wall time, plans/s) of the plan generation run of a day over all the workers, this is used by admin"""
+    return job_queue.run_summary(db, run_date)
+
 @app.post("/user_ratings_comments", status_code=status.HTTP_201_CREATED)
 def post_user_ratings_comments(
     current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user)],
@@ -55,7 +68,19 @@ def post_user_ratings_comments(
     return {"message": "Ratings and comments posted successfully!"}
 
 @app.on_event("startup")
-def on_startup():
-    """Starts the background scheduler to update the plans every day at 6 AM"""
+async def on_startup():
+    """Starts the background scheduler to update the plans every day at 6 AM,
+    and a plan worker generating the enqueued plans (unless the workers run as separate processes),
+    and the listener of the coach context invalidations"""
     event_scheduler.start_scheduler()
+    coach_context.start_listener_thread()
+    if settings.PLAN_WORKER_IN_APP:
+        plan_worker.start_worker_task() # on the event loop of the app
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Stops the scheduler and hands over the scheduler leadership to another process"""
+    event_scheduler.stop_scheduler()
+    await plan_worker.stop_worker_task()
+    coach_context.stop_listener_thread()
     
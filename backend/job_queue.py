@@ -0,0 +1,192 @@
+from sqlalchemy import inspect, select, update, case, literal, or_, and_, func, cast, values, column, true, Date, DateTime, Integer
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta, timezone
+from typing import List
+from . import orm_models
+from .config import settings
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+## job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead" # failed too often, not retried anymore
+
+def enqueue_plan_jobs(db: Session, run_date: date = None) -> int:
+    """Enqueues a plan generation job for every user with preferences and a plan.
+    Users which already have a job for run_date are skipped, so enqueueing twice is harmless.
+    Returns the number of new jobs."""
+
+    run_date = run_date or date.today()
+    eligible_users = (
+        select(orm_models.Users.email, literal(run_date, Date))
+        .join(orm_models.Preferences, orm_models.Preferences.owner_email == orm_models.Users.email)
+        .join(orm_models.Plans, orm_models.Plans.owner_email == orm_models.Users.email)
+        .distinct()
+    )
+    statement = (
+        insert(orm_models.PlanJobs)
+        .from_select(["owner_email", "run_date"], eligible_users)
+        .on_conflict_do_nothing(index_elements=["owner_email", "run_date"])
+    )
+    result = db.execute(statement)
+    db.commit()
+    return result.rowcount
+
+def enqueue_local_morning_plan_jobs(db: Session, bucket_minutes: int, now: datetime = None) -> int:
+    """Enqueues the jobs of the users whose generation time falls before the end of the current bucket.
+
+    The generation time of a user is their next local morning (PLAN_LOCAL_MORNING_HOUR in their timezone),
+    minus PLAN_LEAD_MINUTES, minus a per user offset in [0, PLAN_STAGGER_WINDOW_MINUTES) derived from a hash of the email.
+    So the users of one timezone are spread evenly over the stagger window, and the job of every user
+    becomes claimable (run_after) exactly at their generation time.
+    Generation times up to PLAN_LEAD_MINUTES in the past are still enqueued, so that a missed bucket
+    (e.g. during a leader failover) is caught up before the users' morning. Returns the number of new jobs."""
+
+    now = now or datetime.now(timezone.utc)
+    bucket_start = now.replace(minute=now.minute - now.minute % bucket_minutes, second=0, microsecond=0)
+    bucket_end = bucket_start + timedelta(minutes=bucket_minutes)
+    earliest = now - timedelta(minutes=settings.PLAN_LEAD_MINUTES)
+
+    user_timezone = orm_models.Preferences.timezone
+    day_offset = values(column("day", Integer), name="day_offsets").data([(0,), (1,)]) # today's and tomorrow's morning
+    local_date = cast(func.timezone(user_timezone, literal(now, DateTime(timezone=True))), Date) + day_offset.c.day
+    local_morning = local_date + func.make_time(settings.PLAN_LOCAL_MORNING_HOUR, 0, 0)
+    stagger = func.abs(func.hashtext(orm_models.Users.email)) % max(1, settings.PLAN_STAGGER_WINDOW_MINUTES)
+    generation_time = (func.timezone(user_timezone, local_morning)
+                       - func.make_interval(0, 0, 0, 0, 0, settings.PLAN_LEAD_MINUTES + stagger))
+
+    schedule = (
+        select(orm_models.Users.email.label("owner_email"),
+               local_date.label("run_date"),
+               generation_time.label("run_after"))
+        .join(orm_models.Preferences, orm_models.Preferences.owner_email == orm_models.Users.email)
+        .join(orm_models.Plans, orm_models.Plans.owner_email == orm_models.Users.email)
+        .join(day_offset, true())
+        .distinct()
+        .subquery()
+    )
+    due_users = (
+        select(schedule.c.owner_email, schedule.c.run_date, schedule.c.run_after)
+        .where(schedule.c.run_after >= earliest, schedule.c.run_after < bucket_end)
+    )
+    statement = (
+        insert(orm_models.PlanJobs)
+        .from_select(["owner_email", "run_date", "run_after"], due_users)
+        .on_conflict_do_nothing(index_elements=["owner_email", "run_date"])
+    )
+    result = db.execute(statement)
+    db.commit()
+    return result.rowcount
+
+def claim_jobs(db: Session, worker_id: str, limit: int, lease_seconds: float = settings.PLAN_JOB_LEASE_SECONDS) -> List[orm_models.PlanJobs]:
+    """Claims up to limit due jobs for worker_id, leasing them for lease_seconds.
+    Jobs whose lease expired (the worker crashed) are claimed again.
+    Rows locked by other workers are skipped (FOR UPDATE SKIP LOCKED), so any number of workers can drain the queue.
+    If PLAN_MAX_GENERATIONS_PER_MINUTE is set, at most that many jobs are claimed per minute over all workers."""
+
+    now = datetime.now(timezone.utc)
+    if settings.PLAN_MAX_GENERATIONS_PER_MINUTE > 0:
+        # claims are serialized by a transaction level advisory lock, so that concurrent workers see each other's claims
+        db.execute(select(func.pg_advisory_xact_lock(settings.PLAN_JOB_CLAIM_LOCK_ID)))
+        claimed_last_minute = db.execute(
+            select(func.count())
+            .select_from(orm_models.PlanJobs)
+            .where(orm_models.PlanJobs.claimed_at > now - timedelta(minutes=1))
+        ).scalar()
+        limit = min(limit, settings.PLAN_MAX_GENERATIONS_PER_MINUTE - claimed_last_minute)
+        if limit <= 0:
+            db.commit()
+            return []
+
+    due_jobs = db.execute(
+        select(orm_models.PlanJobs)
+        .where(or_(
+            and_(orm_models.PlanJobs.status == PENDING, orm_models.PlanJobs.run_after <= now),
+            and_(orm_models.PlanJobs.status == RUNNING, orm_models.PlanJobs.locked_until < now),
+        ))
+        .order_by(orm_models.PlanJobs.run_after)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    claimed_jobs = []
+    for job in due_jobs:
+        if job.attempts >= settings.PLAN_JOB_MAX_ATTEMPTS: # the lease of the last attempt expired
+            job.status = DEAD
+            job.locked_by = None
+            job.locked_until = None
+            job.last_error = job.last_error or "Lease expired"
+            continue
+        job.status = RUNNING
+        job.attempts += 1
+        job.locked_by = worker_id
+        job.locked_until = now + timedelta(seconds=lease_seconds)
+        job.claimed_at = now
+        claimed_jobs.append(job)
+    db.commit()
+    return claimed_jobs
+
+def finish_claimed_job(db: Session, job: orm_models.PlanJobs, worker_id: str, **values) -> bool:
+    """Updates a job only if worker_id still holds it: a worker whose lease expired (and whose job was claimed
+    again) must not overwrite the state given by the new owner. Returns False (nothing written) if the job was lost."""
+    result = db.execute(
+        update(orm_models.PlanJobs)
+        .where(orm_models.PlanJobs.id == inspect(job).identity[0], # without loading the (expired) row again
+               orm_models.PlanJobs.status == RUNNING,
+               orm_models.PlanJobs.locked_by == worker_id)
+        .values(locked_by=None, locked_until=None, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    if result.rowcount == 0:
+        metrics.increment("plan_jobs_lease_lost")
+        logger.warning("Plan job %s was claimed again by another worker, %s leaves it", inspect(job).identity[0], worker_id)
+        return False
+    return True
+
+def complete_job(db: Session, job: orm_models.PlanJobs, worker_id: str) -> bool:
+    """Marks a job claimed by worker_id as done."""
+    return finish_claimed_job(db, job, worker_id, status=DONE, last_error=None)
+
+def fail_job(db: Session, job: orm_models.PlanJobs, worker_id: str, error: str) -> bool:
+    """Schedules a retry of a failed job claimed by worker_id with exponential backoff,
+    or moves it to the dead state once it has failed PLAN_JOB_MAX_ATTEMPTS times.
+    The attempts are read in the update, the job object may hold the ones of another claim."""
+    attempts = orm_models.PlanJobs.attempts
+    is_last_attempt = attempts >= settings.PLAN_JOB_MAX_ATTEMPTS
+    backoff = func.least(settings.PLAN_JOB_BACKOFF_SECONDS * func.power(2, attempts - 1), settings.PLAN_JOB_MAX_BACKOFF_SECONDS)
+    return finish_claimed_job(db, job, worker_id, last_error=error,
+                              status=case((is_last_attempt, DEAD), else_=PENDING),
+                              run_after=case((is_last_attempt, orm_models.PlanJobs.run_after),
+                                             else_=func.now() + func.make_interval(0, 0, 0, 0, 0, 0, backoff)))
+
+def run_summary(db: Session, run_date: date) -> dict:
+    """Totals of the plan generation run of run_date, over all the batches and workers: the jobs per state,
+    the wall time from the first claim to the last finished job, and the generated plans per second.
+    (claimed_at is the last claim of a job, so the start is later than the first claim if the first jobs were retried.)"""
+
+    finished = orm_models.PlanJobs.status.in_([DONE, DEAD])
+    row = db.execute(
+        select(func.count().label("total"),
+               func.count().filter(orm_models.PlanJobs.status == DONE).label("done"),
+               func.count().filter(orm_models.PlanJobs.status == DEAD).label("dead"),
+               func.count().filter(orm_models.PlanJobs.status == PENDING).label("pending"),
+               func.count().filter(orm_models.PlanJobs.status == RUNNING).label("running"),
+               func.min(orm_models.PlanJobs.claimed_at).label("started_at"),
+               func.max(orm_models.PlanJobs.updated_at).filter(finished).label("finished_at"))
+        .where(orm_models.PlanJobs.run_date == run_date)
+    ).one()
+    wall_time = (row.finished_at - row.started_at).total_seconds() if row.started_at and row.finished_at else 0.0
+    return {
+        "run_date": run_date.isoformat(),
+        "jobs": {"total": row.total, "done": row.done, "dead": row.dead, "pending": row.pending, "running": row.running},
+        "started_at": row.started_at.isoformat() if row.started_at else None,
+        "finished_at": row.finished_at.isoformat() if row.finished_at else None,
+        "wall_time_seconds": round(wall_time, 3),
+        "plans_per_second": round(row.done / wall_time, 3) if wall_time > 0 else 0.0,
+    }
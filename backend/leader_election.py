@@ -0,0 +1,71 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Engine, Connection
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class LeaderElection:
+    """Leader election between processes sharing the same postgres database.
+
+    The leader is the process holding a session level advisory lock (pg_try_advisory_lock) on a
+    dedicated connection. The lock lives as long as that connection, so if the leader dies
+    postgres releases it and the next follower calling try_acquire takes over."""
+
+    def __init__(self, engine: Engine, lock_id: int):
+        self.engine = engine
+        self.lock_id = lock_id
+        self._connection: Connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._connection is not None
+
+    def try_acquire(self) -> bool:
+        """Becomes the leader if no other process is, and checks that the leadership is still held otherwise.
+        Returns whether this process is the leader."""
+        with self._lock:
+            if self._connection is not None:
+                try:
+                    self._connection.execute(text("SELECT 1")) # heartbeat, the lock is gone with the connection
+                    return True
+                except Exception:
+                    logger.warning("Lost the connection holding the leader lock %s", self.lock_id)
+                    self._close()
+
+            connection = None
+            try:
+                # autocommit, so that the connection holding the lock is not left idle in a transaction
+                connection = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+                acquired = connection.execute(text("SELECT pg_try_advisory_lock(:lock_id)"), {"lock_id": self.lock_id}).scalar()
+            except Exception:
+                logger.exception("Leader election for lock %s failed", self.lock_id)
+                acquired = False
+
+            if acquired:
+                self._connection = connection
+                logger.info("This process is now the leader for lock %s", self.lock_id)
+            elif connection is not None:
+                connection.close()
+            return self.is_leader
+
+    def release(self):
+        """Gives up the leadership, so that another process can take over right away."""
+        with self._lock:
+            if self._connection is None:
+                return
+            try:
+                self._connection.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": self.lock_id})
+            except Exception:
+                pass # the lock is released with the connection anyway
+            self._close()
+
+    def _close(self):
+        try:
+            # invalidate instead of returning the connection to the pool, a lock must never stay on a pooled connection
+            self._connection.invalidate()
+            self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
@@ -0,0 +1,243 @@
+"""Chat model providers, selected with LLM_PROVIDER:
+
+- "openai": the OpenAI models (needs OPENAI_API_KEY)
+- "fake": a local deterministic model answering a canned plan / chat response, with a configurable
+  latency and tokens per second, to benchmark the whole stack offline
+- "record": the OpenAI models, every response is also saved to a cassette file in LLM_CASSETTE_DIR
+- "replay": answers the recorded responses (same prompt up to the chat history and the times of the day,
+  same response format) without any network access,
+  with the latency and tokens per second of the fake model
+"""
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional
+from .chat_history import SUMMARY_PREFIX
+from .config import settings
+import asyncio
+import hashlib
+import json
+import re
+import time
+
+# canned plan of the fake model (FAKE_LLM_PLAN_FILE overrides it), valid for schemas.GeneratedPlan
+DEFAULT_FAKE_PLAN = {
+    "task1_title": "Morning Mobility Flow",
+    "task1_content": {
+        "step_1": "Start with 2 minutes of neck rolls and shoulder circles.",
+        "step_2": "Move through cat-cow, hip circles and leg swings for 10 minutes.",
+        "step_3": "Finish with 3 minutes of deep breathing."
+    },
+    "task1_timings_start": "07:00:00",
+    "task1_timings_end": "07:20:00",
+    "task1_tip": "Open a window, fresh air makes the flow feel twice as energizing.",
+
+    "task2_title": "Lunchtime Brisk Walk",
+    "task2_content": {
+        "step_1": "Warm up with 3 minutes of easy walking.",
+        "step_2": "Walk briskly for 20 minutes, keeping a pace where talking is hard.",
+        "step_3": "Cool down with 5 minutes of slow walking and calf stretches."
+    },
+    "task2_timings_start": "12:30:00",
+    "task2_timings_end": "13:00:00",
+    "task2_tip": "Pick a new route every day to keep the walk interesting.",
+
+    "task3_title": "Evening Bodyweight Circuit",
+    "task3_content": {
+        "step_1": "Do 3 rounds of 12 squats, 10 push-ups and 30 seconds of plank.",
+        "step_2": "Rest 60 seconds between the rounds.",
+        "step_3": "Stretch your legs, chest and lower back for 5 minutes."
+    },
+    "task3_timings_start": "18:30:00",
+    "task3_timings_end": "19:00:00",
+    "task3_tip": "Track your reps, beating yesterday's number is a great motivator."
+}
+
+DEFAULT_FAKE_CHAT_RESPONSE = """### 💪 Great question!
+
+- **Stay consistent**: small daily habits beat occasional hard sessions.
+- **Hydrate**: drink a glass of water before every task of your plan.
+- **Rest**: sleep 7-9 hours so that your body can recover.
+
+You've got this! 🚀"""
+
+
+def split_tokens(text: str) -> List[str]:
+    """Splits a text in pieces of about one token (words, with their leading whitespace, cut every 4 characters)."""
+    return re.findall(r"\s*\S{1,4}|\s+$", text)
+
+def estimate_usage(messages: List[BaseMessage], text: str) -> dict:
+    input_tokens = sum(len(str(message.content)) for message in messages) // 4
+    output_tokens = len(split_tokens(text))
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+
+def fit_to_response_format(response: str, response_format: Optional[dict]) -> str:
+    """Keeps only the keys of a JSON response which the json schema of response_format has
+    (e.g. the regenerated tasks of a plan), so that the canned plan fits the structured outputs.
+    If the response has none of them (e.g. the plans of several days), it is answered for each of them."""
+    try:
+        properties = response_format["json_schema"]["schema"]["properties"]
+        response_dict = json.loads(response)
+    except (TypeError, KeyError, ValueError):
+        return response
+    if not isinstance(response_dict, dict):
+        return response
+    if not response_dict.keys() & properties.keys():
+        return json.dumps({key: response_dict for key in properties})
+    return json.dumps({key: value for key, value in response_dict.items() if key in properties})
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic local chat model: answers `response` after latency_seconds, then streams it at tokens_per_second
+    (0 for no delay). Extra call arguments (response_format...) are accepted and ignored."""
+
+    model_name: str = "fake"
+    response: str = ""
+    latency_seconds: float = 0
+    tokens_per_second: float = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _response(self, messages: List[BaseMessage], **kwargs: Any) -> str:
+        return fit_to_response_format(self.response, kwargs.get("response_format"))
+
+    def _token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+    def _result(self, messages: List[BaseMessage], text: str) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=estimate_usage(messages, text)))])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self._response(messages, **kwargs)
+        time.sleep(self.latency_seconds + len(split_tokens(text)) * self._token_delay())
+        return self._result(messages, text)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self._response(messages, **kwargs)
+        await asyncio.sleep(self.latency_seconds + len(split_tokens(text)) * self._token_delay())
+        return self._result(messages, text)
+
+    def _chunks(self, messages: List[BaseMessage], text: str) -> Iterator[ChatGenerationChunk]:
+        for token in split_tokens(text):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=estimate_usage(messages, text))) # like the usage chunk of OpenAI
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        text = self._response(messages, **kwargs)
+        time.sleep(self.latency_seconds)
+        for chunk in self._chunks(messages, text):
+            time.sleep(self._token_delay())
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        text = self._response(messages, **kwargs)
+        await asyncio.sleep(self.latency_seconds)
+        for chunk in self._chunks(messages, text):
+            await asyncio.sleep(self._token_delay())
+            yield chunk
+
+
+## record / replay ------------------------------------------------------------------------------
+# times of the day in the prompts ("09:30", "09:30:00", and the "09 hrs 30 mins" of the not_before constraint)
+TIME_PATTERN = re.compile(r"\b\d{1,2}:\d{2}(?::\d{2})?\b|\b\d{1,2} hrs \d{1,2} mins\b")
+
+def cassette_messages(messages: List[BaseMessage]) -> List[List[str]]:
+    """The parts of the prompt messages a recorded response is looked up by, the same for the same request at another
+    time: the system messages (but the summary of the conversation) and the last message, with the times of the day
+    left out. So the chat history (and the static few-shot examples) and the current time do not change the key."""
+    kept = [message for message in messages[:-1]
+            if message.type == "system" and not str(message.content).startswith(SUMMARY_PREFIX)] + messages[-1:]
+    return [[message.type, TIME_PATTERN.sub("<time>", str(message.content))] for message in kept]
+
+def cassette_path(cassette_dir: str, use_case: str, messages: List[BaseMessage], **kwargs: Any) -> Path:
+    """The cassette file of a call: a hash of the normalized prompt messages and of the response format."""
+    call = {
+        "messages": cassette_messages(messages),
+        "response_format": kwargs.get("response_format"),
+    }
+    key = hashlib.sha256(json.dumps(call, sort_keys=True, default=str).encode()).hexdigest()
+    return Path(cassette_dir) / use_case / f"{key}.json"
+
+def save_cassette(path: Path, model_name: str, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"model": model_name, "content": text}, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+class ReplayChatModel(FakeChatModel):
+    """Answers the responses recorded by RecordingChatModel, a call which was not recorded raises a LookupError."""
+
+    use_case: str
+    cassette_dir: str
+
+    def _response(self, messages: List[BaseMessage], **kwargs: Any) -> str:
+        path = cassette_path(self.cassette_dir, self.use_case, messages, **kwargs)
+        if not path.exists():
+            raise LookupError(f"No recorded {self.use_case} response for this prompt in {path.parent}")
+        return json.loads(path.read_text(encoding="utf-8"))["content"]
+
+
+class RecordingChatModel(BaseChatModel):
+    """Calls the wrapped model and saves every response to a cassette file, for ReplayChatModel."""
+
+    model_name: str
+    use_case: str
+    cassette_dir: str
+    model: BaseChatModel
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording-chat-model"
+
+    def _save(self, messages: List[BaseMessage], text: str, **kwargs: Any):
+        save_cassette(cassette_path(self.cassette_dir, self.use_case, messages, **kwargs), self.model_name, text)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        message = self.model.invoke(messages, stop=stop, **kwargs)
+        self._save(messages, message.content, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        message = await self.model.ainvoke(messages, stop=stop, **kwargs)
+        await asyncio.to_thread(self._save, messages, message.content, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        text = ""
+        for chunk in self.model.stream(messages, stop=stop, **kwargs):
+            text += chunk.content
+            yield ChatGenerationChunk(message=chunk)
+        self._save(messages, text, **kwargs)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        text = ""
+        async for chunk in self.model.astream(messages, stop=stop, **kwargs):
+            text += chunk.content
+            yield ChatGenerationChunk(message=chunk)
+        await asyncio.to_thread(self._save, messages, text, **kwargs)
+
+
+def fake_response(use_case: str) -> str:
+    if use_case == "plan":
+        if settings.FAKE_LLM_PLAN_FILE:
+            return Path(settings.FAKE_LLM_PLAN_FILE).read_text(encoding="utf-8")
+        return json.dumps(DEFAULT_FAKE_PLAN)
+    return DEFAULT_FAKE_CHAT_RESPONSE
+
+def build_chat_model(use_case: str, model: str, openai_model: Callable[[], BaseChatModel]) -> BaseChatModel:
+    """The chat model of a use case ("plan" or "chat") for LLM_PROVIDER, openai_model builds the OpenAI model."""
+    provider = settings.LLM_PROVIDER
+    if provider == "fake":
+        return FakeChatModel(model_name=model, response=fake_response(use_case),
+                             latency_seconds=settings.FAKE_LLM_LATENCY_SECONDS, tokens_per_second=settings.FAKE_LLM_TOKENS_PER_SECOND)
+    if provider == "replay":
+        return ReplayChatModel(model_name=model, use_case=use_case, cassette_dir=settings.LLM_CASSETTE_DIR,
+                               latency_seconds=settings.FAKE_LLM_LATENCY_SECONDS, tokens_per_second=settings.FAKE_LLM_TOKENS_PER_SECOND)
+    if provider == "record":
+        return RecordingChatModel(model_name=model, use_case=use_case, cassette_dir=settings.LLM_CASSETTE_DIR, model=openai_model())
+    if provider == "openai":
+        return openai_model()
+    raise ValueError(f"Unknown LLM_PROVIDER '{provider}', expected openai, fake, record or replay")
@@ -0,0 +1,202 @@
+from collections import deque
+from langchain_core.runnables import Runnable, RunnableConfig
+from typing import Any, AsyncIterator, List, Optional
+from .config import settings
+from .metrics import metrics
+from .rate_limiter import LLMRateLimiter
+from .token_counting import count_prompt_tokens
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHED_SHARE_BUCKETS = (0, 0.25, 0.5, 0.75, 0.9, 1) # histogram of the share of the prompt tokens read from the provider's cache
+
+class LLMTier:
+    """One model of an LLMRouter, with the window of its recent latencies (for the hedge threshold)."""
+
+    def __init__(self, name: str, model: Runnable):
+        self.name = name
+        self.model = model
+        self.model_name = getattr(model, "model_name", name) # the rate limits are per model
+        self._latencies = deque(maxlen=settings.LLM_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """The percentile of the recent latencies, None until LLM_HEDGE_MIN_SAMPLES are recorded."""
+        with self._lock:
+            if len(self._latencies) < max(1, settings.LLM_HEDGE_MIN_SAMPLES):
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+
+class LLMRouter(Runnable):
+    """Chat model with a latency budget, used in place of a single model in the pipelines.
+
+    - every call is bounded by deadline_seconds over all the tiers (a stuck connection never hangs a request)
+    - the tiers (primary, then cheaper and faster fallbacks) are tried in order, a tier which fails or
+      does not answer within tier_timeout_seconds falls back to the next one (the last one gets the rest of the deadline)
+    - a call still running after the p95 latency of its tier (hedge_after_seconds until enough latencies
+      are recorded) is duplicated, the first answer wins and the other request is cancelled
+    - streamed calls fall back on the time to the first chunk, they are not hedged
+
+    Latencies are recorded per tier in the histograms llm_<use_case>_<tier>_latency_seconds (and
+    _first_chunk_seconds for streams), hedges, fallbacks and timeouts in the llm_<use_case>_* counters,
+    and the token usage of every call (with the prompt tokens served from the provider's prompt cache) too.
+    Every request (hedges included) first waits for the rate limiter, with the prompt tokens
+    plus completion_tokens_estimate, the wait counts against the deadline.
+    The tiers can be any runnable taking the prompt, e.g. a fake chat model in tests."""
+
+    def __init__(self, use_case: str, tiers: List[LLMTier],
+                 deadline_seconds: float, tier_timeout_seconds: float, hedge_after_seconds: float = 0,
+                 rate_limiter: LLMRateLimiter = None, completion_tokens_estimate: int = 0):
+        self.use_case = use_case
+        self.tiers = tiers
+        self.deadline_seconds = deadline_seconds
+        self.tier_timeout_seconds = tier_timeout_seconds
+        self.hedge_after_seconds = hedge_after_seconds
+        self.rate_limiter = rate_limiter
+        self.completion_tokens_estimate = completion_tokens_estimate
+
+    def _hedge_after(self, tier: LLMTier) -> Optional[float]:
+        if self.hedge_after_seconds <= 0:
+            return None
+        percentile = tier.latency_percentile(settings.LLM_HEDGE_PERCENTILE)
+        return percentile if percentile is not None else self.hedge_after_seconds
+
+    def _tier_timeout(self, tier_index: int, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if tier_index == len(self.tiers) - 1:
+            return remaining
+        return min(remaining, self.tier_timeout_seconds)
+
+    def _record(self, tier: LLMTier, seconds: float, histogram: str = "latency_seconds"):
+        if histogram == "latency_seconds":
+            tier.record_latency(seconds)
+        metrics.observe(f"llm_{self.use_case}_{tier.name}_{histogram}", seconds)
+
+    def _record_usage(self, message: Any):
+        """Records the token usage reported by the provider (on the last chunk of a stream), if any."""
+        usage = getattr(message, "usage_metadata", None)
+        if not usage:
+            return
+        cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+        metrics.increment(f"llm_{self.use_case}_calls_with_usage")
+        metrics.increment(f"llm_{self.use_case}_input_tokens", usage.get("input_tokens", 0))
+        metrics.increment(f"llm_{self.use_case}_cached_input_tokens", cached_tokens)
+        metrics.increment(f"llm_{self.use_case}_output_tokens", usage.get("output_tokens", 0))
+        if usage.get("input_tokens"):
+            metrics.observe(f"llm_{self.use_case}_cached_input_share", cached_tokens / usage["input_tokens"], buckets=CACHED_SHARE_BUCKETS)
+
+    def _estimated_tokens(self, tier: LLMTier, input: Any) -> int:
+        return count_prompt_tokens(input, tier.model_name) + self.completion_tokens_estimate
+
+    def _fall_back(self, tier: LLMTier, error: Exception):
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+            metrics.increment(f"llm_{self.use_case}_timeouts")
+            logger.warning("LLM tier %s of %s timed out", tier.name, self.use_case)
+        else:
+            metrics.increment(f"llm_{self.use_case}_errors")
+            logger.warning("LLM tier %s of %s failed: %s: %s", tier.name, self.use_case, type(error).__name__, error)
+
+    ## async -------------------------------------------------------------------------
+    async def _ainvoke_hedged(self, tier: LLMTier, input: Any, config: Optional[RunnableConfig], **kwargs) -> Any:
+        async def call():
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(tier.model_name, self._estimated_tokens(tier, input))
+            start = time.monotonic()
+            result = await tier.model.ainvoke(input, config, **kwargs)
+            self._record(tier, time.monotonic() - start)
+            self._record_usage(result)
+            return result
+
+        calls = {asyncio.ensure_future(call())}
+        try:
+            hedge_after = self._hedge_after(tier)
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(calls, timeout=hedge_after)
+                if not done:
+                    metrics.increment(f"llm_{self.use_case}_hedged")
+                    calls.add(asyncio.ensure_future(call()))
+            while True:
+                done, calls = await asyncio.wait(calls, return_when=asyncio.FIRST_COMPLETED)
+                for finished_call in done:
+                    if finished_call.exception() is None:
+                        return finished_call.result()
+                if not calls: # all the requests failed
+                    raise done.pop().exception()
+        finally:
+            for pending_call in calls:
+                pending_call.cancel()
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> Any:
+        deadline = time.monotonic() + self.deadline_seconds
+        error = None
+        for tier_index, tier in enumerate(self.tiers):
+            timeout = self._tier_timeout(tier_index, deadline)
+            if timeout <= 0:
+                break
+            if tier_index > 0:
+                metrics.increment(f"llm_{self.use_case}_fallbacks")
+            try:
+                return await asyncio.wait_for(self._ainvoke_hedged(tier, input, config, **kwargs), timeout=timeout)
+            except Exception as e:
+                self._fall_back(tier, e)
+                error = e
+        raise error or asyncio.TimeoutError(f"LLM deadline of {self.deadline_seconds}s exceeded")
+
+    async def _astream_tier(self, tier: LLMTier, input: Any, config: Optional[RunnableConfig], **kwargs) -> AsyncIterator[Any]:
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(tier.model_name, self._estimated_tokens(tier, input))
+        async for chunk in tier.model.astream(input, config, **kwargs):
+            self._record_usage(chunk)
+            yield chunk
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> AsyncIterator[Any]:
+        deadline = time.monotonic() + self.deadline_seconds
+        error = None
+        for tier_index, tier in enumerate(self.tiers):
+            timeout = self._tier_timeout(tier_index, deadline)
+            if timeout <= 0:
+                break
+            if tier_index > 0:
+                metrics.increment(f"llm_{self.use_case}_fallbacks")
+            start = time.monotonic()
+            chunks = self._astream_tier(tier, input, config, **kwargs)
+            try:
+                first_chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                await chunks.aclose()
+                self._fall_back(tier, e)
+                error = e
+                continue
+            self._record(tier, time.monotonic() - start, histogram="first_chunk_seconds")
+
+            # once the answer is streaming, the rest of the deadline bounds every chunk
+            yield first_chunk
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    await chunks.aclose()
+                    metrics.increment(f"llm_{self.use_case}_timeouts")
+                    raise
+                yield chunk
+            self._record(tier, time.monotonic() - start)
+            return
+        raise error or asyncio.TimeoutError(f"LLM deadline of {self.deadline_seconds}s exceeded")
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> Any:
+        """The async path in an event loop of its own (the app only makes async calls), outside of a running loop only."""
+        return asyncio.run(self.ainvoke(input, config, **kwargs))
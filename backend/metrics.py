@@ -0,0 +1,43 @@
+from collections import defaultdict
+from typing import Dict
+import bisect
+import threading
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+class Metrics:
+    """In-process counters and histograms of the backend, exposed by the /metrics endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._histograms: Dict[str, dict] = {}
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS):
+        """Records a value in the histogram name (count per bucket, count and sum)."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = {"buckets": list(buckets), "counts": [0] * (len(buckets) + 1), "count": 0, "sum": 0.0}
+            histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {name: {**histogram, "buckets": list(histogram["buckets"]), "counts": list(histogram["counts"])}
+                               for name, histogram in self._histograms.items()},
+            }
+
+metrics = Metrics()
@@ -3,7 +3,9 @@ from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
 from typing import Annotated
 from jose import jwt, JWTError, ExpiredSignatureError
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .config import settings
 from . import orm_models, database, schemas
@@ -82,4 +84,49 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session
     if not user:
         raise credentials_exception
     
-    return user
\ No newline at end of file
+    return user
+
+
+async def get_current_user_async(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(database.get_async_db)):
+    
+    """Same as get_current_user, but with the async db session.
+    Used by the async endpoints, so that they do not keep a connection of the sync pool for the whole request."""
+    
+    return await authenticate_token_async(token, db)
+
+
+async def authenticate_token_async(token: str, db: AsyncSession) -> orm_models.Users:
+    
+    """The user of a token, raises a 401 HTTPException if the token is invalid, expired or revoked.
+    Also used by the websocket endpoints, whose token is not read by oauth2_scheme."""
+    
+    # if the passed token in header is blacklisted (user has logged out)
+    blacklisted_token = (await db.execute(
+        select(orm_models.BlacklistedTokens).where(orm_models.BlacklistedTokens.token == token)
+    )).scalars().first()
+    if blacklisted_token:
+        raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Token has been revoked",
+        headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    
+    try:
+        # decode the token
+        token_data = verify_access_token(token, credentials_exception) # this will raise exception if token is invalid
+    except Exception:
+        raise credentials_exception
+    
+    user = (await db.execute(
+        select(orm_models.Users).where(orm_models.Users.email == token_data.email)
+    )).scalars().first()
+    if not user:
+        raise credentials_exception
+    
+    return user
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, ForeignKey, Date, text, Time, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, func, ForeignKey, Date, text, Time, Text, UniqueConstraint, Float, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
@@ -35,6 +35,7 @@ class Preferences(Base):
     lifestyle = Column(String, nullable= False)
     preferred_timings = Column(ARRAY(String), nullable= False)
     note = Column(String)
+    timezone = Column(String, nullable= False, server_default= "Europe/Berlin") # IANA name, the plans are scheduled in the user's local time
     
     # setting the foreign key
     owner_email = Column(String, ForeignKey("users.email", ondelete= "CASCADE"), nullable= False)
@@ -97,4 +98,88 @@ class Plans(Base):
     # setting the foreign key
     owner_email = Column(String, ForeignKey("users.email", ondelete="CASCADE"), nullable=False)
     owner = relationship("Users", back_populates="plans")
-    
\ No newline at end of file
+    
+## Plans of the next days generated in advance (weekly mode), activated by the plan workers each morning
+class PlannedDays(Base):
+    __tablename__ = "planned_days"
+    __table_args__ = (UniqueConstraint("owner_email", "plan_date"),) # one plan per user and day
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    plan_date = Column(Date, nullable=False) # the day the plan is for
+    plan = Column(Text, nullable=False) # the generated plan as JSON string
+    preferences_key = Column(String, nullable=False) # plan_inputs_key of the preferences the plan was generated for
+    generated_on = Column(Date, nullable=False) # first day of the batch, the feedback since then is checked before the activation
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    
+    # setting the foreign key
+    owner_email = Column(String, ForeignKey("users.email", ondelete="CASCADE"), nullable=False)
+    
+## Queue of plan generation jobs, drained by the plan workers
+class PlanJobs(Base):
+    __tablename__ = "plan_jobs"
+    __table_args__ = (UniqueConstraint("owner_email", "run_date"),) # one job per user and day
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_date = Column(Date, nullable=False) # the day the plan is generated for
+    status = Column(String, nullable=False, server_default="pending", index=True) # pending, running, done or dead
+    attempts = Column(Integer, nullable=False, server_default=text("0"))
+    run_after = Column(DateTime(timezone=True), nullable=False, server_default=func.now()) # not claimed before this time (schedule, backoff)
+    claimed_at = Column(DateTime(timezone=True), nullable=True, index=True) # last time a worker claimed the job
+    locked_by = Column(String, nullable=True) # the worker holding the lease
+    locked_until = Column(DateTime(timezone=True), nullable=True) # the lease expires at this time, then the job can be claimed again
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+    
+    # setting the foreign key
+    owner_email = Column(String, ForeignKey("users.email", ondelete="CASCADE"), nullable=False)
+
+## Shared cache of generated plans, keyed by a hash of the generation inputs
+class PlanCacheEntries(Base):
+    __tablename__ = "plan_cache"
+    
+    key = Column(String, primary_key=True)
+    plan = Column(Text, nullable=False) # the generated plan as JSON string
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+## Token buckets of the LLM rate limiter, shared by all the processes
+class LLMRateLimits(Base):
+    __tablename__ = "llm_rate_limits"
+    
+    key = Column(String, primary_key=True) # <model>:requests or <model>:tokens
+    level = Column(Float, nullable=False) # tokens left in the bucket at updated_at
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+## Chat history of the coach, per user
+class ChatMessages(Base):
+    __tablename__ = "chat_messages"
+    __table_args__ = (Index("ix_chat_messages_owner_email_id", "owner_email", "id"),) # the last messages of a user
+    
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    role = Column(String, nullable=False) # the message type: "human" or "ai"
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    
+    # setting the foreign key
+    owner_email = Column(String, ForeignKey("users.email", ondelete="CASCADE"), nullable=False)
+
+## Running summary of the older chat messages of a user (summary mode of the chat history)
+class ChatSummaries(Base):
+    __tablename__ = "chat_summaries"
+    
+    owner_email = Column(String, ForeignKey("users.email", ondelete="CASCADE"), primary_key=True)
+    summary = Column(Text, nullable=False)
+    summarized_up_to = Column(BigInteger, nullable=False) # id of the last chat message folded into the summary
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+## Columns added to tables which already exist in deployed databases (create_all only creates the missing tables)
+ADDED_COLUMNS = [
+    "ALTER TABLE preferences ADD COLUMN IF NOT EXISTS timezone VARCHAR NOT NULL DEFAULT 'Europe/Berlin'",
+]
+
+def create_tables(engine):
+    """Creates the missing tables and adds the missing columns to the existing ones, safe to run on every startup."""
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for statement in ADDED_COLUMNS:
+            connection.execute(text(statement))
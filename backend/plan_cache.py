@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.dialects.postgresql import insert
+from typing import List, Optional, Tuple
+from . import database, orm_models, schemas
+from .config import settings
+from .metrics import metrics
+import copy
+import hashlib
+import json
+import threading
+import time
+
+def plan_inputs_key(preferences: schemas.Preferences, list_of_task_failures: List[str], list_of_task_successes: List[str]) -> str:
+    """Canonical hash of everything the generated plan depends on (except the time constraint,
+    which is applied to the cached plans with utils.shift_plan_after)."""
+
+    normalize = lambda text: " ".join((text or "").lower().split())
+    inputs = {
+        "goal": normalize(preferences.goal),
+        "lifestyle": normalize(preferences.lifestyle),
+        "preferred_timings": [normalize(timing) for timing in preferences.preferred_timings], # the order is the preference
+        "note": normalize(preferences.note),
+        "list_of_task_failures": sorted(normalize(title) for title in list_of_task_failures),
+        "list_of_task_successes": sorted(normalize(title) for title in list_of_task_successes),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class PostgresPlanCacheBackend:
+    """Shared cache backend, so that all the processes see the same generated plans."""
+
+    def get(self, key: str, max_age: float) -> Optional[dict]:
+        with database.Session_local() as db:
+            entry = db.query(orm_models.PlanCacheEntries).filter(
+                orm_models.PlanCacheEntries.key == key,
+                orm_models.PlanCacheEntries.created_at > datetime.now(timezone.utc) - timedelta(seconds=max_age)
+            ).first()
+            return json.loads(entry.plan) if entry else None
+
+    def set(self, key: str, plan: dict):
+        with database.Session_local() as db:
+            db.execute(
+                insert(orm_models.PlanCacheEntries)
+                .values(key=key, plan=json.dumps(plan))
+                .on_conflict_do_update(index_elements=["key"], set_={"plan": json.dumps(plan), "created_at": datetime.now(timezone.utc)})
+            )
+            # expired entries are dropped on write
+            db.query(orm_models.PlanCacheEntries).filter(
+                orm_models.PlanCacheEntries.created_at <= datetime.now(timezone.utc) - timedelta(seconds=settings.PLAN_CACHE_TTL_SECONDS)
+            ).delete(synchronize_session=False)
+            db.commit()
+
+
+class PlanCache:
+    """Cache of generated plans keyed by plan_inputs_key: a size bounded in-process LRU with a TTL,
+    in front of an optional shared backend. Hits and misses are counted in the metrics."""
+
+    def __init__(self, max_size: int, ttl_seconds: float, backend: PostgresPlanCacheBackend = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns a copy of the cached plan, or None."""
+        plan = self._get_local(key)
+        if plan is None and self.backend is not None:
+            plan = self.backend.get(key, self.ttl_seconds)
+            if plan is not None:
+                self._set_local(key, plan)
+        metrics.increment("plan_cache_hits" if plan is not None else "plan_cache_misses")
+        return copy.deepcopy(plan)
+
+    def set(self, key: str, plan: dict):
+        plan = copy.deepcopy(plan)
+        self._set_local(key, plan)
+        if self.backend is not None:
+            self.backend.set(key, plan)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_local(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, plan = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return plan
+
+    def _set_local(self, key: str, plan: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), plan)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False) # least recently used
+
+
+plan_cache = PlanCache(
+    max_size= settings.PLAN_CACHE_SIZE,
+    ttl_seconds= settings.PLAN_CACHE_TTL_SECONDS,
+    backend= PostgresPlanCacheBackend() if settings.PLAN_CACHE_BACKEND == "postgres" else None
+)
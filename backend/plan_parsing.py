@@ -0,0 +1,176 @@
+"""Tolerant parsing of the plans generated by the LLM.
+
+The structured output of OpenAI always gives a valid plan, but the fallback models, recorded cassettes
+or a FAKE_LLM_PLAN_FILE may not: markdown fences, text around the JSON, trailing commas, the content of
+a task as a (double encoded) string or a list of steps, "7:30 PM" timings, titles too long for the plans table.
+Such outputs are repaired locally, the LLM is called again only if the repaired plan is still invalid.
+
+Counted in the metrics: plan_output_valid (valid as generated), plan_output_repaired (and plan_output_repair_<kind>
+per kind of repair), plan_output_regenerated (a new LLM call) and plan_output_invalid (given up).
+"""
+from pydantic import BaseModel, ValidationError
+from typing import Any, List, Optional, Tuple, Type
+from .metrics import metrics
+import ast
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+TITLE_MAX_LENGTH = 50 # schemas.Plans
+STEP_KEYS = ("step_1", "step_2", "step_3")
+
+FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "„": '"', "‘": "'", "’": "'"})
+TIMING_PATTERN = re.compile(r"^(\d{1,2})(?:\s*[:.h]\s*(\d{2}))?(?:\s*:\s*(\d{2}))?\s*([ap])?\.?\s*(?:m\.?)?$", re.IGNORECASE)
+NUMBERED_STEP_PATTERN = re.compile(r"^\s*(?:step\s*)?\d+\s*[.):-]\s*", re.IGNORECASE)
+
+
+## JSON -------------------------------------------------------------------------------------
+def load_json_object(text: str, repairs: List[str]) -> Optional[dict]:
+    """The JSON object of an LLM output, with the common faults repaired (each kind of repair is added
+    to repairs). None if no object can be read."""
+
+    fenced = FENCE_PATTERN.search(text)
+    if fenced:
+        text = fenced.group(1)
+        repairs.append("fences")
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    if text[:start].strip() or text[end + 1:].strip():
+        repairs.append("surrounding_text")
+    text = text[start:end + 1]
+
+    repaired = TRAILING_COMMA_PATTERN.sub(r"\1", text.translate(SMART_QUOTES))
+    loaders = ((None, lambda: json.loads(text, strict=False)), # strict=False: raw newlines and tabs inside the strings
+               ("json", lambda: json.loads(repaired, strict=False)),
+               ("python_literal", lambda: ast.literal_eval(repaired))) # a python dict (single quotes, True/None)
+    for kind, load in loaders:
+        try:
+            value = load()
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if not isinstance(value, dict):
+            return None
+        if kind:
+            repairs.append(kind)
+        return value
+    return None
+
+
+## fields -----------------------------------------------------------------------------------
+def normalize_timing(value: Any) -> Any:
+    """"7:30", "07:30 PM", "7pm", "19.30" or "19h30" -> "HH:MM:SS", anything else is returned as is."""
+    if not isinstance(value, str):
+        return value
+    match = TIMING_PATTERN.match(value.strip())
+    if not match:
+        return value
+    hours, minutes, seconds, meridiem = int(match[1]), int(match[2] or 0), int(match[3] or 0), (match[4] or "").lower()
+    if meridiem == "p" and hours < 12:
+        hours += 12
+    elif meridiem == "a" and hours == 12:
+        hours = 0
+    if hours > 23 or minutes > 59 or seconds > 59:
+        return value
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def normalize_content(value: Any) -> Any:
+    """The content of a task as a dict with step_1, step_2 and step_3. Accepts a double encoded JSON string,
+    a list of steps, numbered lines, or a dict with other keys (in the order of the steps)."""
+    if isinstance(value, str):
+        try:
+            return normalize_content(json.loads(value, strict=False))
+        except ValueError:
+            value = [line for line in value.splitlines() if line.strip()]
+    if isinstance(value, dict):
+        if all(key in value for key in STEP_KEYS):
+            return {key: value[key] for key in STEP_KEYS}
+        value = list(value.values())
+    if isinstance(value, list) and len(value) >= len(STEP_KEYS) and all(isinstance(step, str) for step in value):
+        steps = [NUMBERED_STEP_PATTERN.sub("", step).strip() for step in value]
+        steps[len(STEP_KEYS) - 1:] = [" ".join(steps[len(STEP_KEYS) - 1:])] # extra steps go with the last one
+        return dict(zip(STEP_KEYS, steps))
+    return value
+
+def truncate_title(value: Any) -> Any:
+    if not isinstance(value, str):
+        return value
+    value = " ".join(value.split())
+    if len(value) <= TITLE_MAX_LENGTH:
+        return value
+    truncated = value[:TITLE_MAX_LENGTH + 1].rsplit(" ", 1)[0] # at a word boundary if possible
+    return truncated[:TITLE_MAX_LENGTH].rstrip(" ,;:-")
+
+def normalize_plan(plan: dict, repairs: List[str]) -> dict:
+    """Normalizes the fields of the tasks of a (partial) generated plan, the other keys are left as they are
+    (except the nested plans of several days, normalized too)."""
+    normalizers = (("_content", normalize_content, "content"),
+                   ("_timings_start", normalize_timing, "timings"),
+                   ("_timings_end", normalize_timing, "timings"),
+                   ("_title", truncate_title, "title"))
+    normalized = {}
+    for key, value in plan.items():
+        for suffix, normalize, kind in normalizers:
+            if key.endswith(suffix):
+                new_value = normalize(value)
+                if new_value != value and kind not in repairs:
+                    repairs.append(kind)
+                value = new_value
+                break
+        else:
+            if isinstance(value, dict):
+                value = normalize_plan(value, repairs)
+        normalized[key] = value
+    return normalized
+
+
+## validation -------------------------------------------------------------------------------
+def parse_plan_output(text: str, model: Type[BaseModel]) -> dict:
+    """Validates the text of a generated plan against model (schemas.GeneratedPlan, or generated_tasks_model
+    for some tasks), repairing it if needed. Raises the ValidationError of the output if it cannot be repaired."""
+    try:
+        plan = model.model_validate_json(text).model_dump()
+    except ValidationError as error:
+        plan, repairs = repair_plan_output(text, model)
+        if plan is None:
+            raise error
+        record_repairs(repairs)
+        return plan
+    # timings and titles are not constrained by the json schema
+    repairs = []
+    plan = normalize_plan(plan, repairs)
+    record_repairs(repairs)
+    return plan
+
+def repair_plan_output(text: str, model: Type[BaseModel]) -> Tuple[Optional[dict], List[str]]:
+    repairs = []
+    plan = load_json_object(text, repairs)
+    if plan is None:
+        return None, repairs
+    if plan.keys() - model.model_fields.keys(): # e.g. the whole plan when only some tasks were asked
+        plan = {key: value for key, value in plan.items() if key in model.model_fields}
+        repairs.append("extra_keys")
+    try:
+        return model.model_validate(normalize_plan(plan, repairs)).model_dump(), repairs
+    except ValidationError:
+        return None, repairs
+
+def validate_plan(plan: dict, model: Type[BaseModel]) -> dict:
+    """Like parse_plan_output, for a plan already parsed from JSON (e.g. by the streaming parser)."""
+    repairs = []
+    plan = model.model_validate(normalize_plan(plan, repairs)).model_dump()
+    record_repairs(repairs)
+    return plan
+
+def record_repairs(repairs: List[str]):
+    if not repairs:
+        metrics.increment("plan_output_valid")
+        return
+    metrics.increment("plan_output_repaired")
+    for kind in repairs:
+        metrics.increment(f"plan_output_repair_{kind}")
+    logger.info("Repaired generated plan (%s)", ", ".join(repairs))
@@ -0,0 +1,160 @@
+"""Plan generation worker, drains the plan_jobs queue filled by the scheduler.
+
+By default (PLAN_WORKER_IN_APP) a worker also runs on the event loop of every API process.
+Any number of workers can run next to the API, as separate processes:
+
+    python -m backend.plan_worker
+"""
+from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
+from . import database, job_queue, orm_models, planned_days, rate_limiter, utils
+from .config import settings
+from .event_scheduler import PlanGenerationJob, generate_plans, iter_plan_generation_jobs, save_generated_plan
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# the sessions of the worker are only used from this thread (one at a time), never from the event loop,
+# which is the one of the API when the worker runs in the app
+db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plan-worker-db")
+
+def claim_batch(db: Session, worker_id: str) -> Tuple[Dict[str, orm_models.PlanJobs], List[PlanGenerationJob]]:
+    """Claims a batch of due jobs (by email), and returns them with the generation jobs of the users which need an LLM call.
+    The jobs of users without preferences or plan, and in weekly mode the ones with a usable stored plan, are done here."""
+
+    claimed_jobs = job_queue.claim_jobs(db, worker_id, limit=2 * settings.PLAN_GENERATION_CONCURRENCY)
+    if not claimed_jobs:
+        return {}, []
+    queued_jobs = {job.owner_email: job for job in claimed_jobs}
+
+    generation_jobs = list(iter_plan_generation_jobs(db, emails=list(queued_jobs)))
+
+    # users which lost their preferences or plan since the job was enqueued have nothing to generate
+    for email in set(queued_jobs) - {job.email for job in generation_jobs}:
+        job_queue.complete_job(db, queued_jobs[email], worker_id)
+
+    if settings.PLAN_DAYS_PER_GENERATION > 1:
+        # weekly mode: the users with a usable stored plan for the day need no LLM call
+        run_dates = {email: job.run_date for email, job in queued_jobs.items()}
+        ready_days = planned_days.find_ready_days(db, generation_jobs, run_dates)
+        for job in generation_jobs:
+            if job.email in ready_days:
+                try:
+                    planned_days.activate_planned_day(db, job, ready_days[job.email])
+                    job_queue.complete_job(db, queued_jobs[job.email], worker_id)
+                except utils.PlanDoesNotFit as e: # too late in the day for the stored plan, a new batch is generated
+                    logger.info("Stored plan of %s not activated: %s", job.email, e)
+                    del ready_days[job.email]
+                except Exception as e:
+                    logger.exception("Activation of the stored plan of %s failed", job.email)
+                    job_queue.fail_job(db, queued_jobs[job.email], worker_id, f"{type(e).__name__}: {e}")
+        generation_jobs = [job for job in generation_jobs if job.email not in ready_days]
+    return queued_jobs, generation_jobs
+
+async def process_jobs(db: Session, worker_id: str, cohorts: dict = None, run_dates: set = None) -> int:
+    """Claims a batch of due jobs and generates their plans. Returns the number of claimed jobs.
+    cohorts is passed on to generate_plans, to share the plans of users with identical inputs.
+    The run dates of the claimed jobs are added to run_dates.
+    db is only used in db_thread, the plans are saved there as soon as they are generated."""
+
+    loop = asyncio.get_running_loop()
+    queued_jobs, generation_jobs = await loop.run_in_executor(db_thread, claim_batch, db, worker_id)
+    if not queued_jobs:
+        return 0
+    if run_dates is not None:
+        run_dates.update(job.run_date for job in queued_jobs.values())
+
+    days = settings.PLAN_DAYS_PER_GENERATION
+
+    def save(job: PlanGenerationJob, generated_plan):
+        try:
+            if days > 1:
+                planned_days.save_planned_days(db, job, generated_plan, queued_jobs[job.email].run_date)
+            else:
+                save_generated_plan(db, job, generated_plan)
+            job_queue.complete_job(db, queued_jobs[job.email], worker_id)
+        except Exception as e:
+            logger.exception("Saving the plan of %s failed", job.email)
+            db.rollback()
+            job_queue.fail_job(db, queued_jobs[job.email], worker_id, f"{type(e).__name__}: {e}")
+
+    writes = []
+    def on_plan_generated(job: PlanGenerationJob, generated_plan):
+        writes.append(loop.run_in_executor(db_thread, save, job, generated_plan))
+
+    def on_plan_failed(job: PlanGenerationJob, error: Exception):
+        writes.append(loop.run_in_executor(db_thread, job_queue.fail_job, db, queued_jobs[job.email], worker_id, f"{type(error).__name__}: {error}"))
+
+    await generate_plans(generation_jobs, on_plan_generated= on_plan_generated, on_plan_failed= on_plan_failed,
+                         cohorts= cohorts, days= days)
+    await asyncio.gather(*writes)
+    return len(queued_jobs)
+
+def log_run_summaries(db: Session, run_dates: set):
+    """Logs the totals of the runs (over all the workers, see job_queue.run_summary), once the queue is drained."""
+    for run_date in sorted(run_dates):
+        summary = job_queue.run_summary(db, run_date)
+        logger.info("Plan generation run of %s: %d/%d plans generated (%d dead, %d left) in %.1fs, %.2f plans/s",
+                    summary["run_date"], summary["jobs"]["done"], summary["jobs"]["total"], summary["jobs"]["dead"],
+                    summary["jobs"]["pending"] + summary["jobs"]["running"], summary["wall_time_seconds"], summary["plans_per_second"])
+
+async def run_worker():
+    """Processes jobs until cancelled, polling the queue while it is empty."""
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    rate_limiter.llm_priority.set(rate_limiter.BACKGROUND) # the requests of the users are served first
+    logger.info("Plan worker %s started", worker_id)
+    cohorts, cohorts_date = {}, date.today() # the cohort plans are shared over all the batches of a day
+    run_dates = set() # of the jobs processed since the queue was last empty
+
+    try:
+        while True:
+            if settings.PLAN_COHORT_DEDUP and cohorts_date != date.today():
+                cohorts, cohorts_date = {}, date.today()
+            db: Session = database.Session_local()
+            try:
+                claimed = await process_jobs(db, worker_id, cohorts if settings.PLAN_COHORT_DEDUP else None, run_dates)
+                if not claimed and run_dates:
+                    await asyncio.get_running_loop().run_in_executor(db_thread, log_run_summaries, db, run_dates)
+                    run_dates.clear()
+            except Exception:
+                logger.exception("Plan worker %s failed to process jobs", worker_id)
+                claimed = 0
+            finally:
+                db_thread.submit(db.close) # after the writes still queued on the session
+            if not claimed:
+                await asyncio.sleep(settings.PLAN_WORKER_POLL_SECONDS)
+    finally:
+        logger.info("Plan worker %s stopped", worker_id)
+
+## worker running on the event loop of the API process ----------------------------------
+# one loop per process: the LLM clients (and their connection pools) and the plan_generations
+# of the requests are shared with the API
+worker_task: Optional[asyncio.Task] = None
+
+def start_worker_task() -> asyncio.Task:
+    global worker_task
+    worker_task = asyncio.create_task(run_worker(), name="plan-worker")
+    return worker_task
+
+async def stop_worker_task():
+    """Cancels the worker, its claimed jobs are claimed again once their lease expires."""
+    global worker_task
+    if worker_task is not None:
+        worker_task.cancel()
+        await asyncio.gather(worker_task, return_exceptions=True)
+        worker_task = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,84 @@
+"""Weekly mode (PLAN_DAYS_PER_GENERATION > 1): the plans of the next days are generated in one LLM call
+and stored in planned_days. Each morning the plan worker activates the stored plan of the day, without an LLM call,
+unless the user's preferences changed or they failed PLAN_DIVERGENCE_MAX_FAILURES tasks since the batch was generated,
+then a new batch is generated."""
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+from . import orm_models, plan_cache, utils
+from .config import settings
+from .event_scheduler import PlanGenerationJob, save_generated_plan
+from .metrics import metrics
+import json
+import logging
+import pytz
+
+logger = logging.getLogger(__name__)
+
+def preferences_key(job: PlanGenerationJob) -> str:
+    return plan_cache.plan_inputs_key(job.preferences, [], [])
+
+def find_ready_days(db: Session, jobs: List[PlanGenerationJob], run_dates: Dict[str, date]) -> Dict[str, orm_models.PlannedDays]:
+    """The stored plans of the run dates of the jobs (by email) which can still be used: generated for the current
+    preferences, and with less than PLAN_DIVERGENCE_MAX_FAILURES failed tasks in the feedback since."""
+    if not jobs:
+        return {}
+    failures_since_generation = (
+        select(func.coalesce(func.sum(func.cardinality(orm_models.Feedback.list_of_task_failures)), 0))
+        .where(orm_models.Feedback.owner_email == orm_models.PlannedDays.owner_email,
+               orm_models.Feedback.date >= orm_models.PlannedDays.generated_on)
+        .scalar_subquery()
+    )
+    rows = db.execute(
+        select(orm_models.PlannedDays, failures_since_generation.label("failures"))
+        .where(tuple_(orm_models.PlannedDays.owner_email, orm_models.PlannedDays.plan_date)
+               .in_([(job.email, run_dates[job.email]) for job in jobs]))
+    ).all()
+    planned_days = {planned_day.owner_email: (planned_day, failures) for planned_day, failures in rows}
+
+    ready_days = {}
+    for job in jobs:
+        planned_day, failures = planned_days.get(job.email, (None, 0))
+        if planned_day is None:
+            continue
+        if planned_day.preferences_key != preferences_key(job) or failures >= settings.PLAN_DIVERGENCE_MAX_FAILURES:
+            metrics.increment("planned_days_diverged")
+            logger.info("Stored plans of %s diverged (%d failed tasks), generating new ones", job.email, failures)
+            continue
+        ready_days[job.email] = planned_day
+    return ready_days
+
+def activate_planned_day(db: Session, job: PlanGenerationJob, planned_day: orm_models.PlannedDays):
+    """Writes a stored plan to the plan of the user (moved after the current local time) and drops it,
+    with the stored plans of the past days. Raises utils.PlanDoesNotFit (nothing written) if the stored plan
+    cannot be moved after the current local time."""
+    generated_plan = json.loads(planned_day.plan)
+    generated_plan = utils.shift_plan_after(generated_plan, datetime.now(pytz.timezone(job.preferences.timezone)))
+    save_generated_plan(db, job, generated_plan)
+    db.query(orm_models.PlannedDays).filter(
+        orm_models.PlannedDays.owner_email == job.email,
+        orm_models.PlannedDays.plan_date <= planned_day.plan_date
+    ).delete(synchronize_session=False)
+    db.commit()
+    metrics.increment("planned_days_activated")
+
+def save_planned_days(db: Session, job: PlanGenerationJob, generated_plans: List[dict], run_date: date):
+    """Writes the first of the generated plans to the plan of the user, and stores the others for the next days
+    (in place of the stored plans of the user)."""
+    save_generated_plan(db, job, generated_plans[0])
+    try:
+        db.query(orm_models.PlannedDays).filter(orm_models.PlannedDays.owner_email == job.email).delete(synchronize_session=False)
+        db.add_all([
+            orm_models.PlannedDays(owner_email= job.email,
+                                   plan_date= run_date + timedelta(days=day),
+                                   plan= json.dumps(generated_plan),
+                                   preferences_key= preferences_key(job),
+                                   generated_on= run_date)
+            for day, generated_plan in enumerate(generated_plans[1:], start=1)
+        ])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    metrics.increment("planned_days_generated", len(generated_plans))
@@ -0,0 +1,155 @@
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from typing import Dict, List, Tuple
+from . import database, orm_models
+from .config import settings
+from .metrics import metrics
+import asyncio
+import random
+import threading
+import time
+
+## priorities of the LLM calls
+INTERACTIVE = "interactive" # requests of the users (/plans, /coach)
+BACKGROUND = "background" # scheduled plan generation
+
+# the priority of the LLM calls of the current task/thread, the plan worker sets it to BACKGROUND
+llm_priority: ContextVar[str] = ContextVar("llm_priority", default=INTERACTIVE)
+
+@dataclass
+class BucketCost:
+    key: str
+    capacity: float # the bucket holds at most a minute of its limit
+    refill_per_second: float
+    cost: float
+    floor: float = 0 # the level which must be left in the bucket after taking the cost
+
+
+class MemoryRateLimitBackend:
+    """Token buckets of this process only."""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {} # key -> (level, monotonic time of the level)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, costs: List[BucketCost]) -> float:
+        with self._lock:
+            now = time.monotonic()
+            levels = {}
+            for bucket in costs:
+                level, updated_at = self._buckets.get(bucket.key, (bucket.capacity, now))
+                levels[bucket.key] = min(bucket.capacity, level + (now - updated_at) * bucket.refill_per_second)
+            wait = seconds_to_wait(costs, levels)
+            for bucket in costs:
+                self._buckets[bucket.key] = (levels[bucket.key] - (bucket.cost if wait == 0 else 0), now)
+            return wait
+
+
+class PostgresRateLimitBackend:
+    """Token buckets shared by all the processes, as rows of llm_rate_limits.
+    The rows of a call are locked (in key order, so that concurrent calls do not deadlock) while they are updated."""
+
+    def try_acquire(self, costs: List[BucketCost]) -> float:
+        with database.Session_local() as db:
+            now = datetime.now(timezone.utc)
+            db.execute(
+                insert(orm_models.LLMRateLimits)
+                .values([{"key": bucket.key, "level": bucket.capacity, "updated_at": now} for bucket in costs])
+                .on_conflict_do_nothing(index_elements=["key"])
+            )
+            rows = {row.key: row for row in db.execute(
+                select(orm_models.LLMRateLimits)
+                .where(orm_models.LLMRateLimits.key.in_([bucket.key for bucket in costs]))
+                .order_by(orm_models.LLMRateLimits.key)
+                .with_for_update()
+            ).scalars()}
+            levels = {bucket.key: min(bucket.capacity, rows[bucket.key].level
+                                      + max(0.0, (now - rows[bucket.key].updated_at).total_seconds()) * bucket.refill_per_second)
+                      for bucket in costs}
+            wait = seconds_to_wait(costs, levels)
+            for bucket in costs:
+                rows[bucket.key].level = levels[bucket.key] - (bucket.cost if wait == 0 else 0)
+                rows[bucket.key].updated_at = now
+            db.commit()
+            return wait
+
+
+def seconds_to_wait(costs: List[BucketCost], levels: Dict[str, float]) -> float:
+    """0 if every bucket has its cost above its floor, else the time until the emptiest one has."""
+    return max(max(0.0, (bucket.cost + bucket.floor - levels[bucket.key]) / bucket.refill_per_second) for bucket in costs)
+
+
+class LLMRateLimiter:
+    """Requests per minute and tokens per minute limits of the LLM calls, per model (like the limits of OpenAI).
+
+    Every call takes a request and its estimated tokens from the token buckets of its model, and waits until
+    they are available. Background calls cannot take the last LLM_RATE_LIMIT_INTERACTIVE_RESERVE share
+    of the buckets, so the requests of the users get through during the morning burst of the scheduler."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, interactive_reserve: float, backend):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.interactive_reserve = interactive_reserve
+        self.backend = backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests_per_minute > 0 or self.tokens_per_minute > 0
+
+    def _costs(self, model: str, tokens: int) -> List[BucketCost]:
+        reserve = self.interactive_reserve if llm_priority.get() == BACKGROUND else 0
+        costs = []
+        for kind, limit, cost in (("requests", self.requests_per_minute, 1), ("tokens", self.tokens_per_minute, tokens)):
+            if limit <= 0:
+                continue
+            cost = min(cost, limit) # a call bigger than the bucket would wait forever
+            costs.append(BucketCost(key=f"{model}:{kind}", capacity=limit, refill_per_second=limit / 60,
+                                    cost=cost, floor=min(reserve * limit, limit - cost)))
+        return costs
+
+    async def acquire(self, model: str, tokens: int):
+        """Waits until the call can be made."""
+        if not self.enabled:
+            return
+        costs, start = self._costs(model, tokens), time.monotonic()
+        while (wait := await asyncio.to_thread(self.backend.try_acquire, costs)) > 0:
+            await asyncio.sleep(min(wait, 1) * random.uniform(1, 1.2)) # jitter, so that the waiting calls do not retry all at once
+        self._record_wait(time.monotonic() - start)
+
+    def _record_wait(self, seconds: float):
+        metrics.observe(f"llm_rate_limit_{llm_priority.get()}_wait_seconds", seconds)
+
+
+class UserConcurrencyLimit:
+    """At most limit generations at once per user (in this process), a generation over the limit is rejected."""
+
+    def __init__(self, limit: int, metric_name: str):
+        self.limit = limit
+        self.metric_name = metric_name
+        self._active: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, user_id: str) -> bool:
+        with self._lock:
+            if self._active.get(user_id, 0) >= self.limit:
+                metrics.increment(self.metric_name)
+                return False
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            return True
+
+    def release(self, user_id: str):
+        with self._lock:
+            self._active[user_id] -= 1
+            if not self._active[user_id]:
+                del self._active[user_id]
+
+
+rate_limiter = LLMRateLimiter(
+    requests_per_minute= settings.LLM_REQUESTS_PER_MINUTE,
+    tokens_per_minute= settings.LLM_TOKENS_PER_MINUTE,
+    interactive_reserve= settings.LLM_RATE_LIMIT_INTERACTIVE_RESERVE,
+    backend= PostgresRateLimitBackend() if settings.LLM_RATE_LIMIT_BACKEND == "postgres" else MemoryRateLimitBackend()
+)
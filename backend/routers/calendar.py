@@ -125,6 +125,11 @@ def calendar_sync_callback(request: Request, db: Session = Depends(database.get_
     """
     return HTMLResponse(content=html_content)
 
+def user_timezone(db: Session, email: str) -> str:
+    """The timezone of the user's preferences, in which their plans are generated."""
+    preferences = db.query(orm_models.Preferences).filter(orm_models.Preferences.owner_email == email).first()
+    return preferences.timezone if preferences else "Europe/Berlin"
+
 # Update the user's Google Calendar events
 def update_events_for_user(user: orm_models.Users, db: Session) -> JSONResponse:
     
@@ -187,7 +192,7 @@ def update_events_for_user(user: orm_models.Users, db: Session) -> JSONResponse:
         db.refresh(user)
         
         # Create calendar events based on the user's plans + get the corresponding event IDs
-        google_event_ids = utils.create_calendar_events(user_plans, service)
+        google_event_ids = utils.create_calendar_events(user_plans, service, user_timezone(db, user.email))
         user.google_event_ids = json.dumps(google_event_ids)  # Store the event IDs as a JSON string in the user table
         user.is_google_synced = True  # Mark the user as synced with Google Calendar
         user.date_last_synced = date.today()  # Update the last synced date
@@ -261,7 +266,7 @@ def post_event(current_user: Annotated[schemas.CreateUserResponse, Depends(oauth
         service = build("calendar", "v3", credentials=credentials)
         
         # Create calendar events based on the user's plans + get the corresponding event IDs
-        google_event_ids = utils.create_calendar_events(user_plans, service)
+        google_event_ids = utils.create_calendar_events(user_plans, service, user_timezone(db, current_user.email))
         current_user.google_event_ids = json.dumps(google_event_ids)  # Store the event IDs as a JSON string in the user table
         current_user.is_google_synced = True  # Mark the user as synced with Google Calendar
         current_user.date_last_synced = date.today() # Set the last synced date
@@ -1,47 +1,127 @@
-from sqlalchemy.orm import Session
-from fastapi import FastAPI, APIRouter, status, Depends, HTTPException
+from fastapi import FastAPI, APIRouter, status, Depends, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.security import OAuth2PasswordRequestForm
-from .. import utils, database, schemas, orm_models, oauth2
-from typing import Annotated
+from .. import utils, schemas, oauth2, coach_context, database
+from ..config import settings
+from ..metrics import metrics
+from ..rate_limiter import UserConcurrencyLimit
+from typing import Annotated, AsyncIterator, Optional, Tuple
 from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+import asyncio
+import contextlib
+import json
+import logging
 # from starlette.responses import StreamingResponse
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix= "/coach",
     tags = ["Coach"]
 )
 
+# a second generation of a user is rejected while the first one streams (e.g. double submit, several tabs)
+coach_generations = UserConcurrencyLimit(limit= settings.COACH_MAX_CONCURRENT_GENERATIONS_PER_USER,
+                                         metric_name= "coach_generations_rejected")
+
+async def limited_chatbot_events(user_query: str, user_id: str, context: coach_context.CoachContext) -> AsyncIterator[Tuple[str, dict]]:
+    """utils.chatbot_events within the concurrency limit of the user, an `error` event if over it."""
+    if not coach_generations.try_acquire(user_id):
+        yield "error", {"detail": "A response is already being generated, please wait for it to finish."}
+        return
+    try:
+        async for event, data in utils.chatbot_events(user_query, user_id, context.user_context, context.goal):
+            yield event, data
+    finally:
+        coach_generations.release(user_id)
+
 
 @router.post("")
 async def stream_chat(
-    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user)],
-    query: schemas.UserQuery,
-    db: Session = Depends(database.get_db)
+    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user_async)],
+    query: schemas.UserQuery
     ):
-    """get the streaming response from the chatbot if the user has a plan."""
-    
+    """get the streaming response from the chatbot if the user has a plan, as server-sent events
+    (`token` events with the chunks of the answer, then an `end` or an `error` event)."""
+
     user_id = current_user.email
-    
-    user_plans = db.query(orm_models.Plans).filter(orm_models.Plans.owner_email == current_user.email).first()
-    if not user_plans:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No plans found for user {current_user.username}."
-        )
-        
-    user_preferences = db.query(orm_models.Preferences).filter(orm_models.Preferences.owner_email == current_user.email).first()
-    if not user_preferences:
+
+    # goal and tasks of the user, rendered once and cached until the plan or the preferences change
+    context = await coach_context.get_coach_context(current_user.email)
+    if context is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No preferences found for user {current_user.username}."
+            detail=f"No plans or preferences found for user {current_user.username}."
         )
-        
+
+    async def events():
+        async for event, data in limited_chatbot_events(query.user_query, user_id, context):
+            yield utils.server_sent_event(event, data)
+
     return StreamingResponse(
-        content = utils.get_chatbot_response(query.user_query, 
-                                             user_id, 
-                                             str(user_plans.task1_content),
-                                             str(user_plans.task2_content),
-                                             str(user_plans.task3_content), 
-                                             user_preferences.goal),
-        media_type="text/event-stream"
-    )
\ No newline at end of file
+        content = events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def stream_answer(websocket: WebSocket, current_user, user_query: str):
+    """Sends the answer to a query as websocket messages: {"event": "token", "text": ...} per chunk, then an `end` or `error` message.
+    On an unexpected failure (e.g. of the db) an `error` message is sent and the websocket is closed, the client never waits
+    for an end which will not come. The cancellation on a disconnect goes through."""
+    try:
+        context = await coach_context.get_coach_context(current_user.email)
+        if context is None:
+            await websocket.send_json({"event": "error", "detail": f"No plans or preferences found for user {current_user.username}."})
+            return
+        async with contextlib.aclosing(limited_chatbot_events(user_query, current_user.email, context)) as events:
+            async for event, data in events:
+                await websocket.send_json({"event": event, **data})
+    except WebSocketDisconnect:
+        return # nobody to tell
+    except Exception:
+        logger.exception("Coach answer over websocket for %s failed", current_user.email)
+        metrics.increment("coach_errors")
+        with contextlib.suppress(Exception): # the websocket may be broken too
+            await websocket.send_json({"event": "error", "detail": "The coach could not answer, please try again."})
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+
+@router.websocket("/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Coach chat over one websocket per chat session: the client sends {"user_query": ...} messages and gets
+    the answers as in stream_answer, one at a time. The token is read from the Authorization header, or from the
+    token query parameter (browsers cannot set headers on websockets).
+    The generation is cancelled as soon as the client disconnects, so that no tokens are paid for when nobody reads them."""
+
+    authorization = websocket.headers.get("authorization", "")
+    token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else websocket.query_params.get("token", "")
+    try:
+        async with database.AsyncSession_local() as db:
+            current_user = await oauth2.authenticate_token_async(token, db)
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    await websocket.accept()
+
+    generation: Optional[asyncio.Task] = None
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                query = schemas.UserQuery.model_validate(json.loads(message))
+            except (ValueError, ValidationError):
+                await websocket.send_json({"event": "error", "detail": 'Expected a JSON message {"user_query": "..."}.'})
+                continue
+            if generation is not None and not generation.done():
+                metrics.increment("coach_generations_rejected")
+                await websocket.send_json({"event": "error", "detail": "A response is already being generated, please wait for it to finish."})
+                continue
+            generation = asyncio.create_task(stream_answer(websocket, current_user, query.user_query))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if generation is not None:
+            if not generation.done():
+                generation.cancel()
+                metrics.increment("coach_generations_cancelled")
+            await asyncio.gather(generation, return_exceptions=True) # the LLM stream is closed and the slot released
@@ -1,11 +1,18 @@
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from fastapi import FastAPI, APIRouter, status, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import FastAPI, APIRouter, status, Depends, HTTPException, Path
 from fastapi.security import OAuth2PasswordRequestForm
-from .. import utils, database, schemas, orm_models, oauth2
-from typing import Annotated, List
+from .. import utils, database, schemas, orm_models, oauth2, coach_context
+from ..single_flight import SingleFlight, plan_generations
+from ..config import settings
+from typing import Annotated, List, Tuple
 from datetime import date, datetime, timedelta
-from fastapi.responses import JSONResponse
-import json
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
+import asyncio
+import copy
+import pytz
 
 
 router = APIRouter(
@@ -28,14 +35,31 @@ def get_plan(
     return user_plans
 
 ## POST PLAN ---------------------------
+async def generate_plan_once(owner_email: str, generate_and_save) -> schemas.Plans:
+    """Runs generate_and_save (which returns the generated plan), unless a generation of the user's plan
+    is already in flight (double clicks, the plan worker...), then returns the plan of that generation.
+    So concurrent requests of a user share one LLM call, and only the first one writes the plan."""
+    try:
+        generated_plan = await plan_generations.do(owner_email, generate_and_save)
+        return schemas.Plans(**utils.serialize_plan_content(generated_plan))
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Generated plan validation failed: {str(e)}"
+        )
+
+# the generating endpoints are async (async db session and LLM call), so that they hold no threadpool thread
+# while waiting on the LLM. The db connection is given back to the pool before the LLM call as well.
 @router.post("", response_model=schemas.Plans, status_code=status.HTTP_201_CREATED)
-def create_plan(
-    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user)],
-    db: Session = Depends(database.get_db)
+async def create_plan(
+    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user_async)],
+    db: AsyncSession = Depends(database.get_async_db)
 ):
     """Generates a new plan for the user of the preferences exists and there is no existing plan."""
     # Check if user has preferences
-    preferences = db.query(orm_models.Preferences).filter(orm_models.Preferences.owner_email == current_user.email).first()
+    preferences = (await db.execute(
+        select(orm_models.Preferences).where(orm_models.Preferences.owner_email == current_user.email)
+    )).scalars().first()
 
     if not preferences:
         raise HTTPException(
@@ -44,44 +68,63 @@ def create_plan(
         )
 
     # Raise exception if plan already exists
-    existing_plan = db.query(orm_models.Plans).filter(orm_models.Plans.owner_email == current_user.email).first()
+    existing_plan = (await db.execute(
+        select(orm_models.Plans).where(orm_models.Plans.owner_email == current_user.email)
+    )).scalars().first()
     if existing_plan:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="A plan for today already exists. Update the plan if you want."
         )
+    await db.commit() # release the db connection while waiting on the LLM
 
-    # Generate plan using preferences
-    generated_plan = utils.get_todays_plan(preferences)
-    # Convert task content to JSON strings
-    generated_plan["task1_content"] = json.dumps(generated_plan["task1_content"])
-    generated_plan["task2_content"] = json.dumps(generated_plan["task2_content"])
-    generated_plan["task3_content"] = json.dumps(generated_plan["task3_content"])
-    
-    # Validate the plan
-    try:
-        validated_plan = schemas.Plans(**generated_plan)
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Generated plan validation failed: {str(e)}"
+    async def generate_and_save() -> dict:
+        # Generate plan using preferences
+        generated_plan = await utils.aget_todays_plan(preferences)
+        # Convert task content to JSON strings and validate the plan
+        validated_plan = schemas.Plans(**utils.serialize_plan_content(copy.deepcopy(generated_plan)))
+        # Create and save plan
+        new_plan = orm_models.Plans(
+            **validated_plan.dict(),
+            owner_email = current_user.email
         )
-    # Create and save plan
-    new_plan = orm_models.Plans(
-        **validated_plan.dict(),
-        owner_email = current_user.email
-    )
-    db.add(new_plan)
-    db.commit()
-    db.refresh(new_plan)
-    return new_plan
+        db.add(new_plan)
+        await coach_context.ainvalidate(current_user.email, db)
+        await db.commit()
+        return generated_plan
+    
+    return await generate_plan_once(current_user.email, generate_and_save)
 
 ## UPDATE PLAN ---------------------------
-def update_plan_for_user(user: orm_models.Users, db: Session) -> orm_models.Plans:
-    """Updates the user's plan if the preferences and the plan already exists."""
+async def get_recent_feedback(owner_email: str, db: AsyncSession) -> Tuple[List[str], List[str]]:
+    """Returns the titles of the failed and of the successful tasks of the feedback window."""
+    
+    end_date = date.today()
+    start_date = end_date - timedelta(days=settings.PLAN_FEEDBACK_WINDOW_DAYS - 1) # the feedback window is also given as input for plan update
+    list_of_task_failures = []
+    list_of_task_successes = []
+    
+    feedback_history = (await db.execute(
+        select(orm_models.Feedback).where(
+            orm_models.Feedback.owner_email == owner_email,
+            orm_models.Feedback.date >= start_date,
+            orm_models.Feedback.date <= end_date,
+        ).order_by(orm_models.Feedback.date)
+    )).scalars().all()
+    
+    for feedback in feedback_history:
+        list_of_task_failures.extend(feedback.list_of_task_failures)
+        list_of_task_successes.extend(feedback.list_of_task_successes)
+    return list_of_task_failures, list_of_task_successes
+
+async def update_plan_for_user(user: orm_models.Users, db: AsyncSession, fresh: bool = False) -> schemas.Plans:
+    """Updates the user's plan if the preferences and the plan already exists.
+    If fresh is set, a new plan is generated even if a plan for the same preferences and feedback is cached."""
     
     # Check if user has preferences
-    preferences = db.query(orm_models.Preferences).filter(orm_models.Preferences.owner_email == user.email).first()
+    preferences = (await db.execute(
+        select(orm_models.Preferences).where(orm_models.Preferences.owner_email == user.email)
+    )).scalars().first()
     if not preferences:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -89,62 +132,206 @@ def update_plan_for_user(user: orm_models.Users, db: Session) -> orm_models.Plan
         )
         
     # check if user has existing plans    
-    plan_query = db.query(orm_models.Plans).filter(orm_models.Plans.owner_email == user.email)
-    if not plan_query.first():
+    user_plans = (await db.execute(
+        select(orm_models.Plans).where(orm_models.Plans.owner_email == user.email)
+    )).scalars().first()
+    if not user_plans:
         raise HTTPException(
             status_code=404, 
             detail="No plan found to update."
         )
-    # adding the hard constraint to the preferred timings    
-    preferred_timings_list = preferences.preferred_timings
-    preferred_timings_list.insert(0, f"Hard constraint (even if the next elements in this list conflicts with this constraint, you must obey hard this constraint) : The suggested plan must take place after {datetime.now().strftime("%H hrs %M mins")}")
-    preferences.preferred_timings = preferred_timings_list
     
+    list_of_task_failures, list_of_task_successes = await get_recent_feedback(user.email, db)
+    await db.commit() # release the db connection while waiting on the LLM
     
-    end_date = date.today()
-    start_date = end_date - timedelta(days=4) # last 5 days feedback window is also given as input for plan update
-    list_of_task_failures = []
-    list_of_task_successes = []
+    async def generate_and_save() -> dict:
+        # Generate plan using preferences, the plan must take place after the current time (hard constraint)
+        generated_plan = await utils.aget_todays_plan(preferences,
+                                                      list_of_task_failures= list_of_task_failures,
+                                                      list_of_task_successes= list_of_task_successes,
+                                                      not_before= datetime.now(pytz.timezone(preferences.timezone)),
+                                                      bypass_cache= fresh)
+        # Convert task content to JSON strings and validate the plan
+        validated_plan = schemas.Plans(**utils.serialize_plan_content(copy.deepcopy(generated_plan)))
+        
+        for column, value in validated_plan.dict().items():
+            setattr(user_plans, column, value)
+        db.add(user_plans)
+        await coach_context.ainvalidate(user.email, db)
+        await db.commit()
+        return generated_plan
     
-    feedback_history = db.query(orm_models.Feedback).filter(
-        orm_models.Feedback.owner_email == user.email,
-        orm_models.Feedback.date >= start_date,
-        orm_models.Feedback.date <= end_date,
-        ).all()
+    return await generate_plan_once(user.email, generate_and_save)
+
+
+@router.put("", response_model=schemas.Plans, status_code=status.HTTP_200_OK)
+async def update_plan(
+    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user_async)],
+    db: AsyncSession = Depends(database.get_async_db),
+    fresh: bool = False
+):
+    """Updates the user's plan, with fresh=true the user gets a different plan even if nothing has changed."""
+    return await update_plan_for_user(current_user, db, fresh)
+
+## REGENERATE SOME TASKS OF THE PLAN ---------------------------
+async def regenerate_tasks_for_user(user: orm_models.Users, db: AsyncSession, task_numbers: List[int]) -> orm_models.Plans:
+    """Regenerates the given tasks of the user's plan, the other tasks are kept (and given as context to the LLM).
+    Only the columns of the regenerated tasks are written."""
     
-    for feedback in feedback_history:
-        list_of_task_failures.extend(feedback.list_of_task_failures)
-        list_of_task_successes.extend(feedback.list_of_task_successes)
+    preferences = (await db.execute(
+        select(orm_models.Preferences).where(orm_models.Preferences.owner_email == user.email)
+    )).scalars().first()
+    if not preferences:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Cannot generate a plan without user preferences."
+        )
     
-    # Generate plan using preferences
-    generated_plan = utils.get_todays_plan(preferences,
-                                           list_of_task_failures= list_of_task_failures,
-                                           list_of_task_successes= list_of_task_successes)
-    # Convert task content to JSON strings
-    generated_plan["task1_content"] = json.dumps(generated_plan["task1_content"])
-    generated_plan["task2_content"] = json.dumps(generated_plan["task2_content"])
-    generated_plan["task3_content"] = json.dumps(generated_plan["task3_content"])
+    user_plans = (await db.execute(
+        select(orm_models.Plans).where(orm_models.Plans.owner_email == user.email)
+    )).scalars().first()
+    if not user_plans:
+        raise HTTPException(
+            status_code=404, 
+            detail="No plan found to update."
+        )
+    current_plan = schemas.Plans.model_validate(user_plans, from_attributes=True).dict()
+    
+    list_of_task_failures, list_of_task_successes = await get_recent_feedback(user.email, db)
+    await db.commit() # release the db connection while waiting on the LLM
+    
+    async def generate_tasks() -> dict:
+        # the new tasks must take place after the current time (hard constraint)
+        return await utils.aregenerate_plan_tasks(preferences,
+                                                  current_plan,
+                                                  task_numbers,
+                                                  list_of_task_failures= list_of_task_failures,
+                                                  list_of_task_successes= list_of_task_successes,
+                                                  not_before= datetime.now(pytz.timezone(preferences.timezone)))
     
-    # Validate the plan
     try:
-        validated_plan = schemas.Plans(**generated_plan)
-    except Exception as e:
+        # concurrent identical requests share one generation (see generate_plan_once)
+        generated_tasks = utils.serialize_plan_content(
+            await plan_generations.do(f"{user.email}:tasks:{task_numbers}", generate_tasks))
+        validated_plan = schemas.Plans(**{**current_plan, **generated_tasks})
+    except ValidationError as e:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Generated plan validation failed: {str(e)}"
         )
     
-    plan_query.update(validated_plan.dict(), synchronize_session=False)
-    db.commit()
-    return plan_query.first()
+    for column in generated_tasks:
+        setattr(user_plans, column, getattr(validated_plan, column))
+    db.add(user_plans)
+    await coach_context.ainvalidate(user.email, db)
+    await db.commit()
+    return user_plans
 
 
-@router.put("", response_model=schemas.Plans, status_code=status.HTTP_200_OK)
-def update_plan(
-    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user)],
-    db: Session = Depends(database.get_db)
+@router.put("/tasks", response_model=schemas.Plans, status_code=status.HTTP_200_OK)
+async def regenerate_tasks(
+    tasks: schemas.RegenerateTasks,
+    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user_async)],
+    db: AsyncSession = Depends(database.get_async_db)
 ):
-    return update_plan_for_user(current_user, db)
+    """Regenerates only the given tasks of the user's plan (e.g. the afternoon and evening tasks when the user is behind schedule)."""
+    return await regenerate_tasks_for_user(current_user, db, tasks.tasks)
+
+@router.put("/tasks/{task_number}", response_model=schemas.Plans, status_code=status.HTTP_200_OK)
+async def regenerate_task(
+    task_number: Annotated[int, Path(ge=1, le=3)],
+    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user_async)],
+    db: AsyncSession = Depends(database.get_async_db)
+):
+    """Regenerates one task of the user's plan."""
+    return await regenerate_tasks_for_user(current_user, db, [task_number])
+
+## STREAM PLAN ---------------------------
+@router.post("/stream", status_code=status.HTTP_200_OK)
+async def stream_plan(
+    current_user: Annotated[schemas.CreateUserResponse, Depends(oauth2.get_current_user_async)],
+    db: AsyncSession = Depends(database.get_async_db),
+    fresh: bool = False
+):
+    """Generates the user's plan (a new plan, or an update of the existing one) as server-sent events:
+    a `task` event with the fields of each task as soon as it is generated, then a `plan` event
+    with the saved plan, or an `error` event if the generation failed."""
+    
+    preferences = (await db.execute(
+        select(orm_models.Preferences).where(orm_models.Preferences.owner_email == current_user.email)
+    )).scalars().first()
+    if not preferences:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Cannot generate a plan without user preferences."
+        )
+    
+    plan_exists = (await db.execute(
+        select(orm_models.Plans.id).where(orm_models.Plans.owner_email == current_user.email)
+    )).first() is not None
+    if plan_exists: # same inputs as PUT /plans
+        list_of_task_failures, list_of_task_successes = await get_recent_feedback(current_user.email, db)
+        not_before = datetime.now(pytz.timezone(preferences.timezone))
+    else: # same inputs as POST /plans
+        list_of_task_failures, list_of_task_successes, not_before = [], [], None
+    await db.commit() # release the db connection while waiting on the LLM
+    owner_email = current_user.email
+    
+    async def plan_events():
+        # the stream joins the generation of the user's plan in flight, if any (see generate_plan_once)
+        flight, is_leader = plan_generations.begin(owner_email)
+        try:
+            if is_leader:
+                generated_plan = {}
+                async for task_number, task in utils.astream_todays_plan(preferences,
+                                                                         list_of_task_failures= list_of_task_failures,
+                                                                         list_of_task_successes= list_of_task_successes,
+                                                                         not_before= not_before,
+                                                                         bypass_cache= fresh):
+                    generated_plan.update(task)
+                    yield utils.server_sent_event("task", {"task": task_number, **utils.serialize_plan_content(dict(task))})
+                validated_plan = schemas.Plans(**utils.serialize_plan_content(copy.deepcopy(generated_plan)))
+                
+                # the session of the request is not used here, the response outlives the dependency
+                async with database.AsyncSession_local() as plan_db:
+                    user_plans = (await plan_db.execute(
+                        select(orm_models.Plans).where(orm_models.Plans.owner_email == owner_email)
+                    )).scalars().first()
+                    if user_plans is None:
+                        user_plans = orm_models.Plans(owner_email = owner_email)
+                    for column, value in validated_plan.dict().items():
+                        setattr(user_plans, column, value)
+                    plan_db.add(user_plans)
+                    await coach_context.ainvalidate(owner_email, plan_db)
+                    await plan_db.commit()
+                plan_generations.end(owner_email, flight, result=generated_plan)
+            else:
+                generated_plan = await SingleFlight.wait(flight)
+                validated_plan = schemas.Plans(**utils.serialize_plan_content(generated_plan))
+                for task_number in range(1, 4):
+                    yield utils.server_sent_event("task", {"task": task_number, **utils.plan_task(validated_plan.dict(), task_number)})
+        except ValidationError as e:
+            if is_leader:
+                plan_generations.end(owner_email, flight, error=e)
+            yield utils.server_sent_event("error", {"detail": f"Generated plan validation failed: {str(e)}"})
+            return
+        except Exception as e:
+            if is_leader:
+                plan_generations.end(owner_email, flight, error=e)
+            yield utils.server_sent_event("error", {"detail": f"Plan generation failed: {str(e)}"})
+            return
+        except asyncio.CancelledError:
+            if is_leader or not flight.cancelled():
+                raise
+            yield utils.server_sent_event("error", {"detail": "Plan generation was cancelled, please retry."})
+            return
+        finally:
+            if is_leader: # no-op if ended above, else the client went away and the followers start a new generation
+                plan_generations.end(owner_email, flight, error=asyncio.CancelledError())
+        yield utils.server_sent_event("plan", validated_plan.dict())
+    
+    return StreamingResponse(plan_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 ## DELETE PLAN -------------------------------
 @router.delete("", status_code=status.HTTP_204_NO_CONTENT)
@@ -158,6 +345,7 @@ def delete_plan(
         raise HTTPException(status_code=404, detail="No plan found to delete.")
 
     plan_query.delete(synchronize_session=False)
+    coach_context.invalidate(current_user.email, db)
     db.commit()
     return
 
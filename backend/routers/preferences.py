@@ -1,7 +1,7 @@
 from sqlalchemy.orm import Session
 from fastapi import FastAPI, APIRouter, status, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
-from .. import utils, database, schemas, orm_models, oauth2
+from .. import utils, database, schemas, orm_models, oauth2, coach_context
 from typing import Annotated, List
 
 
@@ -58,10 +58,12 @@ def create_preferences(
         lifestyle=preferences.lifestyle,
         preferred_timings=preferences.preferred_timings,
         note=preferences.note,
+        timezone=preferences.timezone,
         owner_email=current_user.email
     )
 
     db.add(new_preferences)
+    coach_context.invalidate(current_user.email, db)
     db.commit()
     db.refresh(new_preferences)
     return new_preferences
@@ -88,6 +90,7 @@ def update_preferences(
         )
 
     user_preferences_query.update(preferences.dict(), synchronize_session=False)
+    coach_context.invalidate(current_user.email, db)
     db.commit()
     return user_preferences_query.first()
 
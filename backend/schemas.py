@@ -1,6 +1,8 @@
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, create_model, field_validator
 from datetime import datetime, date
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple, Type
+from functools import lru_cache
+import pytz
 
 class CreateUser(BaseModel):
     email: EmailStr
@@ -29,6 +31,14 @@ class Preferences(BaseModel):
     lifestyle: str
     preferred_timings: List[str]
     note: Optional[str] = None
+    timezone: str = "Europe/Berlin"
+    
+    @field_validator("timezone")
+    @classmethod
+    def validate_timezone(cls, value: str) -> str:
+        if value not in pytz.all_timezones_set:
+            raise ValueError(f"Unknown timezone '{value}'")
+        return value
     
 class PreferencesOut(Preferences):
     owner_email: str
@@ -55,6 +65,65 @@ class Plans(BaseModel):
     task3_timings_end: str
     task3_tip: str
 
+# the plan as generated by the LLM, used as the json schema of its structured output
+# (strict structured output needs every field required and no additional properties)
+class PlanTaskContent(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
+    step_1: str
+    step_2: str
+    step_3: str
+
+class GeneratedPlan(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
+    task1_title: str
+    task1_content: PlanTaskContent
+    task1_timings_start: str
+    task1_timings_end: str
+    task1_tip: str
+
+    task2_title: str
+    task2_content: PlanTaskContent
+    task2_timings_start: str
+    task2_timings_end: str
+    task2_tip: str
+
+    task3_title: str
+    task3_content: PlanTaskContent
+    task3_timings_start: str
+    task3_timings_end: str
+    task3_tip: str
+
+@lru_cache(maxsize=None)
+def generated_tasks_model(task_numbers: Tuple[int, ...]) -> Type[BaseModel]:
+    """The part of GeneratedPlan with the fields of the given tasks only, for the regeneration of some tasks of a plan."""
+    fields = {}
+    for task_number in task_numbers:
+        fields[f"task{task_number}_title"] = (str, ...)
+        fields[f"task{task_number}_content"] = (PlanTaskContent, ...)
+        fields[f"task{task_number}_timings_start"] = (str, ...)
+        fields[f"task{task_number}_timings_end"] = (str, ...)
+        fields[f"task{task_number}_tip"] = (str, ...)
+    return create_model(f"GeneratedTasks{''.join(map(str, task_numbers))}", __config__=ConfigDict(extra="forbid"), **fields)
+
+@lru_cache(maxsize=None)
+def generated_days_model(days: int) -> Type[BaseModel]:
+    """The plans of several days generated at once (day_1 ... day_<days>), for the weekly mode."""
+    fields = {f"day_{day}": (GeneratedPlan, ...) for day in range(1, days + 1)}
+    return create_model(f"GeneratedDays{days}", __config__=ConfigDict(extra="forbid"), **fields)
+
+# the tasks of the plan to regenerate (the others are kept)
+class RegenerateTasks(BaseModel):
+    tasks: List[int] = Field(min_length=1, max_length=3)
+    
+    @field_validator("tasks")
+    @classmethod
+    def validate_tasks(cls, value: List[int]) -> List[int]:
+        if any(task_number not in (1, 2, 3) for task_number in value):
+            raise ValueError("Task numbers must be 1, 2 or 3")
+        return sorted(set(value))
+
 # if the daily task is done or not    
 class Feedback(BaseModel):
     
@@ -0,0 +1,122 @@
+"""Semantic cache of the coach answers (SEMANTIC_CACHE_ENABLED): a question close enough to one already answered
+for a user with the same goal (cosine similarity of their embeddings >= SEMANTIC_CACHE_THRESHOLD) gets the cached answer,
+streamed like a generated one, instead of a new completion.
+
+The embeddings are local hashing embeddings (words and character trigrams hashed into EMBEDDING_DIMENSIONS buckets),
+no model nor network call. The questions about the user's own plan, and the short follow-ups which depend
+on the conversation, are never cached (nor any question after the first of a conversation, see utils.chatbot_events)."""
+from typing import List, Optional
+from .config import settings
+from .metrics import metrics
+import hashlib
+import numpy as np
+import re
+import threading
+import time
+
+EMBEDDING_DIMENSIONS = 1024
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+# the answer depends on the tasks of the user
+PLAN_REFERENCE_PATTERN = re.compile(
+    r"\b(?:my|this|today'?s|tomorrow'?s|the|these|those)\s+(?:\w+\s+)?(?:plans?|tasks?|schedule|routine|steps?|tips?)\b"
+    r"|\b(?:task|step)\s*(?:1|2|3|one|two|three)\b"
+    r"|\b(?:first|second|third|last|next)\s+(?:task|step)\b"
+)
+
+def normalize_query(text: str) -> str:
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+def references_plan(query: str) -> bool:
+    return PLAN_REFERENCE_PATTERN.search(normalize_query(query)) is not None
+
+def _bucket(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+
+def embed(text: str) -> np.ndarray:
+    """Unit length hashing embedding of a normalized text: its words (weight 1) and the character trigrams
+    of its words (weight 0.5, tolerant to typos and plurals), with a hashed sign to limit the collisions."""
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for word in text.split():
+        features = [(f"w:{word}", 1.0)]
+        padded = f" {word} "
+        features += [(f"c:{padded[i:i + 3]}", 0.5) for i in range(len(padded) - 2)]
+        for feature, weight in features:
+            bucket = _bucket(feature)
+            vector[bucket % EMBEDDING_DIMENSIONS] += weight if bucket & (1 << 63) else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SemanticCache:
+    """Size bounded vector index of the answers: the embeddings are the rows of a preallocated matrix, searched
+    with a single matrix-vector product. A full index replaces an expired entry, else the least recently used one."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, threshold: float, min_words: int = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.min_words = min_words
+        self._vectors = np.zeros((max_entries, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        self._goals = np.full(max_entries, None, dtype=object)
+        self._answers: List[Optional[str]] = [None] * max_entries
+        self._stored_at = np.full(max_entries, -np.inf)
+        self._used_at = np.full(max_entries, -np.inf)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def key(self, query: str, goal: str) -> Optional[tuple]:
+        """The (embedding, normalized goal) to look up and store the answer of query, None if it must not be cached."""
+        normalized = normalize_query(query)
+        if len(normalized.split()) < self.min_words or references_plan(query):
+            metrics.increment("semantic_cache_bypassed")
+            return None
+        return embed(normalized), normalize_query(goal or "")
+
+    def get(self, key: tuple) -> Optional[str]:
+        vector, goal = key
+        now = time.monotonic()
+        with self._lock:
+            if self._size:
+                similarities = self._vectors[:self._size] @ vector
+                candidates = ((self._goals[:self._size] == goal)
+                              & (now - self._stored_at[:self._size] <= self.ttl_seconds))
+                similarities = np.where(candidates, similarities, -1)
+                index = int(np.argmax(similarities))
+                if similarities[index] >= self.threshold:
+                    self._used_at[index] = now
+                    metrics.increment("semantic_cache_hits")
+                    metrics.observe("semantic_cache_hit_similarity", float(similarities[index]),
+                                    buckets=(0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1))
+                    return self._answers[index]
+        metrics.increment("semantic_cache_misses")
+        return None
+
+    def set(self, key: tuple, answer: str):
+        vector, goal = key
+        now = time.monotonic()
+        with self._lock:
+            if self._size < self.max_entries:
+                index = self._size
+                self._size += 1
+            else:
+                expired = np.flatnonzero(now - self._stored_at > self.ttl_seconds)
+                index = int(expired[0]) if len(expired) else int(np.argmin(self._used_at))
+                metrics.increment("semantic_cache_evictions")
+            self._vectors[index] = vector
+            self._goals[index] = goal
+            self._answers[index] = answer
+            self._stored_at[index] = self._used_at[index] = now
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self._goals[:] = None
+            self._answers = [None] * self.max_entries
+
+
+semantic_cache = SemanticCache(
+    max_entries= settings.SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl_seconds= settings.SEMANTIC_CACHE_TTL_SECONDS,
+    threshold= settings.SEMANTIC_CACHE_THRESHOLD,
+    min_words= settings.SEMANTIC_CACHE_MIN_WORDS
+) if settings.SEMANTIC_CACHE_ENABLED else None
@@ -0,0 +1,73 @@
+from concurrent.futures import Future, CancelledError
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+from .metrics import metrics
+import asyncio
+import copy
+import threading
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: the first caller (the leader) runs the call,
+    the callers arriving while it is in flight wait for it and get (a copy of) its result or its error.
+
+    The flights are concurrent.futures.Future, so callers running in other event loops of the process
+    (e.g. the plan worker thread) join them too. Every coalesced call is counted in the metrics."""
+
+    def __init__(self, metric_name: str):
+        self.metric_name = metric_name
+        self._flights: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key: Hashable) -> Tuple[Future, bool]:
+        """Joins the flight of key, or starts it. Returns the flight and whether the caller is its leader,
+        the leader must call end with the outcome."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                metrics.increment(self.metric_name)
+                return flight, False
+            flight = self._flights[key] = Future()
+            return flight, True
+
+    def end(self, key: Hashable, flight: Future, result: Any = None, error: BaseException = None):
+        """Completes the flight with the result or the error of the leader. A flight ended with
+        a CancelledError (the leader was cancelled) is cancelled, its followers start a new one."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if flight.done():
+            return
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            flight.cancel()
+        elif error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(result)
+
+    @staticmethod
+    async def wait(flight: Future) -> Any:
+        """Waits for a flight, cancelling the waiting caller does not cancel the flight."""
+        return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(flight)))
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs call(), unless a call with the same key is in flight, then returns the result of that one."""
+        while True:
+            flight, is_leader = self.begin(key)
+            if is_leader:
+                break
+            try:
+                return await self.wait(flight)
+            except (asyncio.CancelledError, CancelledError):
+                if not flight.cancelled():
+                    raise # this caller was cancelled, not the flight
+
+        try:
+            result = await call()
+        except BaseException as e:
+            self.end(key, flight, error=e)
+            raise
+        self.end(key, flight, result=copy.deepcopy(result))
+        return result
+
+
+# concurrent generations of the plan of the same user, keyed by the user's email
+plan_generations = SingleFlight(metric_name="plans_coalesced")
@@ -0,0 +1,33 @@
+from functools import lru_cache
+from typing import Any
+import logging
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """The tiktoken encoding of the model, None if it cannot be loaded (the encodings are downloaded on first use)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError: # unknown model
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.warning("Could not load the tiktoken encoding of %s, estimating 4 characters per token", model)
+        return None
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_prompt_tokens(prompt: Any, model: str = "gpt-4o") -> int:
+    """Tokens of a prompt (a prompt value, a list of messages or a string), with the per message overhead of the chat format."""
+    if hasattr(prompt, "to_messages"):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, str):
+        return count_tokens(prompt, model)
+    return sum(count_tokens(message.content if isinstance(message.content, str) else str(message.content), model) + 4
+               for message in prompt) + 3
@@ -6,19 +6,35 @@ from langchain_core.prompts import (ChatPromptTemplate,
                                     FewShotChatMessagePromptTemplate,
                                     AIMessagePromptTemplate)
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.chat_history import InMemoryChatMessageHistory
-from langchain.callbacks.base import AsyncCallbackHandler
-from langchain.schema import LLMResult
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
 from langchain_huggingface import HuggingFaceEndpoint, ChatHuggingFace
 from langchain_together import ChatTogether
 from backend.config import settings
-from backend import schemas
+from backend import schemas, plan_cache, plan_parsing, chat_history
+from backend.llm_router import LLMRouter, LLMTier
+from backend.llm_providers import build_chat_model, split_tokens
+from backend.rate_limiter import rate_limiter, llm_priority, BACKGROUND
+from backend.single_flight import SingleFlight
+from backend.semantic_cache import semantic_cache
+from backend.token_counting import count_tokens, count_prompt_tokens
+from backend.metrics import metrics
+from pydantic import BaseModel, ValidationError
+from typing import AsyncIterator, List, Tuple, Type
+import copy
 import json
+import pytz
 import asyncio
-from datetime import date
+import contextlib
+import time
+from datetime import date, datetime
 from cryptography.fernet import Fernet
 import os
 from dotenv import load_dotenv
+import logging
+
+logger = logging.getLogger(__name__)
+PROMPT_TOKEN_BUCKETS = (250, 500, 1000, 1500, 2000, 2500, 3000, 4000, 6000, 8000)
 
 ## hasing and varifying passwords ---------------------------------------------------
 from passlib.context import CryptContext
@@ -46,19 +62,39 @@ def decrypt_credentials(encrypted: str) -> dict:
 
 ## llm agent ---------------------------------------------------------------------------
 ## OpenAI provides paid models, HuggingFace provides opensource models
+## the models are called through an LLMRouter (deadline, hedged requests, fallback model), see llm_router.py
 
-plans_llm = ChatOpenAI(
-        model="gpt-4o",
+def openai_chat_model(model: str, timeout: float) -> ChatOpenAI:
+    return ChatOpenAI(
+        model=model,
         temperature=0.8,
         max_tokens=None,
-        timeout=None,
-        max_retries=2,
+        timeout=timeout, # the router bounds the calls too, this also bounds the requests it cannot cancel (sync calls)
+        max_retries=0, # the router retries, with hedged requests and fallback tiers
+        stream_usage=True, # token usage (with the cached prompt tokens) of the streamed calls too
         api_key= settings.OPENAI_API_KEY  # if you prefer to pass api key in directly instaed of using env vars
         # base_url="...",
         # organization="...",
         # other params...
     )
 
+def llm_tiers(use_case: str, model: str, fallback_model: str, timeout: float) -> List[LLMTier]:
+    """The primary tier, and the fallback tier if a fallback model is set, with the models of LLM_PROVIDER."""
+    tiers = [LLMTier("primary", build_chat_model(use_case, model, lambda: openai_chat_model(model, timeout)))]
+    if fallback_model:
+        tiers.append(LLMTier("fallback", build_chat_model(use_case, fallback_model, lambda: openai_chat_model(fallback_model, timeout))))
+    return tiers
+
+plans_llm = LLMRouter(
+        use_case="plan",
+        tiers=llm_tiers("plan", settings.PLAN_LLM_MODEL, settings.PLAN_LLM_FALLBACK_MODEL, settings.PLAN_LLM_DEADLINE_SECONDS),
+        deadline_seconds=settings.PLAN_LLM_DEADLINE_SECONDS,
+        tier_timeout_seconds=settings.PLAN_LLM_TIER_TIMEOUT_SECONDS,
+        hedge_after_seconds=settings.PLAN_LLM_HEDGE_AFTER_SECONDS,
+        rate_limiter=rate_limiter,
+        completion_tokens_estimate=settings.PLAN_LLM_COMPLETION_TOKENS_ESTIMATE
+    )
+
 # repo_id = "meta-llama/Meta-Llama-3-70B-Instruct"
 # HUGGINGFACEHUB_API_TOKEN = os.getenv("HUGGINGFACEHUB_API_TOKEN")
 # plans_llm = HuggingFaceEndpoint(
@@ -120,8 +156,8 @@ User Preferences:
 - Lifestyle: {lifestyle}
 - Preferred Timings (in order of preference): {preferred_timings}
 - Note: {note}
-- Tasks the user failed to complete recently: {list_of_task_failures}
-- Tasks the user completed successfully: {list_of_task_successes}
+- Tasks the user failed to complete recently (×N: N times): {list_of_task_failures}
+- Tasks the user completed successfully (×N: N times): {list_of_task_successes}
 """
 
 
@@ -140,31 +176,31 @@ User Preferences:
         "output": json.dumps(
 {
     "task1_title": "Morning Stretch Routine",
-    "task1_content": json.dumps({
+    "task1_content": {
         "step_1": "Start with neck rolls and shoulder circles to loosen up the upper body.",
         "step_2": "Do 5–10 minutes of gentle hamstring and back stretches.",
         "step_3": "Finish with deep breathing and light mobility drills to energize."
-    }),
+    },
     "task1_timings_start": "07:00:00",
     "task1_timings_end": "07:30:00",
     "task1_tip": "Play calming instrumental music to enhance relaxation during stretches.",
 
     "task2_title": "Afternoon Chair Workout",
-    "task2_content": json.dumps({
+    "task2_content": {
         "step_1": "Perform seated leg lifts and ankle rotations for 10 minutes.",
         "step_2": "Do 2 sets of 10 chair squats and light arm curls with water bottles.",
         "step_3": "Cool down with shoulder rolls and relaxed breathing."
-    }),
+    },
     "task2_timings_start": "01:00:00",
     "task2_timings_end": "01:30:00",
     "task2_tip": "Watch your favorite show while working out to stay motivated.",
 
     "task3_title": "Evening Relaxation Walk",
-    "task3_content": json.dumps({
+    "task3_content": {
         "step_1": "Begin with a gentle 5-minute warm-up walk around your home.",
         "step_2": "Walk at a relaxed pace for 15 minutes while maintaining good posture.",
         "step_3": "End with standing stretches for your legs and lower back."
-    }),
+    },
     "task3_timings_start": "06:30:00",
     "task3_timings_end": "07:00:00",
     "task3_tip": "Listen to an audiobook or podcast to make the walk more enjoyable."
@@ -184,31 +220,31 @@ User Preferences:
         "output": json.dumps(
 {
     "task1_title": "Afternoon Strength Training",
-    "task1_content": json.dumps({
+    "task1_content": {
         "step_1": "Begin with a 10-minute warm-up using treadmill or dynamic stretches.",
         "step_2": "Perform 4 sets of compound lifts: squats, deadlifts, bench presses.",
         "step_3": "Cool down with light cardio and foam rolling."
-    }),
+    },
     "task1_timings_start": "12:30:00",
     "task1_timings_end": "13:30:00",
     "task1_tip": "Use a workout playlist with high-energy music to push through heavy sets.",
 
     "task2_title": "Evening Core & Mobility",
-    "task2_content": json.dumps({
+    "task2_content": {
         "step_1": "Do 3 rounds of planks, hanging leg raises, and Russian twists.",
         "step_2": "Spend 15 minutes on hip openers, spinal twists, and shoulder mobility.",
         "step_3": "Finish with breathing exercises and light stretching."
-    }),
+    },
     "task2_timings_start": "18:00:00",
     "task2_timings_end": "18:45:00",
     "task2_tip": "Light candles or use a diffuser for a spa-like atmosphere during stretches.",
 
     "task3_title": "Morning Light Cardio",
-    "task3_content": json.dumps({
+    "task3_content": {
         "step_1": "Start with a brisk walk or cycling for 10 minutes.",
         "step_2": "Maintain moderate pace for another 10 minutes.",
         "step_3": "Cool down with easy pace and full-body stretches."
-    }),
+    },
     "task3_timings_start": "07:00:00",
     "task3_timings_end": "08:00:00",
     "task3_tip": "Take your cardio session outdoors for fresh air and natural light."
@@ -228,53 +264,372 @@ few_shot_prompt = FewShotChatMessagePromptTemplate(
     examples= examples
 )
 
+# the system prompt and the few shot examples are static, they form a prefix shared by all the plan generations
+# (cached by the provider), the preferences of the user come last
 plans_prompt = ChatPromptTemplate.from_messages([
-    SystemMessagePromptTemplate.from_template(system_prompt),
+    SystemMessage(content=system_prompt),
     few_shot_prompt,
     HumanMessagePromptTemplate.from_template(query)
 ])
 
+# several days in one call (weekly mode): the same static prefix, only the query differs
+query_days = """
+Based on the following preferences, create the plans of the next {days} days: for every day, a full-day plan broken into 3 tasks, in the same format as the plans above. Vary the tasks from day to day and let them progress gently over the days, while keeping them realistic for the user's routine. Format the result as a JSON object with the keys {day_keys}, each one being the plan of that day.
+
+User Preferences:
+- Goal: {goal}
+- Lifestyle: {lifestyle}
+- Preferred Timings (in order of preference): {preferred_timings}
+- Note: {note}
+- Tasks the user failed to complete recently (×N: N times): {list_of_task_failures}
+- Tasks the user completed successfully (×N: N times): {list_of_task_successes}
+"""
+
+days_prompt = ChatPromptTemplate.from_messages([
+    SystemMessage(content=system_prompt),
+    few_shot_prompt,
+    HumanMessagePromptTemplate.from_template(query_days)
+])
+
 ## calls the openai api to get the preferences of the current user -------------------------------------------
-def get_todays_plan(preferences: schemas.Preferences, list_of_task_failures = [], list_of_task_successes = []):
+# structured output: the completion is constrained to the json schema of schemas.GeneratedPlan,
+# so it is always a parseable plan (no stray text around the json)
+plan_response_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "daily_plan",
+        "strict": True,
+        "schema": schemas.GeneratedPlan.model_json_schema()
+    }
+}
+plans_pipeline = plans_prompt | plans_llm.bind(response_format= plan_response_format,
+                                               prompt_cache_key= "fitcoach-plans") # routes the calls to the same prompt cache
+
+def compact_task_titles(titles: List[str], token_budget: int = settings.PLAN_FEEDBACK_TOKEN_BUDGET) -> str:
+    """Deduplicates the task titles of the feedback window (ignoring case and whitespace) into "Title ×count",
+    the most frequent (then the most recent) first, and leaves out the rest once token_budget is reached.
+    So the prompt grows with the distinct tasks, not with the days of feedback."""
+    
+    counts, last_seen, display_titles = {}, {}, {}
+    for position, title in enumerate(titles): # titles are in the order of the feedback dates
+        key = " ".join(title.lower().split())
+        if not key:
+            continue
+        counts[key] = counts.get(key, 0) + 1
+        last_seen[key] = position
+        display_titles.setdefault(key, title.strip())
+    
+    entries, used_tokens = [], 0
+    for key in sorted(counts, key= lambda key: (-counts[key], -last_seen[key])):
+        entry = display_titles[key] if counts[key] == 1 else f"{display_titles[key]} ×{counts[key]}"
+        entry_tokens = count_tokens(entry + ", ", settings.PLAN_LLM_MODEL)
+        if used_tokens + entry_tokens > token_budget:
+            break
+        entries.append(entry)
+        used_tokens += entry_tokens
+    return ", ".join(entries)
+
+def record_plan_prompt_tokens(preferences_dict: dict, prompt: ChatPromptTemplate = plans_prompt):
+    """Logs and records the size of the plan prompt of a generation."""
+    prompt_tokens = count_prompt_tokens(prompt.invoke(preferences_dict), settings.PLAN_LLM_MODEL)
+    metrics.observe("plan_prompt_tokens", prompt_tokens, buckets=PROMPT_TOKEN_BUCKETS)
+    logger.info("Plan prompt of %d tokens", prompt_tokens)
+
+def count_plan_regeneration(attempt: int, error: ValidationError):
+    """Counts a plan output which could not be repaired, raises its error once PLAN_OUTPUT_MAX_REGENERATIONS are used."""
+    if attempt >= settings.PLAN_OUTPUT_MAX_REGENERATIONS:
+        metrics.increment("plan_output_invalid")
+        raise error
+    metrics.increment("plan_output_regenerated")
+    logger.warning("Invalid generated plan (%d errors), generating it again", error.error_count())
+
+async def ainvoke_plan_pipeline(pipeline, inputs: dict, model: Type[BaseModel] = schemas.GeneratedPlan, attempt: int = 0) -> dict:
+    """Calls a plan pipeline and parses its output into a plan (repaired if needed),
+    the LLM is called again only if the output cannot be repaired."""
+    while True:
+        ai_message = await pipeline.ainvoke(inputs)
+        try:
+            return plan_parsing.parse_plan_output(ai_message.content, model)
+        except ValidationError as e:
+            count_plan_regeneration(attempt, e)
+        attempt += 1
+
+def build_plan_inputs(preferences: schemas.Preferences, 
+                      list_of_task_failures = [], 
+                      list_of_task_successes = [], 
+                      not_before: datetime = None) -> dict:
+    """Builds the prompt variables for the plan generation pipeline.
+    If not_before is given, a hard constraint is put in front of the preferred timings,
+    so that the suggested plan takes place after that time."""
     
-    preferences_dict = {
+    preferred_timings = list(preferences.preferred_timings)
+    if not_before is not None:
+        preferred_timings.insert(0, f"Hard constraint (even if the next elements in this list conflicts with this constraint, you must obey hard this constraint) : The suggested plan must take place after {not_before.strftime('%H hrs %M mins')}")
+    
+    return {
         "goal": preferences.goal,
         "lifestyle": preferences.lifestyle,
-        "preferred_timings": preferences.preferred_timings,
+        "preferred_timings": preferred_timings,
         "note": preferences.note,
-        "list_of_task_failures": ", ".join(list_of_task_failures),
-        "list_of_task_successes": ", ".join(list_of_task_successes)
+        "list_of_task_failures": compact_task_titles(list_of_task_failures),
+        "list_of_task_successes": compact_task_titles(list_of_task_successes)
+    }
+
+async def aget_todays_plan(preferences: schemas.Preferences, 
+                           list_of_task_failures = [], 
+                           list_of_task_successes = [], 
+                           not_before: datetime = None,
+                           bypass_cache: bool = False):
+    """Generates a plan for the given preferences and feedback.
+    Plans are cached by their inputs, a cached plan is reused with its timings moved after not_before.
+    With bypass_cache a new plan is generated in any case (and cached)."""
+    
+    cache_key = plan_cache.plan_inputs_key(preferences, list_of_task_failures, list_of_task_successes)
+    if not bypass_cache:
+        cached_plan = await asyncio.to_thread(plan_cache.plan_cache.get, cache_key)
+        if cached_plan is not None:
+            try:
+                return shift_plan_after(cached_plan, not_before) if not_before else cached_plan
+            except PlanDoesNotFit:
+                metrics.increment("plan_cache_misfits") # a new plan is generated for the rest of the day
+    
+    preferences_dict = build_plan_inputs(preferences, list_of_task_failures, list_of_task_successes, not_before)
+    record_plan_prompt_tokens(preferences_dict)
+    
+    generated_plan = await ainvoke_plan_pipeline(plans_pipeline, preferences_dict)
+    await asyncio.to_thread(plan_cache.plan_cache.set, cache_key, generated_plan)
+    return generated_plan
+
+def days_response_format(days: int) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": f"plans_of_{days}_days",
+            "strict": True,
+            "schema": schemas.generated_days_model(days).model_json_schema()
+        }
     }
-    # print(f"My Preferences: {preferences_dict}")
+
+async def aget_plans_for_days(preferences: schemas.Preferences, 
+                              days: int,
+                              list_of_task_failures = [], 
+                              list_of_task_successes = [], 
+                              not_before: datetime = None) -> List[dict]:
+    """Generates the plans of the next days in one LLM call (the static prompt is paid once for all of them).
+    Returns one plan per day, the first one (today's) moved after not_before. The plans are not cached."""
+    
+    preferences_dict = build_plan_inputs(preferences, list_of_task_failures, list_of_task_successes)
+    preferences_dict.update({"days": days, "day_keys": ", ".join(f"day_{day}" for day in range(1, days + 1))})
+    record_plan_prompt_tokens(preferences_dict, days_prompt)
+    
+    days_pipeline = days_prompt | plans_llm.bind(response_format= days_response_format(days),
+                                                 prompt_cache_key= "fitcoach-plans") # same prefix as the daily plans
+    generated_days = await ainvoke_plan_pipeline(days_pipeline, preferences_dict, schemas.generated_days_model(days))
+    plans = [generated_days[f"day_{day}"] for day in range(1, days + 1)]
+    if not_before is not None:
+        plans[0] = shift_generated_plan_after(plans[0], not_before)
+    return plans
+
+PLAN_TASK_FIELDS = ("title", "content", "timings_start", "timings_end", "tip") # in the order of the json schema
+
+def plan_task(generated_plan: dict, task_number: int) -> dict:
+    """The fields of one task of a generated plan."""
+    return {f"task{task_number}_{field}": generated_plan[f"task{task_number}_{field}"] for field in PLAN_TASK_FIELDS}
+
+async def astream_todays_plan(preferences: schemas.Preferences, 
+                              list_of_task_failures = [], 
+                              list_of_task_successes = [], 
+                              not_before: datetime = None,
+                              bypass_cache: bool = False) -> AsyncIterator[Tuple[int, dict]]:
+    """Streaming version of aget_todays_plan, yields (task number, task fields) as soon as each task is complete.
+    
+    The completion is parsed incrementally, the structured output generates the keys in the order of the schema,
+    so a task is complete once the title of the next task shows up. The last task is yielded after
+    the whole plan has been validated (and cached), a ValidationError is raised if it is invalid."""
+    
+    cache_key = plan_cache.plan_inputs_key(preferences, list_of_task_failures, list_of_task_successes)
+    if not bypass_cache:
+        cached_plan = await asyncio.to_thread(plan_cache.plan_cache.get, cache_key)
+        try:
+            cached_plan = shift_plan_after(cached_plan, not_before) if cached_plan and not_before else cached_plan
+        except PlanDoesNotFit:
+            metrics.increment("plan_cache_misfits") # a new plan is generated for the rest of the day
+            cached_plan = None
+        if cached_plan is not None:
+            for task_number in range(1, 4):
+                yield task_number, plan_task(cached_plan, task_number)
+            return
+    
+    preferences_dict = build_plan_inputs(preferences, list_of_task_failures, list_of_task_successes, not_before)
+    record_plan_prompt_tokens(preferences_dict)
     
-    pipeline = (
-        {
-            "goal": lambda x: x["goal"],
-            "lifestyle": lambda x: x["lifestyle"],
-            "preferred_timings": lambda x: x["preferred_timings"],
-            "note": lambda x: x["note"],
-            "list_of_task_failures": lambda x: x["list_of_task_failures"],
-            "list_of_task_successes": lambda x: x["list_of_task_successes"]
+    partial_plan, next_task = {}, 1
+    async for partial_plan in (plans_pipeline | JsonOutputParser()).astream(preferences_dict):
+        while next_task < 3 and f"task{next_task + 1}_title" in partial_plan:
+            task = plan_parsing.normalize_plan(plan_task(partial_plan, next_task), [])
+            task[f"task{next_task}_content"] = schemas.PlanTaskContent.model_validate(task[f"task{next_task}_content"]).model_dump()
+            yield next_task, task
+            next_task += 1
+    
+    try:
+        generated_plan = plan_parsing.validate_plan(partial_plan, schemas.GeneratedPlan)
+    except ValidationError as e:
+        if next_task > 1: # tasks of this plan were already sent
+            metrics.increment("plan_output_invalid")
+            raise
+        count_plan_regeneration(0, e)
+        generated_plan = await ainvoke_plan_pipeline(plans_pipeline, preferences_dict, attempt=1)
+    await asyncio.to_thread(plan_cache.plan_cache.set, cache_key, generated_plan)
+    for task_number in range(next_task, 4):
+        yield task_number, plan_task(generated_plan, task_number)
+
+## regeneration of some tasks of a plan, the other tasks are kept ------------------------------------------
+system_prompt_tasks = """
+You are a smart fitness and lifestyle planning assistant. The user already has a personalized full-day plan of 3 tasks, and some of its tasks have to be replaced (e.g. because the user is behind schedule).
+
+You will be given the user's fitness goal, lifestyle type, preferred timings (in order of preference), an optional note, the tasks the user recently failed and completed, the tasks which are kept in the plan, and the keys of the tasks to create.
+
+Create only the requested tasks, with the requested keys:
+- taskN_title: concise and to the point (no more than ~5 words)
+- taskN_content: a dict with step_1, step_2, step_3, each a short instruction (~1–2 sentences)
+- taskN_timings_start and taskN_timings_end: in the format "HH:MM:SS"
+- taskN_tip: engaging and motivational, making the task more enjoyable or sustainable
+
+The new tasks must fit around the kept tasks: they must not overlap them, and they should complement them rather than repeat them.
+
+Think like a practical, encouraging coach who tailors fitness to real-life routines.
+"""
+
+query_tasks = """
+Create the tasks {task_numbers} of the user's plan (keys: {task_keys}).
+
+User Preferences:
+- Goal: {goal}
+- Lifestyle: {lifestyle}
+- Preferred Timings (in order of preference): {preferred_timings}
+- Note: {note}
+- Tasks the user failed to complete recently (×N: N times): {list_of_task_failures}
+- Tasks the user completed successfully (×N: N times): {list_of_task_successes}
+- Tasks kept in the plan (do not change them): {kept_tasks}
+"""
+
+tasks_prompt = ChatPromptTemplate.from_messages([
+    SystemMessage(content=system_prompt_tasks),
+    HumanMessagePromptTemplate.from_template(query_tasks)
+])
+
+def tasks_response_format(task_numbers: Tuple[int, ...]) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": f"plan_tasks_{''.join(map(str, task_numbers))}",
+            "strict": True,
+            "schema": schemas.generated_tasks_model(task_numbers).model_json_schema()
         }
-        | plans_prompt 
-        | plans_llm
-        )
-    ai_message = pipeline.invoke(preferences_dict)
-    return json.loads(ai_message.content)
+    }
+
+async def aregenerate_plan_tasks(preferences: schemas.Preferences, 
+                                 current_plan: dict,
+                                 task_numbers: List[int],
+                                 list_of_task_failures = [], 
+                                 list_of_task_successes = [], 
+                                 not_before: datetime = None) -> dict:
+    """Generates new versions of the given tasks of current_plan (a plan as stored, schemas.Plans),
+    with the other tasks given as fixed context. Returns the fields of the new tasks only."""
+    
+    task_numbers = tuple(sorted(task_numbers))
+    preferences_dict = build_plan_inputs(preferences, list_of_task_failures, list_of_task_successes, not_before)
+    kept_tasks = [f"Task {n}: {current_plan[f'task{n}_title']} ({current_plan[f'task{n}_timings_start']} - {current_plan[f'task{n}_timings_end']})"
+                  for n in range(1, 4) if n not in task_numbers]
+    preferences_dict.update({
+        "task_numbers": ", ".join(map(str, task_numbers)),
+        "task_keys": ", ".join(f"task{n}_{field}" for n in task_numbers for field in PLAN_TASK_FIELDS),
+        "kept_tasks": "; ".join(kept_tasks) or "none",
+    })
+    
+    tasks_pipeline = tasks_prompt | plans_llm.bind(response_format= tasks_response_format(task_numbers),
+                                                   prompt_cache_key= "fitcoach-plan-tasks")
+    return await ainvoke_plan_pipeline(tasks_pipeline, preferences_dict, schemas.generated_tasks_model(task_numbers))
+
+class PlanDoesNotFit(ValueError):
+    """The tasks of a plan cannot all be moved between not_before and midnight."""
+
+MIN_SHIFTED_TASK_MINUTES = 10 # a moved task is shortened to fit a free slot, down to this duration
+DAY_END_MINUTES = 23 * 60 + 59
+
+def shift_plan_after(generated_plan: dict, not_before: datetime) -> dict:
+    """Moves the tasks of a generated plan starting before not_before to the earliest free slots after it,
+    keeping their durations. Used when a plan generated for someone else (or earlier) is reused.
+    The tasks already after not_before stay where they are. A moved task is shortened to the largest free slot
+    if its duration does not fit anywhere before midnight, and PlanDoesNotFit is raised if no slot of
+    MIN_SHIFTED_TASK_MINUTES is left (every task keeps an end after its start)."""
+    
+    def to_minutes(timing: str) -> int:
+        hours, minutes = timing.split(":")[:2]
+        return int(hours) * 60 + int(minutes)
+    
+    def to_timing(minutes: int) -> str:
+        return f"{minutes // 60:02d}:{minutes % 60:02d}:00"
+    
+    not_before_minutes = not_before.hour * 60 + not_before.minute
+    earliest = not_before_minutes + -not_before_minutes % 15 # round up to a quarter hour
+    tasks = sorted(range(1, 4), key= lambda n: to_minutes(generated_plan[f"task{n}_timings_start"]))
+    kept = [n for n in tasks if to_minutes(generated_plan[f"task{n}_timings_start"]) >= not_before_minutes]
+    
+    # free slots between earliest and midnight, around the tasks which stay
+    free_slots, slot_start = [], earliest
+    for n in kept:
+        start, end = to_minutes(generated_plan[f"task{n}_timings_start"]), to_minutes(generated_plan[f"task{n}_timings_end"])
+        if start > slot_start:
+            free_slots.append([slot_start, start])
+        slot_start = max(slot_start, end)
+    if DAY_END_MINUTES > slot_start:
+        free_slots.append([slot_start, DAY_END_MINUTES])
+    
+    for n in tasks:
+        if n in kept:
+            continue
+        duration = to_minutes(generated_plan[f"task{n}_timings_end"]) - to_minutes(generated_plan[f"task{n}_timings_start"])
+        duration = max(duration, MIN_SHIFTED_TASK_MINUTES)
+        slot = next((slot for slot in free_slots if slot[1] - slot[0] >= duration), None)
+        if slot is None: # shortened to the largest free slot
+            slot = max(free_slots, key= lambda slot: slot[1] - slot[0], default=None)
+            if slot is None or slot[1] - slot[0] < MIN_SHIFTED_TASK_MINUTES:
+                raise PlanDoesNotFit(f"No free slot of {MIN_SHIFTED_TASK_MINUTES} minutes left after {to_timing(earliest)} for task {n}")
+            duration = slot[1] - slot[0]
+        generated_plan[f"task{n}_timings_start"] = to_timing(slot[0])
+        generated_plan[f"task{n}_timings_end"] = to_timing(slot[0] + duration)
+        slot[0] += duration
+    return generated_plan
+
+def shift_generated_plan_after(generated_plan: dict, not_before: datetime) -> dict:
+    """shift_plan_after for a plan just generated with not_before in its prompt: a plan which cannot be moved
+    (e.g. generated late in the evening) is kept as the LLM made it, there is no better one to use."""
+    try:
+        return shift_plan_after(copy.deepcopy(generated_plan), not_before)
+    except PlanDoesNotFit as e:
+        metrics.increment("plan_shift_misfits")
+        logger.warning("Generated plan kept as is: %s", e)
+        return generated_plan
+
+def serialize_plan_content(generated_plan: dict) -> dict:
+    """Converts the task content dicts of a generated plan (or of some of its tasks) to JSON strings, as stored in the plans table."""
+    for key in generated_plan:
+        if key.endswith("_content"):
+            generated_plan[key] = json.dumps(generated_plan[key])
+    return generated_plan
 
 
 ## -------------------------------------------------------------------- LLM agent for chat bot --------------------------
 
-chat_llm = ChatOpenAI(
-        model="gpt-4o",
-        temperature=0.8,
-        max_tokens=None,
-        timeout=None,
-        max_retries=2,
-        api_key= settings.OPENAI_API_KEY  # if you prefer to pass api key in directly instaed of using env vars
-        # base_url="...",
-        # organization="...",
-        # other params...
+chat_llm = LLMRouter(
+        use_case="chat",
+        tiers=llm_tiers("chat", settings.CHAT_LLM_MODEL, settings.CHAT_LLM_FALLBACK_MODEL, settings.CHAT_LLM_DEADLINE_SECONDS),
+        deadline_seconds=settings.CHAT_LLM_DEADLINE_SECONDS,
+        tier_timeout_seconds=settings.CHAT_LLM_TIER_TIMEOUT_SECONDS,
+        hedge_after_seconds=settings.CHAT_LLM_HEDGE_AFTER_SECONDS,
+        rate_limiter=rate_limiter,
+        completion_tokens_estimate=settings.CHAT_LLM_COMPLETION_TOKENS_ESTIMATE
     )
 
 
@@ -301,7 +656,12 @@ system_prompt_chatbot = """
 - Keep your response concise and to the point always.
 
 Note: if you are using emojees, use standard emojees only applicabple in markdown.
+"""
 
+# the user's goal and plans are kept out of the static system prompt above, so that the prompt of every user
+# starts with the same prefix (cached by the provider), followed by the prefix of the user (context and history).
+# Rendered once per user and cached, see coach_context.py
+user_context_chatbot = """
 Goal of the user:
 {goal}
 
@@ -310,6 +670,12 @@ User plans (if the user asks any questions related to their plans,use the follow
 - Task 2: {user_task2}
 - Task 3: {user_task3}
 """
+# the context of the answers of the semantic cache, which are served to every user with the same goal:
+# nothing specific to the user but the goal (which is part of the cache key)
+shared_user_context_chatbot = """
+Goal of the user:
+{goal}
+"""
 user_query_chatbot = """
 {user_query}
 
@@ -317,19 +683,17 @@ user_query_chatbot = """
 
 # chat prompt template
 chat_prompt_chatbot = ChatPromptTemplate(
-    [SystemMessagePromptTemplate.from_template(system_prompt_chatbot),
+    [SystemMessage(content=system_prompt_chatbot),
+    SystemMessagePromptTemplate.from_template("{user_context}"),
     MessagesPlaceholder(variable_name="chat_history"),
     HumanMessagePromptTemplate.from_template(user_query_chatbot),],
-    input_variables=["user_task1", "user_task2", "user_task3", "user_query", "goal"],
+    input_variables=["user_context", "user_query"],
     )
 
 # define get chat history
-chat_map = {}
-def get_chat_history(user_id: str):
-    """Retrieves the chat history for a given user."""
-    if user_id not in chat_map:
-        chat_map[user_id] = InMemoryChatMessageHistory()
-    return chat_map[user_id]
+def get_chat_history(user_id: str) -> chat_history.UserChatHistory:
+    """Retrieves the chat history for a given user (bounded, and stored in postgres, see chat_history.py)."""
+    return chat_history.chat_history_store.history(user_id)
 
 # pipeline wrapped with runnables with message history
 pipeline_chatbot = chat_prompt_chatbot | chat_llm
@@ -340,56 +704,139 @@ pipeline_with_history = RunnableWithMessageHistory(
     history_messages_key="chat_history"
 )
 
-## custom callback handler
-class TokenStreamHandler(AsyncCallbackHandler):
-    def __init__(self):
-        # Initialize an asyncio queue to hold the streamed tokens
-        self.queue = asyncio.Queue()
-
-    async def on_llm_new_token(self, token: str, **kwargs):
-        # This callback is triggered every time the LLM emits a new token
-        # Add the token to the queue for streaming
-        await self.queue.put(token)
-
-    async def on_llm_end(self, response: LLMResult, **kwargs):
-        # This callback is triggered when the LLM finishes generating a response
-        # Put a sentinel value (None) in the queue to indicate the end of stream
-        await self.queue.put(None)
-
-    async def __aiter__(self):
-        # Asynchronous generator to yield tokens one by one from the queue
-        while True:
-            token = await self.queue.get()  # Wait for next token
-            if token is None:
-                return  # End of stream
-            yield token  # Yield the token for downstream use (e.g., FastAPI StreamingResponse)
-            await asyncio.sleep(0.01) # add tiny delay to have a streaming behaviour
-
-
-handler = TokenStreamHandler()    
-async def get_chatbot_response(user_query: str, 
-                               user_id:str, 
-                               user_task1: str = None,
-                               user_task2: str = None, 
-                               user_task3: str = None,
-                               goal: str = None):
-    """Generates a response from the AI chatbot based on user input."""
+## rolling summary of the older turns (summary mode of the chat history, see chat_history.py)
+system_prompt_summary = """
+You maintain a running summary of a conversation between a user and their fitness coach.
+Update the current summary with the new messages. Keep the facts the coach needs for the next answers: the user's questions and concerns, their situation (injuries, schedule, diet, progress), and the advice already given.
+Write at most 150 words, in plain sentences, without markdown.
+"""
+
+summary_prompt = ChatPromptTemplate.from_messages([
+    SystemMessage(content=system_prompt_summary),
+    HumanMessagePromptTemplate.from_template("Current summary:\n{summary}\n\nNew messages:\n{messages}")
+])
+summary_pipeline = summary_prompt | chat_llm
+
+chat_summaries = SingleFlight(metric_name="chat_summaries_coalesced") # one summarization per user at a time
+background_tasks = set() # keeps the summarization tasks alive until they are done
+
+async def summarize_chat_history(user_id: str):
+    """Folds the turns before the last CHAT_HISTORY_KEEP_TURNS ones into the running summary of the user, if there are enough."""
+    pending = await asyncio.to_thread(chat_history.chat_history_store.pending_summary, user_id)
+    if pending is None:
+        return
+    summary, messages, summarized_up_to = pending
+    llm_priority.set(BACKGROUND) # only in this task, the answers of the users come first
+    ai_message = await summary_pipeline.ainvoke({
+        "summary": summary or "none",
+        "messages": "\n".join(f"{'User' if message.type == 'human' else 'Coach'}: {message.content}" for message in messages)
+    })
+    await asyncio.to_thread(chat_history.chat_history_store.set_summary, user_id, ai_message.content, summarized_up_to)
+    metrics.increment("chat_summaries")
+    logger.info("Folded %d chat messages of %s into the summary", len(messages), user_id)
+
+def schedule_chat_summary(user_id: str):
+    """Summarizes the history of the user in the background, after the response (off the hot path)."""
+    async def run():
+        try:
+            await chat_summaries.do(user_id, lambda: summarize_chat_history(user_id))
+        except Exception:
+            metrics.increment("chat_summary_errors")
+            logger.exception("Summary of the chat history of %s failed", user_id)
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 30, 40, 60, 80, 100, 150, 200)
+
+def server_sent_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_cached_answer(user_query: str, user_id: str, answer: str) -> AsyncIterator[AIMessageChunk]:
+    """Streams an answer of the semantic cache in chunks of about a token (like the model), then adds the turn
+    to the chat history of the user."""
+    for token in split_tokens(answer):
+        yield AIMessageChunk(content=token)
+        await asyncio.sleep(0) # let the other responses stream
+    await asyncio.to_thread(get_chat_history(user_id).add_messages, [HumanMessage(content=user_query), AIMessage(content=answer)])
+
+async def chatbot_events(user_query: str, 
+                         user_id:str, 
+                         user_context: str,
+                         goal: str = None) -> AsyncIterator[Tuple[str, dict]]:
+    """Streams the response of the AI chatbot as (event, data): a `token` event with every chunk of the answer
+    as soon as the model emits it, then an `end` event with the time to the first token and the tokens per second
+    of the request (or an `error` event). Every call streams its own chunks, nothing is shared between requests.
+    Closing the iterator or cancelling its task (e.g. when the client disconnects) closes the LLM stream right away.
+    user_context is the rendered user_context_chatbot of the user (see coach_context.get_coach_context).
+    With the semantic cache, the answer of a similar question asked for the same goal is streamed instead of a new one.
+    Only the first turn of a conversation goes through the cache, and its answer is generated with the goal alone
+    (shared_user_context_chatbot): a cached answer depends on nothing else the other users of the goal do not share."""
+    
+    start = time.monotonic()
+    first_token_at, chunks, output_tokens, prompt_tokens = None, 0, None, None
+    cache_key = semantic_cache.key(user_query, goal) if semantic_cache else None
+    if cache_key and await asyncio.to_thread(chat_history.chat_history_store.get_messages, user_id):
+        metrics.increment("semantic_cache_bypassed") # the answer depends on the conversation
+        cache_key = None
+    cached_answer = semantic_cache.get(cache_key) if cache_key else None
+    if cached_answer is not None:
+        chunk_stream = stream_cached_answer(user_query, user_id, cached_answer)
+    else:
+        if cache_key:
+            user_context = shared_user_context_chatbot.format(goal= goal)
+        chunk_stream = pipeline_with_history.astream({"user_context": user_context, "user_query": user_query},
+                                                     config = {"configurable": {"session_id": user_id}})
+    answer = []
+    try:
+        async with contextlib.aclosing(chunk_stream):
+            async for chunk in chunk_stream:
+                if chunk.usage_metadata: # last chunk
+                    output_tokens = chunk.usage_metadata.get("output_tokens")
+                    prompt_tokens = chunk.usage_metadata.get("input_tokens")
+                if not chunk.content:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                chunks += 1
+                answer.append(chunk.content)
+                yield "token", {"text": chunk.content}
+    except Exception:
+        logger.exception("Coach response for %s failed", user_id)
+        metrics.increment("coach_errors")
+        yield "error", {"detail": "The coach could not answer, please try again."}
+        return
     
-    async for chunk in pipeline_with_history.astream(
-        {"user_task1": user_task1, "user_task2": user_task2, "user_task3": user_task3, 
-         "user_query": user_query, "goal": goal}, 
-        config = {"session_id": user_id, "callbacks": [handler]}
-    ):
-        yield chunk.content
+    end = time.monotonic()
+    tokens = output_tokens or chunks # a chunk is about a token if the provider reports no usage
+    time_to_first_token = (first_token_at or end) - start
+    tokens_per_second = tokens / (end - first_token_at) if first_token_at and end > first_token_at else 0
+    if cached_answer is None: # the histograms are about the model
+        metrics.observe("coach_time_to_first_token_seconds", time_to_first_token)
+        metrics.observe("coach_tokens_per_second", tokens_per_second, buckets=TOKENS_PER_SECOND_BUCKETS)
+        if cache_key:
+            semantic_cache.set(cache_key, "".join(answer))
+    if prompt_tokens is not None: # stays flat over a long conversation in the summary mode
+        metrics.observe("coach_prompt_tokens", prompt_tokens, buckets=PROMPT_TOKEN_BUCKETS)
+    logger.info("Coach response of %d tokens (prompt of %s tokens%s), first token after %.2fs, %.1f tokens/s",
+                tokens, prompt_tokens, ", cached" if cached_answer is not None else "", time_to_first_token, tokens_per_second)
+    if settings.CHAT_HISTORY_KEEP_TURNS > 0:
+        schedule_chat_summary(user_id)
+    yield "end", {"tokens": tokens,
+                  "prompt_tokens": prompt_tokens,
+                  "time_to_first_token_seconds": round(time_to_first_token, 3),
+                  "tokens_per_second": round(tokens_per_second, 1),
+                  "cached": cached_answer is not None}
         
 ## ----------- Helper functions for calendar events ---------------------------->
 
-def create_calendar_events(user_plans: schemas.Plans, service):
+def create_calendar_events(user_plans: schemas.Plans, service, timezone: str = "Europe/Berlin"):
     
-    """Creates calendar events based on the user's plans."""
+    """Creates calendar events based on the user's plans, on today's date and at the timings
+    of the plans in the user's timezone (the plans are generated in it)."""
     
     # creating events from user's plans -------------------------------->
-    todays_date = date.today().isoformat()  # Get today's date in ISO format
+    todays_date = datetime.now(pytz.timezone(timezone)).date().isoformat()  # Get the user's local date in ISO format
     task1_content = ""
     task2_content = "" 
     task3_content = ""
@@ -407,11 +854,11 @@ def create_calendar_events(user_plans: schemas.Plans, service):
         'description': task1_content,
         'start': {
             'dateTime': todays_date + 'T' + user_plans.task1_timings_start,
-            'timeZone': 'Europe/Berlin',
+            'timeZone': timezone,
         },
         'end': {
             'dateTime': todays_date + 'T' + user_plans.task1_timings_end,
-            'timeZone': 'Europe/Berlin',
+            'timeZone': timezone,
         },
     }
     event2 = {
@@ -419,11 +866,11 @@ def create_calendar_events(user_plans: schemas.Plans, service):
         'description': task2_content,
         'start': {
             'dateTime': todays_date + 'T' + user_plans.task2_timings_start,
-            'timeZone': 'Europe/Berlin',
+            'timeZone': timezone,
         },
         'end': {
             'dateTime': todays_date + 'T' + user_plans.task2_timings_end,
-            'timeZone': 'Europe/Berlin',
+            'timeZone': timezone,
         },
     }
     event3 = {
@@ -431,11 +878,11 @@ def create_calendar_events(user_plans: schemas.Plans, service):
         'description': task3_content,
         'start': {
             'dateTime': todays_date + 'T' + user_plans.task3_timings_start,
-            'timeZone': 'Europe/Berlin',
+            'timeZone': timezone,
         },
         'end': {
             'dateTime': todays_date + 'T' + user_plans.task3_timings_end,
-            'timeZone': 'Europe/Berlin',
+            'timeZone': timezone,
         },
     }
     # -------------------------------------------------------------------------------
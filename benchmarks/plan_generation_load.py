@@ -0,0 +1,79 @@
+"""Latency of /me while many plan generations are in flight (the plan endpoints must not hold threads
+while they wait on the LLM).
+
+Run the backend with a slow fake LLM, e.g.
+    LLM_PROVIDER=fake FAKE_LLM_LATENCY_SECONDS=3 uvicorn backend.fastapi_app:app --port 8000
+then
+    python benchmarks/plan_generation_load.py --url http://127.0.0.1:8000 --users 200
+
+The users bench-<n>@example.com are created (with their preferences and a first plan) on the first run.
+Every user regenerates their plan once (PUT /plans?fresh=true, one LLM call each, nothing coalesced nor cached)
+while /me is probed, the /me latencies with and without the load are printed."""
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+PASSWORD = "bench-password"
+
+async def sign_in(client: httpx.AsyncClient, n: int) -> dict:
+    """Creates the user n (if needed) with preferences and a plan, returns its auth headers."""
+    email = f"bench-{n}@example.com"
+    await client.post("/auth/register", json={"email": email, "username": f"bench{n}", "password": PASSWORD}) # 400 if it exists
+    token = (await client.post("/auth/login", data={"username": email, "password": PASSWORD})).raise_for_status().json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    await client.post("/preferences", headers=headers, json={
+        "goal": "Get fitter", "lifestyle": "Office job", "preferred_timings": ["mornings"], "note": f"benchmark user {n}"
+    })
+    await client.post("/plans", headers=headers) # 4xx if the user already has a plan
+    return headers
+
+async def probe(client: httpx.AsyncClient, headers: dict, count: int, interval: float) -> list:
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        (await client.get("/me", headers=headers)).raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+def summary(latencies: list) -> str:
+    latencies = sorted(latencies)
+    return (f"median {statistics.median(latencies) * 1000:.0f} ms, "
+            f"max {latencies[-1] * 1000:.0f} ms ({len(latencies)} requests)")
+
+async def main(args):
+    limits = httpx.Limits(max_connections=args.users + 10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        semaphore = asyncio.Semaphore(20) # registration hashes passwords, do not overload the setup
+        async def limited_sign_in(n):
+            async with semaphore:
+                return await sign_in(client, n)
+        users = await asyncio.gather(*(limited_sign_in(n) for n in range(args.users)))
+        print(f"/me alone: {summary(await probe(client, users[0], args.probes, args.interval))}")
+
+        async def regenerate(headers):
+            start = time.perf_counter()
+            response = await client.put("/plans", params={"fresh": "true"}, headers=headers)
+            return response.status_code, time.perf_counter() - start
+        generations = [asyncio.create_task(regenerate(headers)) for headers in users]
+        await asyncio.sleep(args.warmup) # let the generations reach the LLM
+        in_flight = sum(not generation.done() for generation in generations)
+        print(f"/me with {in_flight} plan generations in flight: {summary(await probe(client, users[0], args.probes, args.interval))}")
+
+        results = await asyncio.gather(*generations)
+        statuses = {}
+        for status_code, _ in results:
+            statuses[status_code] = statuses.get(status_code, 0) + 1
+        print(f"plan generations: {statuses}, {summary([seconds for _, seconds in results])}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=200, help="concurrent plan generations")
+    parser.add_argument("--probes", type=int, default=10, help="/me requests per measurement")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between the /me requests")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds between the start of the generations and the probes")
+    parser.add_argument("--timeout", type=float, default=120)
+    asyncio.run(main(parser.parse_args()))
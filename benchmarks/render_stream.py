@@ -0,0 +1,61 @@
+"""Client CPU of the streamed coach answer: re-rendering the whole markdown after every token, against
+frontend.streaming.render_stream (at most a render every 50 ms).
+
+    python benchmarks/render_stream.py --lines 150 --rates 100 400
+
+Every render JSON-encodes the whole markdown and scans its inline markup, as a stand-in for the delta which
+Streamlit sends (and the browser parses) on every placeholder.markdown call."""
+import argparse
+import json
+import re
+import resource
+import time
+from backend.llm_providers import split_tokens
+from frontend import streaming
+
+INLINE_MARKUP = re.compile(r"\*\*(.+?)\*\*|`(.+?)`")
+
+class Placeholder:
+    """Stands for st.empty(), counts the renders and the characters shipped."""
+    def __init__(self):
+        self.renders, self.chars, self.text = 0, 0, ""
+
+    def markdown(self, text: str):
+        self.renders += 1
+        self.chars += len(text)
+        self.text = text
+        json.dumps({"delta": {"markdown": {"body": text}}}).encode()
+        INLINE_MARKUP.findall(text)
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def stream(tokens, tokens_per_second: float):
+    for token in tokens:
+        time.sleep(1 / tokens_per_second)
+        yield token
+
+def render_every_chunk(chunks, placeholder) -> str:
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        placeholder.markdown(text)
+    return text
+
+def main(args):
+    answer = "### Tips\n\n" + "- **Stay consistent**: small daily habits beat occasional hard sessions, keep going.\n" * args.lines
+    tokens = split_tokens(answer)
+    print(f"answer of {len(tokens)} tokens")
+    for rate in args.rates:
+        for name, render in (("every chunk", render_every_chunk), ("throttled", streaming.render_stream)):
+            placeholder, start = Placeholder(), cpu_seconds()
+            text = render(stream(tokens, rate), placeholder)
+            print(f"{name:<11} {rate:>4g} tok/s: {placeholder.renders:>5} renders, {placeholder.chars / 1e6:5.1f}M chars, "
+                  f"cpu {cpu_seconds() - start:.2f}s, exact {text == answer and placeholder.text == answer}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=150, help="bullet lines of the answer")
+    parser.add_argument("--rates", type=float, nargs="+", default=[100, 400], help="tokens per second of the stream")
+    main(parser.parse_args())
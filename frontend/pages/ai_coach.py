@@ -2,30 +2,63 @@ import streamlit as st
 import random
 import time
 import requests
+import json
+import contextlib
+from websockets.sync.client import connect
+from websockets.exceptions import WebSocketException
+from websockets.protocol import State
 from frontend.streamlit_app import API_URL
-from frontend import utils
+from frontend import utils, streaming
 
 headers = {
     "Authorization": f"Bearer {utils.get_token()}"
 }
 
+COACH_WS_URL = API_URL.replace("http", "ws", 1) + "/coach/ws" # http -> ws, https -> wss
+
+def coach_connection():
+    """The websocket of the chat session with the coach, opened once and kept in the session state
+    (opened again if it was closed or if the user logged in again)."""
+    token, connection = st.session_state.get("coach_ws", (None, None))
+    if connection is None or token != headers["Authorization"] or connection.state is not State.OPEN:
+        connection = connect(COACH_WS_URL, additional_headers=headers, open_timeout=10)
+        st.session_state.coach_ws = (headers["Authorization"], connection)
+    return connection
+
 def stream_from_api(user_input: str):
     
-    """Generator to stream messages from the API."""
-    
-    response = requests.post(
-        f"{API_URL}/coach",
-        json={"user_query": user_input},
-        stream=True,
-        headers=headers
-    )
+    """Generator to stream messages from the API (a websocket message per chunk, then an end or error message).
+    If it is not run to the end (e.g. the user leaves the page), the connection is closed and the server stops the answer."""
     
-    if response.status_code !=200:
+    try:
+        connection = coach_connection()
+        connection.send(json.dumps({"user_query": user_input}))
+    except (OSError, WebSocketException):
+        st.session_state.pop("coach_ws", None)
         yield "⚠️ Error from server."
-    else:
-        for chunk in response.iter_lines(decode_unicode=True):
-            if chunk:
-                yield chunk + " "
+        return
+    
+    finished = False
+    try:
+        try:
+            for message in connection:
+                data = json.loads(message)
+                if data["event"] == "token":
+                    yield data["text"]
+                elif data["event"] == "error":
+                    finished = True
+                    yield f"\n\n⚠️ {data.get('detail', 'Error from server.')}"
+                    return
+                elif data["event"] == "end":
+                    finished = True
+                    return
+        except WebSocketException:
+            pass
+        yield "\n\n⚠️ Connection to the server lost."
+    finally:
+        if not finished:
+            connection.close()
+            st.session_state.pop("coach_ws", None)
 
 # get the username ------>
 response_user = requests.get(API_URL + "/me", headers=headers)
@@ -76,9 +109,7 @@ else:
         
         with st.chat_message("assistant"):
             markdown_placeholder = st.empty()  # Placeholder for streaming markdown
-            full_response = ""
-            for chunk in stream_from_api(user_input):
-                full_response += "\n" + chunk
-                markdown_placeholder.markdown(full_response)  # Re-render as markdown each step
+            with contextlib.closing(stream_from_api(user_input)) as chunks: # closed even if the script run is stopped
+                full_response = streaming.render_stream(chunks, markdown_placeholder)  # at most a re-render every 50 ms
 
         st.session_state.history[st.session_state.user_email].append({"role": "assistant", "content": full_response})
@@ -10,6 +10,7 @@ from frontend.streamlit_app import API_URL
 from frontend import utils
 import time
 import json
+import pytz
 import nivo_chart as nc
 
 headers = {
@@ -162,11 +163,23 @@ def adjust():
         # if no plan exists, then display a button to redirect to the onboarding page
         st.error("No plans found. Please set your preferences first.")
     else:
-        st.write("Do you really want to update your today's plan?")
-        # generate new plan --->
-        if st.button("Submit"):
+        detailed_plan = plans_response.json()
+        task_labels = {n: f"Task {n}: {detailed_plan[f'task{n}_title']} ({detailed_plan[f'task{n}_timings_start'][:5]})" for n in (1, 2, 3)}
+        # by default, only the tasks which have not started yet are replaced
+        # (plans are in the user's timezone, not the one of the Streamlit server)
+        preferences_response = requests.get(API_URL + "/preferences", headers = headers)
+        timezone = preferences_response.json().get("timezone") if preferences_response.status_code == 200 else None
+        now = datetime.now(pytz.timezone(timezone or "Europe/Berlin")).strftime("%H:%M:%S")
+        upcoming_tasks = [n for n in (1, 2, 3) if detailed_plan[f"task{n}_timings_start"] > now]
+        tasks_to_update = st.multiselect("Which tasks do you want to update?", options=[1, 2, 3],
+                                         default=upcoming_tasks or [1, 2, 3], format_func=lambda n: task_labels[n])
+        # generate new tasks (or a new plan) --->
+        if st.button("Submit", disabled=not tasks_to_update):
             with st.spinner("Updating your today's plan..."):
-                utils.generate_plan(API_URL)
+                if len(tasks_to_update) == 3:
+                    utils.generate_plan(API_URL)
+                else:
+                    utils.regenerate_tasks(API_URL, tasks_to_update)
             st.success("✅ Plan updated successfully!")
             time.sleep(1)
             st.rerun()  # Refresh the page to show the updated plan
@@ -81,7 +81,7 @@ else:
         st.markdown("Need a new plan?")
         if st.button("Generate New Plan"):
             with st.spinner("Generating new plan..."):
-                utils.generate_plan(API_URL)
+                utils.generate_plan(API_URL, fresh=True)
                 st.success("New plan generated successfully!")
                 st.rerun()
     with col2:
@@ -1,5 +1,6 @@
 import streamlit as st
 import requests
+import pytz
 from frontend.streamlit_app import API_URL
 from frontend import utils
 
@@ -17,6 +18,7 @@ if response.status_code == 200:
     lifestyle_response = response.json().get("lifestyle")
     preferred_timings_response = response.json().get("preferred_timings")
     note_response = response.json().get("note")
+    timezone_response = response.json().get("timezone")
     
 else:
     st.title("🚀 Let's Get You Started!")
@@ -83,6 +85,18 @@ with st.form("onboarding_form"):
     )
     st.caption("👆 Select at least 1 option for better personalization.")
 
+    ## TIMEZONE
+    st.markdown("---")
+    st.markdown("### 🌍 Where do you live?")
+    timezone_options = pytz.common_timezones
+    user_timezone = st.selectbox(
+        "Choose your timezone (your daily plan is prepared before your local morning):",
+        timezone_options,
+        index = timezone_options.index(timezone_response) 
+                if response.status_code == 200 and timezone_response in timezone_options 
+                else timezone_options.index("Europe/Berlin")
+    )
+
     ## Extra Notes
     st.markdown("---")
     note = st.text_area("📝 Any specific notes or considerations? (optional)", value =  note_response if response.status_code == 200 else "")
@@ -95,6 +109,7 @@ with st.form("onboarding_form"):
             "lifestyle": lifestyle,
             "preferred_timings": workout_time_pref if workout_time_pref != [] else ["Morning (6 AM - 9 AM)"],  # Default to morning if none selected
             "note": note,
+            "timezone": user_timezone,
         }
         if response.status_code == 200:
             # If preferences exist, update them
@@ -0,0 +1,19 @@
+"""Rendering of the streamed answers, kept free of streamlit so that it can be tested and benchmarked on its own."""
+import time
+
+def render_stream(chunks, placeholder, min_interval_seconds: float = 0.05) -> str:
+    
+    """Renders a stream of markdown chunks into placeholder and returns the whole text. The chunks are concatenated
+    exactly as sent, and the text is re-rendered at most every min_interval_seconds (the chunks received meanwhile
+    are rendered together), so that a long answer costs a few renders per second instead of one per token."""
+    parts, rendered_parts, last_render = [], 0, 0.0
+    for chunk in chunks:
+        parts.append(chunk)
+        now = time.monotonic()
+        if now - last_render >= min_interval_seconds:
+            placeholder.markdown("".join(parts))
+            rendered_parts, last_render = len(parts), now
+    text = "".join(parts)
+    if rendered_parts != len(parts): # the last chunks
+        placeholder.markdown(text)
+    return text
@@ -30,10 +30,10 @@ def get_token():
     return cookies.get("access_token")
 
 
-def generate_plan(API_URL: str):
+def generate_plan(API_URL: str, fresh: bool = False):
     
     """Checks if the user already has a plan,
-    if yes, update the plan,
+    if yes, update the plan (with fresh=True, always a different plan),
     if not, create a new plan"""
     # check if the user has a plan already in db
     headers = {
@@ -42,7 +42,7 @@ def generate_plan(API_URL: str):
     response = requests.get(API_URL+ "/plans", headers = headers)
     if response.status_code == 200:
         # if plan already exists, update the plan
-        put_response = requests.put(API_URL + "/plans", headers=headers)
+        put_response = requests.put(API_URL + "/plans", headers=headers, params={"fresh": fresh})
 
         if put_response.status_code !=200:
             st.error(put_response.json().get("detail", "Error updating plan."))
@@ -52,4 +52,15 @@ def generate_plan(API_URL: str):
         post_response = requests.post(API_URL + "/plans", headers=headers)
         
         if post_response.status_code != 201:
-            st.error(post_response.json().get("detail", "Error creating plan."))
\ No newline at end of file
+            st.error(post_response.json().get("detail", "Error creating plan."))
+
+def regenerate_tasks(API_URL: str, tasks: list):
+    
+    """Regenerates only the given tasks (numbers 1 to 3) of the user's plan, the other tasks are kept"""
+    headers = {
+        "Authorization": f"Bearer {get_token()}"
+    }
+    put_response = requests.put(API_URL + "/plans/tasks", headers=headers, json={"tasks": tasks})
+    
+    if put_response.status_code != 200:
+        st.error(put_response.json().get("detail", "Error updating plan."))
@@ -0,0 +1,26 @@
+"""Settings for the tests: the required settings get dummy values (unless set, e.g. in .env) and the LLMs
+are the local fake model, so that the backend modules can be imported without any service.
+The tests which need postgres use the DATABASE_* settings and are skipped if it cannot be reached."""
+import os
+
+for name, value in {
+    "DATABASE_USERNAME": "postgres",
+    "DATABASE_PASSWORD": "postgres",
+    "DATABASE_IP": "localhost",
+    "DATABASE_NAME": "fitcoach_test",
+    "DATABASE_PORT": "5432",
+    "SECRET_KEY": "test-secret-key",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "COOKIE_SECRET": "test-cookie-secret",
+    "COOKIE_PREFIX": "fitcoach-test",
+    "OPENAI_API_KEY": "sk-test",
+    "GOOGLE_REDIRECT_URI": "http://localhost:8000/calendar/callback",
+    "FRONTEND_URL": "http://localhost:8501",
+    "GOOGLE_CREDENTIALS_ENCRYPTION_KEY": "DRk6arwV4_GvlVg-LE86BtP5onCQuSHzOgiM9muSeBY=",
+    "LLM_PROVIDER": "fake",
+    "FAKE_LLM_LATENCY_SECONDS": "0",
+    "FAKE_LLM_TOKENS_PER_SECOND": "0",
+    "CHAT_HISTORY_BACKEND": "memory",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,36 @@
+from datetime import datetime
+from types import SimpleNamespace
+from backend import utils
+import json
+import pytz
+
+class FakeCalendarService:
+    """Stands for the Google Calendar service, records the inserted events."""
+    def __init__(self):
+        self.bodies = []
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        self.bodies.append(body)
+        return SimpleNamespace(execute=lambda: {"id": f"event{len(self.bodies)}"})
+
+def make_plans():
+    plans = {}
+    for n, (start, end) in enumerate([("07:00:00", "07:30:00"), ("12:00:00", "12:45:00"), ("18:00:00", "18:30:00")], start=1):
+        plans.update({f"task{n}_title": f"Task {n}", f"task{n}_content": json.dumps({"step1": "Do it"}),
+                      f"task{n}_timings_start": start, f"task{n}_timings_end": end})
+    return SimpleNamespace(**plans)
+
+def test_events_are_created_in_the_user_timezone_and_local_date():
+    # UTC+14 and UTC-11, at least one of them is not on the date of the server
+    for timezone in ("Pacific/Kiritimati", "Pacific/Pago_Pago"):
+        service = FakeCalendarService()
+        assert utils.create_calendar_events(make_plans(), service, timezone) == ["event1", "event2", "event3"]
+        local_date = datetime.now(pytz.timezone(timezone)).date().isoformat()
+        for body in service.bodies:
+            for edge in ("start", "end"):
+                assert body[edge]["timeZone"] == timezone
+                assert body[edge]["dateTime"].startswith(local_date + "T")
+        assert service.bodies[0]["start"]["dateTime"] == local_date + "T07:00:00"
@@ -0,0 +1,40 @@
+import types
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from backend import coach_context, oauth2
+from backend.routers import coach
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def authenticate(token, db):
+        return types.SimpleNamespace(email="user@example.com", username="user")
+    monkeypatch.setattr(oauth2, "authenticate_token_async", authenticate)
+    app = FastAPI()
+    app.include_router(coach.router)
+    with TestClient(app) as client:
+        yield client
+
+def test_failed_answer_sends_an_error_and_closes(client, monkeypatch):
+    async def failing_context(email):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(coach_context, "get_coach_context", failing_context)
+
+    with client.websocket_connect("/coach/ws?token=token") as websocket:
+        websocket.send_json({"user_query": "how do I warm up before a run"})
+        assert websocket.receive_json()["event"] == "error"
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_json()
+    assert closed.value.code == 1011
+
+def test_missing_context_keeps_the_websocket_open(client, monkeypatch):
+    async def no_context(email):
+        return None
+    monkeypatch.setattr(coach_context, "get_coach_context", no_context)
+
+    with client.websocket_connect("/coach/ws?token=token") as websocket:
+        for _ in range(2):
+            websocket.send_json({"user_query": "how do I warm up before a run"})
+            assert websocket.receive_json()["event"] == "error"
@@ -0,0 +1,42 @@
+from backend import event_scheduler, schemas, utils
+from backend.llm_providers import DEFAULT_FAKE_PLAN
+from backend.metrics import metrics
+import asyncio
+import copy
+import pytest
+
+PREFERENCES = schemas.Preferences(goal="Run a 10k", lifestyle="Office job", preferred_timings=["evenings"], note=None,
+                                  timezone="Pacific/Kiritimati")
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    calls = []
+    async def generate(preferences, **kwargs):
+        calls.append(preferences)
+        await asyncio.sleep(0.01)
+        return copy.deepcopy(DEFAULT_FAKE_PLAN)
+    monkeypatch.setattr(utils, "aget_todays_plan", generate)
+    monkeypatch.setattr(utils, "shift_plan_after", lambda plan, not_before: plan) # any time of the day
+    return calls
+
+def make_jobs(count, preferences=PREFERENCES, first=0):
+    return [event_scheduler.PlanGenerationJob(email=f"user{n}@example.com", plan_id=n, preferences=preferences)
+            for n in range(first, first + count)]
+
+def run(jobs, cohorts):
+    generated = []
+    report = asyncio.run(event_scheduler.generate_plans(jobs, on_plan_generated=lambda job, plan: generated.append(job.email),
+                                                        cohorts=cohorts))
+    return report, generated
+
+
+def test_cohort_hits_and_saved_calls_are_counted(llm_calls):
+    before = {name: metrics.get(name) for name in ("plan_cohort_jobs", "plan_cohort_hits", "plan_cohort_llm_calls_saved")}
+    with_note = PREFERENCES.model_copy(update={"note": "bad knee"}) # never grouped
+    report, generated = run(make_jobs(5) + make_jobs(1, with_note, first=5), cohorts={})
+
+    assert len(generated) == 6 and len(llm_calls) == 2
+    assert report.cohort_hits == 4
+    assert metrics.get("plan_cohort_jobs") - before["plan_cohort_jobs"] == 5
+    assert metrics.get("plan_cohort_hits") - before["plan_cohort_hits"] == 4
+    assert metrics.get("plan_cohort_llm_calls_saved") - before["plan_cohort_llm_calls_saved"] == 4
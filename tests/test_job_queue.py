@@ -0,0 +1,80 @@
+"""The plan job queue against postgres, skipped if the database of the DATABASE_* settings cannot be reached."""
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import delete, text
+from sqlalchemy.exc import OperationalError
+from backend import job_queue, orm_models
+import pytest
+
+EMAIL = "job-queue-test-{}@example.com"
+RUN_DATE = date(2000, 1, 1) # no real run
+
+@pytest.fixture
+def db():
+    from backend import database
+    try:
+        with database.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except OperationalError:
+        pytest.skip("postgres is not reachable")
+    orm_models.create_tables(database.engine)
+    db = database.Session_local()
+    emails = [EMAIL.format(n) for n in range(4)]
+    db.execute(delete(orm_models.Users).where(orm_models.Users.email.in_(emails)))
+    db.add_all([orm_models.Users(email=email, username=f"user{n}", password=f"hash{n}") for n, email in enumerate(emails)])
+    db.commit()
+    yield db
+    db.rollback()
+    db.execute(delete(orm_models.Users).where(orm_models.Users.email.in_(emails))) # the jobs are deleted in cascade
+    db.commit()
+    db.close()
+
+
+def test_run_summary_covers_all_the_batches(db):
+    start = datetime(2000, 1, 1, 4, 0, tzinfo=timezone.utc)
+    states = [(job_queue.DONE, 0, 30), (job_queue.DONE, 10, 50), (job_queue.DEAD, 20, 60), (job_queue.PENDING, None, None)]
+    db.add_all([orm_models.PlanJobs(owner_email=EMAIL.format(n), run_date=RUN_DATE, status=status,
+                                    claimed_at=start + timedelta(seconds=claimed) if claimed is not None else None,
+                                    updated_at=start + timedelta(seconds=finished) if finished is not None else start)
+                for n, (status, claimed, finished) in enumerate(states)])
+    db.commit()
+
+    summary = job_queue.run_summary(db, RUN_DATE)
+    assert summary["jobs"] == {"total": 4, "done": 2, "dead": 1, "pending": 1, "running": 0}
+    assert summary["wall_time_seconds"] == 60 # from the first claim to the last finished job
+    assert summary["plans_per_second"] == round(2 / 60, 3)
+
+def claim(db, worker_id, lease_seconds=600):
+    return [job for job in job_queue.claim_jobs(db, worker_id, limit=100, lease_seconds=lease_seconds)
+            if job.owner_email.startswith("job-queue-test-")]
+
+def test_a_worker_which_lost_its_lease_leaves_the_job(db):
+    db.add(orm_models.PlanJobs(owner_email=EMAIL.format(0), run_date=RUN_DATE))
+    db.commit()
+    [lost_job] = claim(db, "worker-a", lease_seconds=-1) # expired at once
+    [job] = claim(db, "worker-b")
+    assert job.attempts == 2
+
+    assert not job_queue.complete_job(db, lost_job, "worker-a")
+    assert not job_queue.fail_job(db, lost_job, "worker-a", "too late")
+    db.refresh(job)
+    assert (job.status, job.locked_by, job.last_error) == (job_queue.RUNNING, "worker-b", None)
+
+    assert job_queue.complete_job(db, job, "worker-b")
+    db.refresh(job)
+    assert (job.status, job.locked_by) == (job_queue.DONE, None)
+
+def test_failed_job_is_retried_with_backoff_then_dead(db, monkeypatch):
+    monkeypatch.setattr(job_queue.settings, "PLAN_JOB_MAX_ATTEMPTS", 2)
+    db.add(orm_models.PlanJobs(owner_email=EMAIL.format(0), run_date=RUN_DATE))
+    db.commit()
+    [job] = claim(db, "worker-a")
+    assert job_queue.fail_job(db, job, "worker-a", "boom")
+    db.refresh(job)
+    assert job.status == job_queue.PENDING and job.run_after > datetime.now(timezone.utc) + timedelta(seconds=30)
+
+    job.run_after = datetime.now(timezone.utc) - timedelta(seconds=1) # skip the backoff
+    db.commit()
+    [job] = claim(db, "worker-a")
+    assert job_queue.fail_job(db, job, "worker-a", "boom again")
+    db.refresh(job)
+    assert (job.status, job.last_error) == (job_queue.DEAD, "boom again")
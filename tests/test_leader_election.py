@@ -0,0 +1,69 @@
+"""Several scheduler processes against one postgres database: a scheduled job must run exactly once.
+Skipped if the database of the DATABASE_* settings cannot be reached."""
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+import multiprocessing
+import os
+import pytest
+
+TEST_LOCK_ID = 72659999 # not the lock of a running scheduler
+WORKERS = 5
+
+@pytest.fixture(scope="module")
+def database_url():
+    from backend import database
+    try:
+        with create_engine(database.DATABASE_URL).connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except OperationalError:
+        pytest.skip("postgres is not reachable")
+    return database.DATABASE_URL
+
+
+def run_scheduled_job(executions_file: str, ready, done):
+    """A worker process: runs the scheduled job through run_if_leader at the same time as the others,
+    and keeps its connections (so the leadership) until all of them tried."""
+    os.environ["SCHEDULER_LEADER_LOCK_ID"] = str(TEST_LOCK_ID)
+    from backend import event_scheduler
+
+    def job():
+        with open(executions_file, "a") as executions:
+            executions.write(f"{os.getpid()}\n")
+
+    ready.wait()
+    event_scheduler.run_if_leader(job)()
+    done.wait()
+    event_scheduler.leader.release()
+
+
+def test_scheduled_job_runs_once_across_processes(database_url, tmp_path):
+    executions_file = str(tmp_path / "executions")
+    context = multiprocessing.get_context("spawn")
+    ready, done = context.Barrier(WORKERS), context.Barrier(WORKERS)
+    workers = [context.Process(target=run_scheduled_job, args=(executions_file, ready, done)) for _ in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    with open(executions_file) as executions:
+        assert len(executions.read().split()) == 1
+
+
+def test_follower_takes_over_after_release(database_url):
+    from backend.leader_election import LeaderElection
+    engines = [create_engine(database_url) for _ in range(WORKERS)] # one engine (connection) per simulated process
+    elections = [LeaderElection(engine, TEST_LOCK_ID) for engine in engines]
+    try:
+        assert [election.try_acquire() for election in elections].count(True) == 1
+        leader = next(election for election in elections if election.is_leader)
+        assert leader.try_acquire() # heartbeat of the leader
+        leader.release()
+        followers = [election for election in elections if election is not leader]
+        assert [election.try_acquire() for election in followers].count(True) == 1
+    finally:
+        for election in elections:
+            election.release()
+        for engine in engines:
+            engine.dispose()
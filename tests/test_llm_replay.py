@@ -0,0 +1,41 @@
+from datetime import datetime
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from backend import schemas, utils
+from backend.chat_history import SUMMARY_PREFIX
+from backend.llm_providers import FakeChatModel, RecordingChatModel, ReplayChatModel
+import pytest
+
+PREFERENCES = schemas.Preferences(goal="Run a 10k", lifestyle="Office job", preferred_timings=["mornings"], note=None)
+
+def plan_messages(now: datetime):
+    return utils.plans_prompt.invoke(utils.build_plan_inputs(PREFERENCES, ["Long run"], ["Stretching"], not_before=now)).to_messages()
+
+def recorder(tmp_path, use_case, response):
+    return RecordingChatModel(model_name="gpt", use_case=use_case, cassette_dir=str(tmp_path),
+                              model=FakeChatModel(response=response))
+
+def replayer(tmp_path, use_case):
+    return ReplayChatModel(model_name="gpt", use_case=use_case, cassette_dir=str(tmp_path))
+
+
+def test_a_plan_request_is_replayed_at_a_later_time(tmp_path):
+    recorded = recorder(tmp_path, "plan", '{"plan": 1}').invoke(plan_messages(datetime(2025, 3, 1, 9, 30)),
+                                                               response_format=utils.plan_response_format)
+    replayed = replayer(tmp_path, "plan").invoke(plan_messages(datetime(2025, 3, 1, 15, 45)),
+                                                 response_format=utils.plan_response_format)
+    assert replayed.content == recorded.content
+
+def test_other_preferences_are_not_replayed(tmp_path):
+    recorder(tmp_path, "plan", '{"plan": 1}').invoke(plan_messages(datetime(2025, 3, 1, 9, 30)))
+    other = utils.plans_prompt.invoke(utils.build_plan_inputs(PREFERENCES.model_copy(update={"goal": "Sleep better"}))).to_messages()
+    with pytest.raises(LookupError):
+        replayer(tmp_path, "plan").invoke(other)
+
+def test_a_chat_turn_is_replayed_whatever_the_history(tmp_path):
+    system = [SystemMessage(content="You are a coach."), SystemMessage(content="Task 1: Run (07:00-07:30)")]
+    question = HumanMessage(content="How do I warm up?")
+    recorder(tmp_path, "chat", "Jog slowly.").invoke(system + [question])
+
+    history = [SystemMessage(content=SUMMARY_PREFIX + "The user runs."), HumanMessage(content="Hi"), AIMessage(content="Hello!")]
+    moved_task = [system[0], SystemMessage(content="Task 1: Run (08:15-08:45)")]
+    assert replayer(tmp_path, "chat").invoke(moved_task + history + [question]).content == "Jog slowly."
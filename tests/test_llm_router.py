@@ -0,0 +1,95 @@
+from langchain_core.messages import HumanMessage
+from pydantic import Field
+from typing import List
+from backend.llm_providers import FakeChatModel
+from backend.llm_router import LLMRouter, LLMTier
+from backend.metrics import metrics
+import asyncio
+import itertools
+import pytest
+import time
+
+PROMPT = [HumanMessage(content="Plan my day")]
+_use_cases = itertools.count()
+
+class ScriptedModel(FakeChatModel):
+    """Fake model with a latency per call (the last one repeats), failing with `error` if set."""
+    latencies: List[float] = Field(default_factory=lambda: [0])
+    error: str = ""
+    calls: List[float] = Field(default_factory=list) # start time of every call
+
+    def _latency(self) -> float:
+        self.calls.append(time.monotonic())
+        return self.latencies[min(len(self.calls), len(self.latencies)) - 1]
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._latency())
+        if self.error:
+            raise RuntimeError(self.error)
+        return self._result(messages, self.response)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._latency())
+        if self.error:
+            raise RuntimeError(self.error)
+        for chunk in self._chunks(messages, self.response):
+            yield chunk
+
+def router(*models, deadline=2.0, tier_timeout=1.0, hedge_after=0.0) -> LLMRouter:
+    return LLMRouter(f"test{next(_use_cases)}", [LLMTier(name, model) for name, model in zip(("primary", "secondary"), models)],
+                     deadline_seconds=deadline, tier_timeout_seconds=tier_timeout, hedge_after_seconds=hedge_after)
+
+def counter(llm: LLMRouter, name: str) -> float:
+    return metrics.get(f"llm_{llm.use_case}_{name}")
+
+
+def test_failing_primary_falls_back_to_the_secondary():
+    llm = router(ScriptedModel(response="primary", error="rate limited"), ScriptedModel(response="secondary"))
+    assert asyncio.run(llm.ainvoke(PROMPT)).content == "secondary"
+    assert counter(llm, "errors") == 1 and counter(llm, "fallbacks") == 1
+
+def test_slow_primary_falls_back_after_the_tier_timeout():
+    primary, secondary = ScriptedModel(response="primary", latencies=[5]), ScriptedModel(response="secondary")
+    llm = router(primary, secondary, tier_timeout=0.2)
+    start = time.monotonic()
+    assert asyncio.run(llm.ainvoke(PROMPT)).content == "secondary"
+    assert time.monotonic() - start < 1
+    assert counter(llm, "timeouts") == 1
+
+def test_hedge_fires_after_the_configured_delay():
+    primary = ScriptedModel(response="hedged", latencies=[5, 0]) # the first request hangs, the hedge answers
+    llm = router(primary, hedge_after=0.2)
+    assert asyncio.run(llm.ainvoke(PROMPT)).content == "hedged"
+    assert len(primary.calls) == 2 and 0.15 < primary.calls[1] - primary.calls[0] < 0.5
+    assert counter(llm, "hedged") == 1
+
+def test_no_hedge_before_the_delay():
+    primary = ScriptedModel(response="fast", latencies=[0.05])
+    llm = router(primary, hedge_after=0.5)
+    assert asyncio.run(llm.ainvoke(PROMPT)).content == "fast"
+    assert len(primary.calls) == 1 and counter(llm, "hedged") == 0
+
+def test_deadline_raises():
+    llm = router(ScriptedModel(latencies=[5]), ScriptedModel(latencies=[5]), deadline=0.3, tier_timeout=0.2)
+    start = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(llm.ainvoke(PROMPT))
+    assert time.monotonic() - start < 1
+
+def test_stream_failing_before_the_first_chunk_switches_tiers():
+    llm = router(ScriptedModel(response="primary answer", error="connection reset"), ScriptedModel(response="secondary answer"))
+    async def collect():
+        return "".join([chunk.content async for chunk in llm.astream(PROMPT)])
+    assert asyncio.run(collect()) == "secondary answer"
+    assert counter(llm, "fallbacks") == 1
+
+def test_stream_slow_first_chunk_switches_tiers():
+    llm = router(ScriptedModel(response="primary answer", latencies=[5]), ScriptedModel(response="secondary answer"), tier_timeout=0.2)
+    async def collect():
+        return "".join([chunk.content async for chunk in llm.astream(PROMPT)])
+    assert asyncio.run(collect()) == "secondary answer"
+    assert counter(llm, "timeouts") == 1
+
+def test_sync_invoke_runs_the_async_path():
+    llm = router(ScriptedModel(response="primary", error="down"), ScriptedModel(response="secondary"))
+    assert llm.invoke(PROMPT).content == "secondary"
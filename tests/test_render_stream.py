@@ -0,0 +1,48 @@
+from frontend import streaming
+from backend.llm_providers import split_tokens
+import pytest
+
+ANSWER = "### Tips\n\n" + "- **Stay consistent**: small daily habits beat occasional hard sessions.\n" * 50
+
+class Placeholder:
+    """Stands for st.empty()."""
+    def __init__(self):
+        self.renders = []
+
+    def markdown(self, text):
+        self.renders.append(text)
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(streaming.time, "monotonic", clock.monotonic)
+    return clock
+
+def stream(tokens, clock, seconds_per_token):
+    for token in tokens:
+        clock.now += seconds_per_token
+        yield token
+
+
+@pytest.mark.parametrize("tokens_per_second", [20, 100, 400])
+def test_renders_are_bounded_by_the_interval_not_the_tokens(clock, tokens_per_second):
+    tokens = split_tokens(ANSWER)
+    placeholder = Placeholder()
+    text = streaming.render_stream(stream(tokens, clock, 1 / tokens_per_second), placeholder, min_interval_seconds=0.05)
+
+    assert text == ANSWER and placeholder.renders[-1] == ANSWER # concatenated exactly as sent
+    seconds = len(tokens) / tokens_per_second
+    assert len(placeholder.renders) <= min(len(tokens), seconds / 0.05 + 2)
+
+def test_a_burst_of_chunks_is_rendered_together(clock):
+    tokens = split_tokens(ANSWER)
+    placeholder = Placeholder()
+    streaming.render_stream(stream(tokens, clock, 0), placeholder)
+    assert placeholder.renders == [tokens[0], ANSWER]
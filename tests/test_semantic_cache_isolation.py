@@ -0,0 +1,54 @@
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from backend import utils, chat_history
+from backend.semantic_cache import SemanticCache
+import asyncio
+import pytest
+
+QUERY = "what should I eat before a morning workout"
+
+class RecordingPipeline:
+    """Stands for pipeline_with_history, records the inputs of the generations."""
+    def __init__(self):
+        self.inputs = []
+
+    async def astream(self, inputs, config=None):
+        self.inputs.append(inputs)
+        yield AIMessageChunk(content=f"answer {len(self.inputs)}")
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = RecordingPipeline()
+    monkeypatch.setattr(utils, "pipeline_with_history", pipeline)
+    monkeypatch.setattr(utils, "semantic_cache", SemanticCache(max_entries=10, ttl_seconds=60, threshold=0.9, min_words=4))
+    monkeypatch.setattr(utils.settings, "CHAT_HISTORY_KEEP_TURNS", 0)
+    yield pipeline
+    for user in ("alice@example.com", "bob@example.com"):
+        chat_history.chat_history_store.clear(user)
+
+def answer(user_id, user_context, goal="lose weight"):
+    async def collect():
+        return [event async for event in utils.chatbot_events(QUERY, user_id, user_context, goal)]
+    events = asyncio.run(collect())
+    return "".join(data["text"] for event, data in events if event == "token"), events[-1]
+
+
+def test_cached_answers_are_generated_without_the_user_context(pipeline):
+    text, end = answer("alice@example.com", "Alice's tasks: knee rehab")
+    assert not end[1]["cached"]
+    assert "Alice" not in pipeline.inputs[0]["user_context"]
+    assert "lose weight" in pipeline.inputs[0]["user_context"]
+
+    cached_text, end = answer("bob@example.com", "Bob's tasks")
+    assert end[1]["cached"] and cached_text == text
+    assert len(pipeline.inputs) == 1
+
+def test_turns_with_history_bypass_the_cache(pipeline):
+    answer("bob@example.com", "Bob's tasks") # cached for the goal
+    chat_history.chat_history_store.add_messages("alice@example.com", [HumanMessage(content="I hurt my knee"),
+                                                                       AIMessage(content="Rest it.")])
+    text, end = answer("alice@example.com", "Alice's tasks: knee rehab")
+    assert not end[1]["cached"]
+    assert pipeline.inputs[-1]["user_context"] == "Alice's tasks: knee rehab"
+
+    answer("bob@example.com", "Bob's tasks")
+    assert len(pipeline.inputs) == 2 # the answer of alice was not stored
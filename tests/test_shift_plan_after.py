@@ -0,0 +1,56 @@
+from datetime import datetime
+from backend import utils, plan_cache, schemas
+from backend.llm_providers import DEFAULT_FAKE_PLAN
+import asyncio
+import pytest
+
+def make_plan(*timings):
+    plan = {}
+    for n, (start, end) in enumerate(timings, start=1):
+        plan.update({f"task{n}_title": f"Task {n}", f"task{n}_timings_start": start, f"task{n}_timings_end": end})
+    return plan
+
+def intervals(plan):
+    return sorted((plan[f"task{n}_timings_start"], plan[f"task{n}_timings_end"]) for n in range(1, 4))
+
+def assert_valid_after(plan, not_before):
+    slots = intervals(plan)
+    for start, end in slots:
+        assert end > start
+        assert start >= not_before
+    for (_, end), (next_start, _) in zip(slots, slots[1:]):
+        assert end <= next_start # no overlap
+
+
+def test_moves_early_tasks_keeping_durations():
+    plan = make_plan(("07:00:00", "07:30:00"), ("12:00:00", "12:45:00"), ("18:00:00", "18:30:00"))
+    shifted = utils.shift_plan_after(plan, datetime(2025, 1, 1, 12, 10))
+    assert intervals(shifted) == [("12:15:00", "12:45:00"), ("12:45:00", "13:30:00"), ("18:00:00", "18:30:00")]
+
+def test_late_evening_keeps_tasks_after_not_before_and_shortens_the_others():
+    plan = make_plan(("07:00:00", "08:00:00"), ("12:00:00", "13:00:00"), ("23:30:00", "23:50:00"))
+    shifted = utils.shift_plan_after(plan, datetime(2025, 1, 1, 22, 10))
+    assert intervals(shifted) == [("22:15:00", "23:15:00"), ("23:15:00", "23:30:00"), ("23:30:00", "23:50:00")]
+    assert_valid_after(shifted, "22:10:00")
+
+def test_late_evening_without_room_for_every_task_raises():
+    # the 23:30 task stays, the other ones would only get 23:00-23:30 and 23:50-23:59
+    plan = make_plan(("07:00:00", "08:00:00"), ("12:00:00", "13:00:00"), ("23:30:00", "23:50:00"))
+    with pytest.raises(utils.PlanDoesNotFit):
+        utils.shift_plan_after(plan, datetime(2025, 1, 1, 22, 50))
+
+def test_no_room_left_raises():
+    plan = make_plan(("07:00:00", "08:00:00"), ("12:00:00", "13:00:00"), ("18:00:00", "19:00:00"))
+    with pytest.raises(utils.PlanDoesNotFit):
+        utils.shift_plan_after(plan, datetime(2025, 1, 1, 23, 40))
+
+def test_generated_plan_which_does_not_fit_is_kept():
+    plan = make_plan(("07:00:00", "08:00:00"), ("12:00:00", "13:00:00"), ("18:00:00", "19:00:00"))
+    assert utils.shift_generated_plan_after(plan, datetime(2025, 1, 1, 23, 40)) == plan
+
+def test_cached_plan_which_does_not_fit_is_generated_again():
+    preferences = schemas.Preferences(goal="Build muscle", lifestyle="Active", preferred_timings=["Evening"], note="", timezone="UTC")
+    cached_plan = make_plan(("07:00:00", "08:00:00"), ("12:00:00", "13:00:00"), ("18:00:00", "19:00:00"))
+    plan_cache.plan_cache.set(plan_cache.plan_inputs_key(preferences, [], []), cached_plan)
+    generated_plan = asyncio.run(utils.aget_todays_plan(preferences, not_before=datetime(2025, 1, 1, 23, 40)))
+    assert generated_plan["task1_title"] == DEFAULT_FAKE_PLAN["task1_title"] # a new plan, not the cached one